@@ -13,8 +13,11 @@ from __future__ import absolute_import, division, print_function  # confidence m
 import os
 import sys
 import numpy as np
+from astropy.io import fits
 from stsci.tools import fileutil, teal, logutil
 from . import outputimage
+from . import asyncwriter
+from . import rawfile
 from . import wcs_functions
 from . import processInput
 from . import util
@@ -36,6 +39,14 @@ __all__ = ['blot', 'runBlot', 'help', 'getHelpAsString']
 __taskname__ = 'drizzlepac.ablot'
 _blot_step_num_ = 5
 
+# Number of pixels by which the section of the median image used to blot
+# a chip extends beyond the footprint of the chip (covers the support of
+# the interpolation kernels):
+BLOT_MARGIN = 16
+
+# Median images opened by _get_median(): {(filename, extn): (signature, data, hdulist)}
+_median_cache = {}
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 
@@ -272,41 +283,8 @@ def run_blot(imageObjectList,output_wcs,paramDict,wcsmap=wcs_functions.WCSMap):
             plist = outputvals.copy()
             plist.update(paramDict)
 
-            # PyFITS can be used here as it will always operate on
-            # output from PyDrizzle (which will always be a FITS file)
-            # Open the input science file
-            medianPar = 'outMedian'
-            outMedianObj = img.getOutputName(medianPar)
-            if img.inmemory:
-                outMedian = img.outputNames[medianPar]
-                _fname,_sciextn = fileutil.parseFilename(outMedian)
-                _inimg = outMedianObj
-            else:
-                outMedian = outMedianObj
-                _fname,_sciextn = fileutil.parseFilename(outMedian)
-                _inimg = fileutil.openImage(_fname, memmap=False)
-
-            # Return the PyFITS HDU corresponding to the named extension
-            _scihdu = fileutil.getExtn(_inimg,_sciextn)
-            _insci = _scihdu.data.copy()
-            _inimg.close()
-            del _inimg, _scihdu
-
-            _outsci = do_blot(_insci, output_wcs,
-                   chip.wcs, chip._exptime, coeffs=paramDict['coeffs'],
-                   interp=paramDict['blot_interp'], sinscl=paramDict['blot_sinscl'],
-                   wcsmap=wcsmap)
-            # Apply sky subtraction and unit conversion to blotted array to
-            # match un-modified input array
-            if paramDict['blot_addsky']:
-                skyval = chip.computedSky
-            else:
-                skyval = paramDict['blot_skyval']
-            _outsci /= chip._conversionFactor
-            if skyval is not None:
-                _outsci += skyval
-                log.info('Applying sky value of %0.6f to blotted image %s'%
-                            (skyval,chip.outputNames['data']))
+            _outsci = blot_chip(img, chip, output_wcs, paramDict,
+                                wcsmap=wcsmap)
 
             # Write output Numpy objects to a PyFITS file
             # Blotting only occurs from a drizzled SCI extension
@@ -327,9 +305,130 @@ def run_blot(imageObjectList,output_wcs,paramDict,wcsmap=wcs_functions.WCSMap):
 
         del _outimg
 
+    _clear_median_cache()
+
+    # make sure all blotted images are on disk before they are used
+    asyncwriter.flush()
+
+
+def blot_chip(img, chip, output_wcs, paramDict, wcsmap=wcs_functions.WCSMap):
+    """
+    blot_chip(img, chip, output_wcs, paramDict, wcsmap=wcs_functions.WCSMap)
+
+    Blot the median image of ``img`` back to the frame of a single ``chip``
+    and return the blotted array, with the sky and units of the input chip,
+    without writing it out.
+    """
+    # Only the section of the median image that covers the chip is used:
+    _median = _get_median(img)
+    if wcsmap in [None, wcs_functions.WCSMap] and paramDict['coeffs']:
+        x1, x2, y1, y2 = _median_footprint(chip.wcs, output_wcs,
+                                           _median.shape)
+    else:
+        x1, x2, y1, y2 = 0, _median.shape[1], 0, _median.shape[0]
+    _insci = _median[y1:y2, x1:x2]
+
+    _outsci = do_blot(_insci, output_wcs,
+           chip.wcs, chip._exptime, coeffs=paramDict['coeffs'],
+           interp=paramDict['blot_interp'], sinscl=paramDict['blot_sinscl'],
+           wcsmap=wcsmap, source_origin=(x1, y1))
+    # Apply sky subtraction and unit conversion to blotted array to
+    # match un-modified input array
+    if paramDict['blot_addsky']:
+        skyval = chip.computedSky
+    else:
+        skyval = paramDict['blot_skyval']
+    _outsci /= chip._conversionFactor
+    if skyval is not None:
+        _outsci += skyval
+        log.info('Applying sky value of %0.6f to blotted image %s'%
+                    (skyval,chip.outputNames['data']))
+
+    return _outsci
+
+
+def _get_median(img):
+    """ Return the data of the median image associated with ``img``.
+
+    Median images on disk are opened only once, memory-mapped read-only, and
+    shared by all subsequent blot operations (and by worker processes forked
+    afterwards) until the file changes or `_clear_median_cache` is called.
+    """
+    medianPar = 'outMedian'
+    outMedianObj = img.getOutputName(medianPar)
+    if img.inmemory:
+        outMedian = img.outputNames[medianPar]
+        _fname,_sciextn = fileutil.parseFilename(outMedian)
+        return fileutil.getExtn(outMedianObj,_sciextn).data
+
+    _fname,_sciextn = fileutil.parseFilename(outMedianObj)
+    raw = rawfile.exists(_fname)
+    key = (os.path.abspath(_fname), str(_sciextn))
+    st = os.stat(rawfile.rawName(_fname) if raw else _fname)
+    signature = (raw, st.st_mtime, st.st_size)
+
+    if key in _median_cache and _median_cache[key][0] == signature:
+        return _median_cache[key][1]
+
+    if raw:
+        _inimg = None
+        data = rawfile.getdata(_fname)
+    else:
+        _inimg = fits.open(_fname, mode='readonly', memmap=True)
+        data = fileutil.getExtn(_inimg,_sciextn).data
+    _median_cache[key] = (signature, data, _inimg)
+    return data
+
+
+def _clear_median_cache():
+    """ Close all median images opened by `_get_median`. """
+    for signature, data, hdulist in _median_cache.values():
+        del data
+        if hdulist is not None:
+            hdulist.close()
+    _median_cache.clear()
+
+
+def _median_footprint(chip_wcs, median_wcs, shape, margin=BLOT_MARGIN):
+    """ Compute the region of the median image covered by a chip.
+
+    The outline of the chip is mapped onto the median image and its bounding
+    box, padded by ``margin`` pixels to account for the extent of the
+    interpolation kernels, is returned as 0-based slice limits
+    ``(x1, x2, y1, y2)``. The full image is returned when the chip does not
+    overlap the median image.
+    """
+    ny, nx = shape
+    cnx = chip_wcs._naxis1
+    cny = chip_wcs._naxis2
+
+    # pixel edges along the outline of the chip (1-based coordinates):
+    xedge = np.arange(cnx + 1, dtype=np.float64) + 0.5
+    yedge = np.arange(cny + 1, dtype=np.float64) + 0.5
+    x = np.concatenate([xedge, xedge, np.full_like(yedge, 0.5),
+                        np.full_like(yedge, cnx + 0.5)])
+    y = np.concatenate([np.full_like(xedge, 0.5), np.full_like(xedge, cny + 0.5),
+                        yedge, yedge])
+
+    ra, dec = chip_wcs.all_pix2world(x, y, 1)
+    mx, my = median_wcs.wcs_world2pix(ra, dec, 1)
+    if not (np.all(np.isfinite(mx)) and np.all(np.isfinite(my))):
+        return 0, nx, 0, ny
+
+    x1 = max(0, int(np.floor(mx.min())) - 1 - margin)
+    x2 = min(nx, int(np.ceil(mx.max())) + margin)
+    y1 = max(0, int(np.floor(my.min())) - 1 - margin)
+    y2 = min(ny, int(np.ceil(my.max())) + margin)
+
+    if x1 >= x2 or y1 >= y2:
+        return 0, nx, 0, ny
+
+    return x1, x2, y1, y2
+
 
 def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
-            interp='poly5', sinscl=1.0, stepsize=10, wcsmap=None):
+            interp='poly5', sinscl=1.0, stepsize=10, wcsmap=None,
+            source_origin=None):
     """ Core functionality of performing the 'blot' operation to create a single
         blotted image from a single source image.
         All distortion information is assumed to be included in the WCS specification
@@ -365,6 +464,10 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
             Custom mapping class to use to provide transformation from
             drizzled to blotted WCS.  Default will be to use
             `drizzlepac.wcs_functions.WCSMap`.
+        source_origin
+            Zero-based ``(x, y)`` position, in the frame described by
+            ``source_wcs``, of the first pixel of ``source`` when ``source``
+            is only a section of the full source image. Default is ``(0, 0)``.
 
     """
     _outsci = np.zeros((blot_wcs._naxis2,blot_wcs._naxis1),dtype=np.float32)
@@ -374,10 +477,16 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
     misval = 0.0
     kscale = 1.0
 
-    xmin = 1
-    xmax = source_wcs._naxis1
-    ymin = 1
-    ymax = source_wcs._naxis2
+    if source_origin is None:
+        xmin = 1
+        xmax = source_wcs._naxis1
+        ymin = 1
+        ymax = source_wcs._naxis2
+    else:
+        xmin = source_origin[0] + 1
+        xmax = source_origin[0] + source.shape[1]
+        ymin = source_origin[1] + 1
+        ymax = source_origin[1] + source.shape[0]
 
     # compute the undistorted 'natural' plate scale for this chip
     if coeffs:
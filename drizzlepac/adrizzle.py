@@ -14,6 +14,9 @@ import numpy as np
 from astropy.io import fits
 from stsci.tools import fileutil, logutil, mputil, teal
 from . import outputimage, wcs_functions, processInput, util
+from . import asyncwriter
+from .imageObject import chip_cache
+from .buildmask import mergeDQarray, PackedMask
 import stwcs
 from stwcs import distortion
 
@@ -396,48 +399,33 @@ def drizFinal(imageObjectList, output_wcs, configObj,build=None,wcsmap=None,proc
 
 # Run 'drizzle' here...
 #
-def mergeDQarray(maskname,dqarr):
-    """ Merge static or CR mask with mask created from DQ array on-the-fly here.
-    """
-    maskarr = None
-    if maskname is not None:
-        if isinstance(maskname, str):
-            # working with file on disk (default case)
-            if os.path.exists(maskname):
-                mask = fileutil.openImage(maskname, memmap=False)
-                maskarr = mask[0].data.astype(np.bool)
-                mask.close()
-        else:
-            if isinstance(maskname, fits.HDUList):
-                # working with a virtual input file
-                maskarr = maskname[0].data.astype(np.bool)
-            else:
-                maskarr = maskname.data.astype(np.bool)
-
-        if maskarr is not None:
-            # merge array with dqarr now
-            np.bitwise_and(dqarr,maskarr,dqarr)
-
 def updateInputDQArray(dqfile,dq_extn,chip, crmaskname,cr_bits_value):
-    if not isinstance(crmaskname, fits.HDUList) and not os.path.exists(crmaskname):
+    virtual = isinstance(crmaskname, (fits.HDUList, PackedMask))
+    if not virtual and not os.path.exists(crmaskname):
         log.warning('No CR mask file found! Input DQ array not updated.')
         return
     if cr_bits_value is None:
         log.warning('Input DQ array not updated!')
         return
-    if isinstance(crmaskname, fits.HDUList):
-        # in_memory case
-        crmask = crmaskname
-    else:
-        crmask = fileutil.openImage(crmaskname, memmap=False)
 
     if os.path.exists(dqfile):
+        if isinstance(crmaskname, PackedMask):
+            # in_memory case: mask kept with 8 pixels per byte
+            crarr = crmaskname.unpack()
+        elif virtual:
+            # in_memory case
+            crarr = crmaskname[0].data
+        else:
+            crmask = fileutil.openImage(crmaskname, memmap=False)
+            crarr = crmask[0].data
+            crmask.close()
+
         fullext=dqfile+"["+dq_extn+str(chip)+"]"
         infile = fileutil.openImage(fullext, mode='update', memmap=False)
-        __bitarray = np.logical_not(crmask[0].data).astype(np.int16) * cr_bits_value
+        __bitarray = np.logical_not(crarr).astype(np.int16) * cr_bits_value
         np.bitwise_or(infile[dq_extn,chip].data,__bitarray,infile[dq_extn,chip].data)
         infile.close()
-        crmask.close()
+        chip_cache.invalidate(dqfile)
 
 def buildDrizParamDict(configObj,single=True):
     chip_pars = ['units','wt_scl','pixfrac','kernel','fillval','bits','maskval']
@@ -604,13 +592,12 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     # An image buffer needs to be setup for converting the input
     # arrays (sci and wht) from FITS format to native format
     # with respect to byteorder and byteswapping.
-    # This buffer should be reused for each input if possible.
+    # For single drizzle, run_driz_img() allocates new buffers for each
+    # input since the finished products are handed over to the background
+    # writer (see asyncwriter) without making copies.
     #
     _outsci = _outwht = _outctx = _hdrlist = None
-    if (not single) or \
-       ( (single) and (not will_parallel) and (not imageObjectList[0].inmemory) ):
-        # Note there are four cases/combinations for single drizzle alone here:
-        # (not-inmem, serial), (not-inmem, parallel), (inmem, serial), (inmem, parallel)
+    if not single:
         #_outsci=np.zeros((output_wcs._naxis2,output_wcs._naxis1),dtype=np.float32)
         _outsci=np.empty((output_wcs._naxis2,output_wcs._naxis1),dtype=np.float32)
         _outsci.fill(maskval)
@@ -661,9 +648,9 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
                 img.virtualOutputs = dproxy
 
             # parallelize run_driz_img (currently for separate drizzle only)
-            p = multiprocessing.Process(target=run_driz_img,
+            p = multiprocessing.Process(target=asyncwriter.run_and_flush,
                 name='adrizzle.run_driz_img()', # for err msgs
-                args=(img,chiplist,output_wcs,outwcs,template,paramDict,
+                args=(run_driz_img,img,chiplist,output_wcs,outwcs,template,paramDict,
                       single,num_in_prod,build,_versions,_numctx,_nplanes,
                       _chipIdx,None,None,None,None,wcsmap))
             subprocs.append(p)
@@ -683,6 +670,9 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
         mputil.launch_and_wait(subprocs, pool_size) # blocks till all done
 
     del _outsci,_outwht,_outctx,_hdrlist
+
+    # make sure all products are on disk before the next step reads them
+    asyncwriter.flush()
     # have looped over each img/chip
 
 
@@ -740,6 +730,8 @@ def run_driz_img(img,chiplist,output_wcs,outwcs,template,paramDict,single,
     if here:
         del _outsci,_outwht,_outctx,_hdrlist
     elif single:
+        # buffers are reused: wait until they have been written out
+        asyncwriter.flush()
         np.multiply(_outsci,0.,_outsci)
         np.multiply(_outwht,0.,_outwht)
         np.multiply(_outctx,0,_outctx)
@@ -772,16 +764,16 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
         _expname = chip.outputNames['data']
     log.info('-Drizzle input: %s' % _expname)
 
-    # Open the SCI image
-    _handle = fileutil.openImage(_expname, mode='readonly', memmap=False)
-    _sciext = _handle[chip.header['extname'],chip.header['extver']]
+    # Get the SCI array through the (read-only) chip data cache
+    _scidata = chip_cache.get(fileutil.parseFilename(_expname)[0],
+                              chip.header['extname'], chip.header['extver'])
 
     # Apply sky subtraction and unit conversion to input array
     if chip.computedSky is None:
-        _insci = _sciext.data
+        _insci = _scidata.copy()
     else:
         log.info("Applying sky value of %0.6f to %s"%(chip.computedSky,_expname))
-        _insci = _sciext.data - chip.computedSky
+        _insci = _scidata - chip.computedSky
     # If input SCI image is still integer format (RAW files)
     # transform it to float32 for all subsequent operations
     # needed for numpy >=1.12.x
@@ -841,9 +833,6 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
     # and combine it with the static_mask for single_drizzle case...
     #
     ####
-    # Build basic DQMask from DQ array and bits value
-    dqarr = img.buildMask(chip._chip,bits=paramDict['bits'])
-
     # get correct mask filenames/objects
     staticMaskName = chip.outputNames['staticMask']
     crMaskName = chip.outputNames['crmaskImage']
@@ -854,20 +843,23 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
         if crMaskName in img.virtualOutputs:
             crMaskName = img.virtualOutputs[crMaskName]
 
-    # Merge appropriate additional mask(s) with DQ mask
+    # Build basic DQMask from DQ array and bits value merged with the
+    # appropriate additional mask(s). Combined masks are cached by the
+    # imageObject and shared with the other processing steps.
+    dqarr = img.getCombinedMask(chip._chip, bits=paramDict['bits'],
+                                staticmask=staticMaskName)
     if single:
-        mergeDQarray(staticMaskName,dqarr)
         if dqarr.sum() == 0:
             log.warning('All pixels masked out when applying static mask!')
     else:
-        mergeDQarray(staticMaskName,dqarr)
-
         if dqarr.sum() == 0:
             log.warning('All pixels masked out when applying static mask!')
         else:
             # Only apply cosmic-ray mask when some good pixels remain after
             # applying the static mask
-            mergeDQarray(crMaskName,dqarr)
+            dqarr = img.getCombinedMask(chip._chip, bits=paramDict['bits'],
+                                        staticmask=staticMaskName,
+                                        crmask=crMaskName)
 
             if dqarr.sum() == 0:
                 log.warning('WARNING: All pixels masked out when applying '
@@ -890,7 +882,9 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
     elif wht_type == 'EXP':
         _inwht = img.buildEXPmask(chip._chip,dqarr)
     else:  # wht_type == None, used for single drizzle images
-        _inwht = chip._exptime * dqarr.astype(np.float32)
+        _inwht = dqarr.astype(np.float32)
+        _inwht *= chip._exptime
+    del dqarr
 
     if not(paramDict['clean']):
         # Write out mask file if 'clean' has been turned off
@@ -40,9 +40,13 @@ from six import string_types
 from stsci.tools import teal, logutil, textutil
 
 from . import adrizzle
+from . import asyncwriter
+from . import chipstats
 from . import ablot
 from . import createMedian
 from . import drizCR
+from . import imageObject
+from . import outputimage
 from . import processInput
 from . import sky
 from . import staticMask
@@ -218,12 +222,19 @@ def run(configobj, wcsmap=None):
         #create the median images from the driz sep images
         createMedian.createMedian(imgObjList, configobj, procSteps=procSteps)
 
-        #blot the images back to the original reference frame
-        ablot.runBlot(imgObjList, outwcs, configobj, wcsmap=wcsmap,
-                      procSteps=procSteps)
+        if drizCR.useFusedBlot(configobj):
+            #blot the median image to each chip in memory and look for
+            #cosmic rays in a single pass
+            drizCR.rundrizCR(imgObjList, configobj, procSteps=procSteps,
+                             output_wcs=outwcs, wcsmap=wcsmap)
 
-        #look for cosmic rays
-        drizCR.rundrizCR(imgObjList, configobj, procSteps=procSteps)
+        else:
+            #blot the images back to the original reference frame
+            ablot.runBlot(imgObjList, outwcs, configobj, wcsmap=wcsmap,
+                          procSteps=procSteps)
+
+            #look for cosmic rays
+            drizCR.rundrizCR(imgObjList, configobj, procSteps=procSteps)
 
         #Make your final drizzled image
         adrizzle.drizFinal(imgObjList, outwcs, configobj, wcsmap=wcsmap,
@@ -243,6 +254,16 @@ def run(configobj, wcsmap=None):
 
     finally:
         procSteps.reportTimes()
+        # wait for output left behind by a step that did not complete
+        try:
+            asyncwriter.flush()
+        except IOError as e:
+            log.error(str(e))
+        outputimage.clearTemplateCache()
+        chipstats.chip_stats.clear()
+        log.info(str(imageObject.chip_cache))
+        imageObject.chip_cache.invalidate()
+        imageObject.chip_cache.reset_stats()
         if imgObjList:
             for image in imgObjList:
                 if clean:
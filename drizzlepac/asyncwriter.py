@@ -0,0 +1,223 @@
+"""
+Background writer for FITS products created by the drizzle, blot and
+cosmic-ray identification steps.
+
+Products handed to :py:func:`writeto` are queued and written to disk by a
+single writer thread while the calling step goes on computing the next
+product. The arrays in the queued ``HDUList`` are not copied: the caller
+transfers their ownership to the writer and must not modify them afterwards.
+The total size of the data waiting to be written is bounded; when the
+budget is exceeded, :py:func:`writeto` blocks until enough data has been
+written to disk.
+
+Each step must call :py:func:`flush` before it ends. This waits for all
+pending products to be written and re-raises the first error encountered
+by the writer thread. Each process uses its own writer, so that worker
+processes started with `multiprocessing` must flush their products before
+they exit (see :py:func:`run_and_flush`).
+
+:License: :doc:`LICENSE`
+
+"""
+from __future__ import (absolute_import, division, unicode_literals,
+                        print_function)
+
+import os
+import threading
+from collections import deque
+
+from stsci.tools import logutil
+
+from .version import *
+
+__all__ = ['FITSWriter', 'writeto', 'flush', 'set_budget', 'run_and_flush']
+
+WRITE_BUFFER_MB = 512  # default maximum size of data waiting to be written
+
+log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
+
+
+def _hdulist_nbytes(hdulist):
+    """ Return size of the data arrays held by an HDUList. """
+    nbytes = 0
+    for hdu in hdulist:
+        data = hdu.__dict__.get('data')
+        if data is not None:
+            nbytes += getattr(data, 'nbytes', 0)
+    return nbytes
+
+
+def _write(hdulist, filename):
+    try:
+        hdulist.writeto(filename)
+    finally:
+        hdulist.close()
+
+
+class FITSWriter(object):
+    """ Write-behind queue of FITS products serviced by a writer thread.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum size (in bytes) of the data waiting to be written. A product
+        larger than the budget is accepted only when the queue is empty.
+        When zero or negative, products are written synchronously.
+
+    """
+    def __init__(self, max_bytes=WRITE_BUFFER_MB * 1024**2):
+        self.max_bytes = int(max_bytes)
+        self._queue = deque()
+        self._pending = 0
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='drizzlepac.asyncwriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                hdulist, filename, nbytes = self._queue[0]
+
+            error = None
+            try:
+                _write(hdulist, filename)
+            except Exception as e:
+                error = e
+            del hdulist
+
+            with self._cond:
+                self._queue.popleft()
+                self._pending -= nbytes
+                if error is not None:
+                    log.error("Error writing '{}': {}".format(filename, error))
+                    if self._error is None:
+                        self._error = (filename, error)
+                self._cond.notify_all()
+
+    def _raise_error(self):
+        # must be called with the lock held
+        if self._error is not None:
+            filename, error = self._error
+            self._error = None
+            raise IOError("Error writing '{}': {}".format(filename, error))
+
+    def writeto(self, hdulist, filename):
+        """ Queue an ``HDUList`` to be written to ``filename``.
+
+        The ``HDUList`` (and the arrays it holds) must not be modified by the
+        caller after this call. It is closed once it has been written.
+        Errors from previously queued products are raised here.
+
+        """
+        if self.max_bytes <= 0:
+            with self._cond:
+                self._raise_error()
+            _write(hdulist, filename)
+            return
+
+        nbytes = _hdulist_nbytes(hdulist)
+        with self._cond:
+            self._raise_error()
+            # backpressure: wait until the product fits within the budget
+            while (self._pending > 0 and
+                   self._pending + nbytes > self.max_bytes):
+                self._cond.wait()
+            self._raise_error()
+            self._queue.append((hdulist, filename, nbytes))
+            self._pending += nbytes
+            self._start()
+            self._cond.notify_all()
+
+    def flush(self):
+        """ Wait for all queued products to be written to disk.
+
+        Raises
+        ------
+        IOError
+            If the writer thread failed to write any of the queued products.
+
+        """
+        with self._cond:
+            while self._queue:
+                self._cond.wait()
+            self._raise_error()
+
+    @property
+    def pending(self):
+        """ Size (in bytes) of the data waiting to be written. """
+        with self._cond:
+            return self._pending
+
+
+_writer = None
+_writer_pid = None
+_budget = WRITE_BUFFER_MB * 1024**2
+
+
+def _get_writer():
+    """ Return the writer of the current process.
+
+    Writer threads do not survive a ``fork()``, so processes started by
+    `multiprocessing` get a new (empty) writer.
+
+    """
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        _writer = FITSWriter(_budget)
+        _writer_pid = os.getpid()
+    return _writer
+
+
+def set_budget(max_mb):
+    """ Set maximum size (in MB) of the data waiting to be written.
+
+    Use 0 to write products synchronously. `None` restores the default
+    value of ``WRITE_BUFFER_MB``.
+
+    """
+    global _budget
+    if max_mb is None:
+        max_mb = WRITE_BUFFER_MB
+    _budget = int(max_mb * 1024**2)
+    writer = _get_writer()
+    writer.flush()
+    writer.max_bytes = _budget
+
+
+def writeto(hdulist, filename):
+    """ Queue an ``HDUList`` to be written to disk by the current process'
+    writer. See :py:meth:`FITSWriter.writeto`.
+
+    """
+    _get_writer().writeto(hdulist, filename)
+
+
+def flush():
+    """ Wait for all products queued by the current process to be written.
+    See :py:meth:`FITSWriter.flush`.
+
+    """
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.flush()
+
+
+def run_and_flush(func, *args):
+    """ Call ``func(*args)`` and flush products queued during the call.
+
+    Used as the target of worker processes, which must write their
+    products to disk before they exit.
+
+    """
+    try:
+        return func(*args)
+    finally:
+        flush()
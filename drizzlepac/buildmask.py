@@ -8,6 +8,10 @@ Functions to build mask files for PyDrizzle.
         This function builds a weighting image for use with drizzle from
         the WFPC2 shadow mask functions derived from 'wmosaic'.
 
+    - PackedMask(mask):
+        Boolean mask stored with 8 pixels per byte, used to keep
+        static, DQ and CR masks in memory between processing steps.
+
 :License: :doc:`LICENSE`
 
 """
@@ -35,6 +39,7 @@ Functions to build mask files for PyDrizzle.
 from __future__ import absolute_import, division, print_function # confidence high
 
 import os
+import itertools
 
 from stsci.tools import fileutil, readgeis
 try:
@@ -46,8 +51,13 @@ from astropy.io import fits
 import numpy as np
 
 from . import processInput,util
+from . import rawfile
 
 __taskname__ = 'drizzlepac.buildmask'
+
+# versions of in-memory (virtual) masks:
+_mask_versions = itertools.count(1)
+
 #
 #### Interactive interface
 #
@@ -89,6 +99,97 @@ def buildMask(dqarr, bitvalue):
                                     dtype=np.uint8)
 
 
+class PackedMask(object):
+    """ Boolean mask stored with 8 pixels per byte.
+
+    Used to keep static, DQ and cosmic-ray masks in memory between
+    processing steps. Like an in-memory (virtual) FITS HDU, the mask
+    array (1 for good pixels, 0 for bad ones) is available through the
+    ``data`` attribute; it gets unpacked each time it is accessed.
+    ``mask_version`` is a number that identifies the mask among all masks
+    created during a session (see `maskVersion`).
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        Mask array. Non-zero values are considered "good".
+
+    """
+    def __init__(self, mask):
+        mask = np.asarray(mask)
+        self.shape = mask.shape
+        self.size = mask.size
+        self._bits = np.packbits(mask != 0, axis=None)
+        self.mask_version = next(_mask_versions)
+
+    @property
+    def nbytes(self):
+        return self._bits.nbytes
+
+    @property
+    def data(self):
+        return self.unpack(dtype=np.uint8)
+
+    def unpack(self, dtype=np.bool_):
+        """ Return a new array with the mask values. """
+        mask = np.unpackbits(self._bits, count=self.size).reshape(self.shape)
+        return mask.astype(dtype, copy=False)
+
+    def sum(self):
+        """ Return the number of good pixels. """
+        return int(np.unpackbits(self._bits, count=self.size).sum(dtype=np.intp))
+
+
+def mergeDQarray(maskname,dqarr):
+    """ Merge static or CR mask with mask created from DQ array on-the-fly here.
+    """
+    maskarr = None
+    if maskname is not None:
+        if isinstance(maskname, str):
+            # working with file on disk (default case)
+            if rawfile.exists(maskname):
+                maskarr = rawfile.getdata(maskname).astype(np.bool_)
+            elif os.path.exists(maskname):
+                mask = fileutil.openImage(maskname, memmap=False)
+                maskarr = mask[0].data.astype(np.bool_)
+                mask.close()
+        elif isinstance(maskname, PackedMask):
+            maskarr = maskname.unpack()
+        elif isinstance(maskname, fits.HDUList):
+            # working with a virtual input file
+            maskarr = maskname[0].data.astype(np.bool_)
+        else:
+            maskarr = maskname.data.astype(np.bool_)
+
+        if maskarr is not None:
+            # merge array with dqarr now
+            np.bitwise_and(dqarr,maskarr,dqarr)
+
+
+def maskVersion(maskname):
+    """ Return a value identifying the current version of a static or CR
+    mask given either as a file name or as an in-memory (virtual) FITS
+    object, or `None` when there is no such mask.
+    """
+    if maskname is None:
+        return None
+    if isinstance(maskname, str):
+        if rawfile.exists(maskname):
+            maskname = rawfile.rawName(maskname)
+        try:
+            st = os.stat(maskname)
+        except OSError:
+            return None
+        return (os.path.abspath(maskname), st.st_mtime, st.st_size)
+    # virtual masks get replaced (not updated) when re-computed and each
+    # new mask object gets a new version number:
+    version = getattr(maskname, 'mask_version', None)
+    if version is None:
+        version = next(_mask_versions)
+        maskname.mask_version = version
+    return version
+
+
 def buildMaskImage(rootname, bitvalue, output, extname='DQ', extver=1):
     """ Builds mask image from rootname's DQ array
         If there is no valid 'DQ' array in image, then return
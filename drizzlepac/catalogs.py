@@ -25,7 +25,7 @@ import stsci.imagestats as imagestats
 import stregion as pyregion
 
 #import idlphot
-from . import tweakutils, util
+from . import catcache, tweakutils, util
 from .mapreg import _AuxSTWCS
 
 ASTROPY_VER_GE13 = LooseVersion(astropy.__version__) >= LooseVersion('1.3')
@@ -38,10 +38,38 @@ REFCAT_ARGS = ['rmaxflux','rminflux','rfluxunits','refnbright']+REFCOL_PARS
 
 sortKeys = ['minflux','maxflux','nbright','fluxunits']
 
+# parameters that affect the sources found in an image:
+SRCFIND_PARS = ['computesig', 'skysigma', 'conv_width', 'peakmin', 'peakmax',
+                'threshold', 'nsigma', 'ratio', 'theta', 'fluxmin', 'fluxmax',
+                'sharplo', 'sharphi', 'roundlo', 'roundhi']
+
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 
+def _outside_regions(ra, dec, reg_ra, reg_dec, reg_dist):
+    """ Return a boolean mask of the sky positions ``ra``, ``dec`` (in
+        degrees) that are farther than ``reg_dist`` (in arcsec) from the
+        centers ``reg_ra``, ``reg_dec`` (in degrees) of all circular regions.
+    """
+    def unit_vectors(ra, dec):
+        ra = np.deg2rad(np.asarray(ra, dtype=np.float64))
+        dec = np.deg2rad(np.asarray(dec, dtype=np.float64))
+        cdec = np.cos(dec)
+        return np.column_stack([cdec * np.cos(ra), cdec * np.sin(ra),
+                                np.sin(dec)])
+
+    src = unit_vectors(ra, dec)
+    keep = np.ones(src.shape[0], dtype=np.bool_)
+    for center, dist in zip(unit_vectors(reg_ra, reg_dec), reg_dist):
+        # angular separation from the chord length (accurate also for
+        # small separations):
+        chord = np.sqrt(np.sum((src - center)**2, axis=1))
+        sep = 7200.0 * np.rad2deg(np.arcsin(np.minimum(0.5 * chord, 1.0)))
+        keep &= ~(sep <= dist)
+    return keep
+
+
 def generateCatalog(wcs, mode='automatic', catalog=None,
                     src_find_filters=None, **kwargs):
     """ Function which determines what type of catalog object needs to be
@@ -74,6 +102,56 @@ def generateCatalog(wcs, mode='automatic', catalog=None,
     return catalog
 
 
+def findImageSources(catalog_list, masks=None, tile_size=None,
+                     num_cores=None, cache=None):
+    """ Find sources in the images of several `ImageCatalog` instances.
+
+        Sources in all images (and in all tiles of the images) are found
+        with a single pool of processes. The sources are then used by the
+        `ImageCatalog.generateXY` method of each catalog. Sources of images
+        found in the ``cache`` are loaded from it instead.
+
+        Parameters
+        ----------
+        catalog_list : list of ImageCatalog
+            Catalogs of the images in which sources are to be found.
+        masks : list, None
+            DQ masks (or `None`) for each image.
+        tile_size : int, None
+            Size of the tiles into which images are split for source finding.
+            When `None`, each image is processed at once.
+        num_cores : int, None
+            Maximum number of processes used to find sources.
+        cache : `~drizzlepac.catcache.CatalogCache`, None
+            Cache of source catalogs.
+    """
+    if masks is None:
+        masks = len(catalog_list) * [None]
+
+    keys = len(catalog_list) * [None]
+    missing = []
+    for i, (cat, mask) in enumerate(zip(catalog_list, masks)):
+        if cache is not None:
+            keys[i] = cat._cache_key(mask)
+            sources = None if keys[i] is None else cache.get(keys[i])
+            if sources is not None:
+                print("  #  Sources for '{}', EXT={} loaded from catalog "
+                      "cache".format(cat.fnamenoext, cat.wcs.extname))
+                cat._sources = (None, sources)
+                continue
+        missing.append(i)
+
+    pars_list = [catalog_list[i]._ndfind_pars(masks[i]) for i in missing]
+    sources = tweakutils.ndfind_many(pars_list, tile_size=tile_size,
+                                     num_cores=num_cores)
+    for i, pars, src in zip(missing, pars_list, sources):
+        catalog_list[i]._sources = (pars, src)
+        # catalogs with no sources are not cached, so that automatic
+        # settings are tried again by 'generateXY':
+        if keys[i] is not None and len(src[0]) > 0:
+            cache.put(keys[i], src)
+
+
 class Catalog(object):
     """ Base class for keeping track of a source catalog for an input WCS
 
@@ -197,47 +275,57 @@ class Catalog(object):
     def apply_exclusions(self,exclusions):
         """ Trim sky catalog to remove any sources within regions specified by
             exclusions file
+
+            Returns a boolean mask of the sources that have been kept
+            (or `None` when the exclusions file could not be read).
         """
         # parse exclusion file into list of positions and distances
         exclusion_coords = tweakutils.parse_exclusions(exclusions)
         if exclusion_coords is None:
-            return
-
-        excluded_list = []
-        radec_indx = list(range(len(self.radec[0])))
-        for ra,dec,indx in zip(self.radec[0],self.radec[1],radec_indx):
-            src_pos = coords.SkyCoord(ra=ra,dec=dec,unit=(u.hourangle,u.deg))
-
-            # check to see whether this source is within an exclusion region
-            for reg in exclusion_coords:
-                if reg['units'] == 'sky':
-                    regpos = reg['pos']
-                    regdist = reg['distance'] # units: arcsec
+            return None
+
+        # convert all regions to sky positions (in degrees) and radii
+        # (in arcsec) at once:
+        nreg = len(exclusion_coords)
+        reg_ra = np.empty(nreg, dtype=np.float64)
+        reg_dec = np.empty(nreg, dtype=np.float64)
+        reg_dist = np.empty(nreg, dtype=np.float64)
+        pix_regions = []
+        for k, reg in enumerate(exclusion_coords):
+            if reg['units'] == 'sky':
+                if isinstance(reg['pos'], str):
+                    # sexagesimal position:
+                    regpos = coords.SkyCoord(reg['pos'],
+                                             unit=(u.hourangle, u.deg))
+                    reg_ra[k] = regpos.ra.degree
+                    reg_dec[k] = regpos.dec.degree
                 else:
-                    regradec = self.wcs.all_pix2world([reg['pos']],1)[0]
-                    regpos = (regradec[0],regradec[1])
-                    regdist = reg['distance']*self.wcs.pscale # units: arcsec
+                    reg_ra[k], reg_dec[k] = reg['pos']
+                reg_dist[k] = reg['distance'] # units: arcsec
+            else:
+                pix_regions.append(k)
+                reg_dist[k] = reg['distance']*self.wcs.pscale # units: arcsec
+        if pix_regions:
+            regradec = self.wcs.all_pix2world(
+                [exclusion_coords[k]['pos'] for k in pix_regions], 1
+            )
+            reg_ra[pix_regions] = regradec[:,0]
+            reg_dec[pix_regions] = regradec[:,1]
 
-                epos = coords.SkyCoord(ra=regpos[0],dec=regpos[1],unit=(u.hourangle,u.deg))
-                if float(epos.separation(src_pos).to_string(unit=u.arcsec,decimal=True)) <= regdist:
-                    excluded_list.append(indx)
-                    break
-        # create a list of all 'good' sources outside all exclusion regions
-        for e in excluded_list: radec_indx.remove(e)
-        radec_indx = np.array(radec_indx,dtype=int)
-        num_excluded = len(excluded_list)
+        keep = _outside_regions(self.radec[0], self.radec[1],
+                                reg_ra, reg_dec, reg_dist)
+
+        # keep all 'good' sources outside all exclusion regions
+        num_excluded = keep.size - np.count_nonzero(keep)
         if num_excluded > 0:
-            radec_trimmed = []
-            xypos_trimmed = []
-            for arr in self.radec:
-                radec_trimmed.append(arr[radec_indx])
-            for arr in self.xypos:
-                xypos_trimmed.append(arr[radec_indx])
+            self.radec = [np.asarray(arr)[keep] for arr in self.radec]
+            xypos_trimmed = [np.asarray(arr)[keep] for arr in self.xypos]
             xypos_trimmed[-1] = np.arange(len(xypos_trimmed[0]))
-            self.radec = radec_trimmed
             self.xypos = xypos_trimmed
             log.info('Excluded %d sources from catalog.'%num_excluded)
 
+        return keep
+
     def apply_flux_limits(self):
         """ Apply any user-specified limits on source selection
             Limits based on fluxes
@@ -443,6 +531,7 @@ class ImageCatalog(Catalog):
             self.wcs.extname = (0)
         self.source = fits.getdata(self.wcs.filename,ext=self.wcs.extname, memmap=False)
         self.nbright = None # No GUI parameter defined yet for this filtering
+        self._sources = None # sources found by 'findImageSources'
 
     def _combine_exclude_mask(self, mask):
         # create masks from exclude/include regions and combine it with the
@@ -538,11 +627,23 @@ class ImageCatalog(Catalog):
 
         return mask
 
-    def generateXY(self, **kwargs):
-        """ Generate source catalog from input image using DAOFIND-style algorithm
+    def _cache_key(self, mask=None):
+        """ Return key of the sources of this image in a
+            `~drizzlepac.catcache.CatalogCache`.
+        """
+        pars = dict((k, self.pars.get(k)) for k in SRCFIND_PARS)
+        pars['use_sharp_round'] = self.use_sharp_round
+        pars['nbright'] = self.nbright
+        region_file = None
+        if self.src_find_filters is not None:
+            region_file = self.src_find_filters.get('region_file')
+        return catcache.catalogKey(self.source, mask, pars,
+                                   region_file=region_file, wcs=self.wcs)
+
+    def _ndfind_pars(self, mask=None):
+        """ Return arguments of `~drizzlepac.tweakutils.ndfind` used to find
+            sources in this image.
         """
-        #x,y,flux,sharp,round = idlphot.find(array,self.pars['hmin'],self.pars['fwhm'],
-        #                    roundlim=self.pars['roundlim'], sharplim=self.pars['sharplim'])
         print("  #  Source finding for '{}', EXT={} started at: {}"
               .format(self.fnamenoext, self.wcs.extname, util._ptime()[0]))
         if self.pars['computesig']:
@@ -557,19 +658,19 @@ class ImageCatalog(Catalog):
         else:
             hmin = sigma*self.pars['threshold']
 
-        if 'mask' in kwargs and kwargs['mask'] is not None:
-            dqmask = np.asarray(kwargs['mask'], dtype=bool)
+        if mask is not None:
+            dqmask = np.asarray(mask, dtype=bool)
         else:
             dqmask = None
 
         # get the mask for source finding:
         mask = self._combine_exclude_mask(dqmask)
 
-        x, y, flux, src_id, sharp, round1, round2 = tweakutils.ndfind(
-            self.source,
-            hmin,
-            self.pars['conv_width'],
-            skymode,
+        return dict(
+            array=self.source,
+            hmin=hmin,
+            fwhm=self.pars['conv_width'],
+            skymode=skymode,
             sharplim=[self.pars['sharplo'],self.pars['sharphi']],
             roundlim=[self.pars['roundlo'],self.pars['roundhi']],
             peakmin=self.pars['peakmin'],
@@ -584,28 +685,29 @@ class ImageCatalog(Catalog):
             nbright=self.nbright
         )
 
+    def generateXY(self, **kwargs):
+        """ Generate source catalog from input image using DAOFIND-style algorithm
+        """
+        #x,y,flux,sharp,round = idlphot.find(array,self.pars['hmin'],self.pars['fwhm'],
+        #                    roundlim=self.pars['roundlim'], sharplim=self.pars['sharplim'])
+        if self._sources is None:
+            findImageSources([self], [kwargs.get('mask')],
+                             tile_size=self.pars.get('tile_size'),
+                             num_cores=self.pars.get('num_cores'))
+        pars, sources = self._sources
+        self._sources = None
+        x, y, flux, src_id, sharp, round1, round2 = sources
+
         if len(x) == 0:
             if  not self.pars['computesig']:
                 sigma = self._compute_sigma()
-                hmin = sigma * self.pars['threshold']
+                pars['hmin'] = sigma * self.pars['threshold']
                 log.info('No sources found with original thresholds. Trying automatic settings.')
+                pars['nbright'] = self.limits.get('nbright')
                 x, y, flux, src_id, sharp, round1, round2 = tweakutils.ndfind(
-                    self.source,
-                    hmin,
-                    self.pars['conv_width'],
-                    skymode,
-                    sharplim=[self.pars['sharplo'],self.pars['sharphi']],
-                    roundlim=[self.pars['roundlo'],self.pars['roundhi']],
-                    peakmin=self.pars['peakmin'],
-                    peakmax=self.pars['peakmax'],
-                    fluxmin=self.pars['fluxmin'],
-                    fluxmax=self.pars['fluxmax'],
-                    nsigma=self.pars['nsigma'],
-                    ratio=self.pars['ratio'],
-                    theta=self.pars['theta'],
-                    mask = mask,
-                    use_sharp_round = self.use_sharp_round,
-                    nbright=self.limits.get('nbright')
+                    tile_size=self.pars.get('tile_size'),
+                    num_cores=self.pars.get('num_cores'),
+                    **pars
                 )
         if len(x) == 0:
             xypostypes = 3*[float]+[int]+(3 if self.use_sharp_round else 0)*[float]
@@ -684,8 +786,7 @@ class UserCatalog(Catalog):
         #colnums = [self.pars['xcol']-1,self.pars['ycol']-1,self.pars['fluxcol']-1]
 
         # read the catalog now, one for each chip/mosaic
-        # Currently, this only supports ASCII catalog files
-        # Support for FITS tables needs to be added
+        # (ASCII catalog files, FITS tables and '.npy' files are supported)
         catcols = tweakutils.readcols(self.source, cols=self.colnames)
         if not util.is_blank(catcols) and len(catcols[0]) == 0:
             catcols = None
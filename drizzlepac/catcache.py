@@ -0,0 +1,202 @@
+"""
+On-disk cache of the source catalogs found by `tweakreg` in input images.
+
+Finding sources is usually the most expensive part of a `tweakreg` run and
+it does not need to be repeated when only matching or fitting parameters
+change. Sources found in each chip are saved in a cache directory, one
+``.npz`` file per chip, keyed by a checksum of the chip's science data,
+the mask derived from its DQ array, the source finding parameters and the
+exclusion regions. Later runs load the sources of unchanged chips from
+the cache instead of finding them again.
+
+The total size of the cache is bounded: when it is exceeded, least
+recently used catalogs are removed.
+
+:License: :doc:`LICENSE`
+
+"""
+from __future__ import (absolute_import, division, unicode_literals,
+                        print_function)
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from stsci.tools import logutil
+
+from .version import *
+
+__all__ = ['CatalogCache', 'catalogKey']
+
+CACHE_VERSION = 1
+CACHE_MB = 256  # default maximum size of the cache
+
+# names of the columns of the source lists returned by 'tweakutils.ndfind':
+COLUMNS = ['x', 'y', 'flux', 'src_id', 'sharp', 'round1', 'round2']
+
+log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
+
+
+def _update_array(h, arr):
+    arr = np.ascontiguousarray(arr)
+    h.update('{}{}'.format(arr.dtype.str, arr.shape).encode('ascii'))
+    h.update(memoryview(arr.view(np.uint8).ravel()))
+
+
+def catalogKey(data, mask=None, pars=None, region_file=None, wcs=None):
+    """ Compute the key of the catalog of a chip.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Science data of the chip.
+
+    mask : numpy.ndarray, None
+        Mask of the pixels used to find sources (derived from the DQ array).
+
+    pars : dict, None
+        Source finding parameters. Values must be JSON serializable.
+
+    region_file : str, None
+        Name of a region file or of a FITS mask file defining the regions
+        of the chip in which sources are (not) searched for.
+
+    wcs : astropy.wcs.WCS, None
+        WCS of the chip. Used only along with a region file (regions may
+        be defined in sky coordinates).
+
+    Returns
+    -------
+    key : str, None
+        Hexadecimal checksum or `None` when the region file does not exist.
+
+    """
+    h = hashlib.sha1()
+    h.update('drizzlepac.catcache {:d}'.format(CACHE_VERSION).encode('ascii'))
+    _update_array(h, data)
+
+    if mask is None:
+        h.update(b'nomask')
+    else:
+        _update_array(h, np.packbits(np.asarray(mask, dtype=np.bool_)))
+
+    h.update(json.dumps(pars, sort_keys=True, default=str).encode('utf-8'))
+
+    if region_file is not None:
+        if not os.path.isfile(region_file):
+            return None
+        with open(region_file, 'rb') as f:
+            h.update(f.read())
+        if wcs is not None:
+            h.update(wcs.to_header_string().encode('ascii'))
+
+    return h.hexdigest()
+
+
+class CatalogCache(object):
+    """ Directory of source catalogs keyed by `catalogKey`.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory. It is created if it does not exist.
+
+    max_mb : float
+        Maximum size (in MB) of all catalogs in the cache.
+
+    """
+    def __init__(self, path, max_mb=CACHE_MB):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = int(max_mb * 1024**2)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _entries(self):
+        entries = []
+        for fname in os.listdir(self.path):
+            if not fname.endswith('.npz'):
+                continue
+            fname = os.path.join(self.path, fname)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        return entries
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def nbytes(self):
+        """ Total size (in bytes) of the catalogs in the cache. """
+        return sum(e[1] for e in self._entries())
+
+    def get(self, key):
+        """ Return sources saved with ``key`` or `None` if they are not in
+        the cache.
+
+        Sources are returned in the format of `~drizzlepac.tweakutils.ndfind`.
+
+        """
+        fname = self._file(key)
+        try:
+            with np.load(fname, allow_pickle=False) as cat:
+                sources = tuple(cat[c] if c in cat.files else None
+                                for c in COLUMNS)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        # mark the catalog as recently used:
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return sources
+
+    def put(self, key, sources):
+        """ Save sources (as returned by `~drizzlepac.tweakutils.ndfind`)
+        with ``key`` and evict least recently used catalogs if the cache
+        size is exceeded.
+
+        """
+        arrays = dict((c, np.asarray(v)) for c, v in zip(COLUMNS, sources)
+                      if v is not None)
+        fname = self._file(key)
+        tmpname = '{}.{:d}.tmp.npz'.format(fname[:-4], os.getpid())
+        try:
+            np.savez(tmpname, **arrays)
+            os.rename(tmpname, fname)
+        except (IOError, OSError) as e:
+            log.warning("Unable to save catalog to cache '{}': {}"
+                        .format(self.path, e))
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+            log.info("Removed catalog '{}' from cache".format(fname))
+
+    def clear(self):
+        """ Remove all catalogs from the cache. """
+        for mtime, size, fname in self._entries():
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
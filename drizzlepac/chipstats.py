@@ -0,0 +1,267 @@
+"""
+Statistics of input chip data shared by the processing steps.
+
+The static mask step computes iteratively clipped statistics of the
+science data of every input chip. This module computes them (with
+`~stsci.imagestats.ImageStats`) only once for each chip and set of
+clipping parameters and serves them through the pipeline-wide `chip_stats`
+instance. Only the requested statistics are computed: the number of
+pixels, minimum, maximum, mean and standard deviation are always computed,
+while the mode and the median, which require a histogram or a sort of the
+clipped data, are computed only when requested and are added to the
+statistics already cached for the chip.
+
+Statistics of many chips can be computed in parallel with
+:py:meth:`ChipStatistics.compute`. Chip data are read through the
+`~drizzlepac.imageObject.chip_cache`, so that data from FITS files that do
+not need scaling are memory-mapped.
+
+:License: :doc:`LICENSE`
+
+"""
+from __future__ import (absolute_import, division, unicode_literals,
+                        print_function)
+
+import os
+import threading
+
+from stsci.imagestats import ImageStats
+from stsci.tools import logutil
+
+from . import util
+from .imageObject import chip_cache
+from .version import *
+
+if util.can_parallel:
+    import multiprocessing
+
+__all__ = ['ChipStats', 'ChipStatistics', 'chip_stats']
+
+# statistics computed along with the clipping of the data:
+BASE_FIELDS = ('npix', 'min', 'max', 'mean', 'stddev')
+
+# statistics computed only when requested:
+EXTRA_FIELDS = ('mode', 'midpt', 'median')
+
+# default clipping parameters of ImageStats:
+STAT_PARS = {'lower': None, 'upper': None, 'nclip': 0, 'lsig': 3.0,
+             'usig': 3.0, 'binwidth': 0.1}
+
+log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
+
+
+class ChipStats(object):
+    """ Statistics of the science data of a chip.
+
+    Attributes ``npix``, ``min``, ``max``, ``mean``, ``stddev`` and, when
+    requested, ``mode``, ``midpt`` and ``median`` have the same meaning as in
+    `~stsci.imagestats.ImageStats`. ``nbins`` is the number of bins of the
+    histogram used to compute the mode (`None` when no histogram was
+    computed). ``fields`` is the set of computed `EXTRA_FIELDS`.
+
+    """
+    def __init__(self, imstats, fields):
+        self.fields = frozenset(fields)
+        for field in BASE_FIELDS + tuple(sorted(self.fields)):
+            setattr(self, field, getattr(imstats, field))
+        hist = getattr(imstats, 'histogram', None)
+        self.nbins = None if hist is None else len(hist)
+
+    def merge(self, other):
+        """ Add the statistics of ``other`` (computed from the same data and
+        with the same clipping parameters) that are missing in ``self``.
+        """
+        for field in other.fields - self.fields:
+            setattr(self, field, getattr(other, field))
+        if self.nbins is None:
+            self.nbins = other.nbins
+        self.fields = self.fields | other.fields
+
+
+def _statsFields(fields):
+    fields = set(f.strip().lower() for f in fields.split(',') if f.strip())
+    unknown = fields.difference(BASE_FIELDS + EXTRA_FIELDS)
+    if unknown:
+        raise ValueError("Unexpected statistics field(s): {}"
+                         .format(', '.join(sorted(unknown))))
+    return frozenset(fields.intersection(EXTRA_FIELDS))
+
+
+def _imageStats(data, fields, pars):
+    return ChipStats(
+        ImageStats(data, fields=','.join(BASE_FIELDS + tuple(sorted(fields))),
+                   **pars),
+        fields
+    )
+
+
+def _statsPars(pars):
+    unknown = set(pars) - set(STAT_PARS)
+    if unknown:
+        raise TypeError("Unexpected statistics parameter(s): {}"
+                        .format(', '.join(sorted(unknown))))
+    allpars = STAT_PARS.copy()
+    allpars.update(pars)
+    return allpars
+
+
+def _computeChipStats(args):
+    """ Compute statistics of a chip read from a file. Errors are returned
+    (not raised) so that they are reported only if the statistics are used.
+    """
+    filename, extname, extver, fields, pars = args
+    try:
+        data = chip_cache.get(filename, extname, extver)
+        return _imageStats(data, fields, pars)
+    except ValueError as e:
+        return e
+
+
+class ChipStatistics(object):
+    """ Cache of statistics of the science data of input chips.
+
+    Statistics are keyed by file name, extension, file modification time and
+    size, and by the clipping parameters, so that they are recomputed when an
+    input file changes. Statistics cached for a key are served to all
+    requests for a subset of their fields; missing fields are computed and
+    added to them. Chips whose data have been attached to the
+    ``imageObject`` in memory are not cached.
+
+    """
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, image, extver, pars):
+        extname = image.scienceExt
+        if image[extname, extver].__dict__.get('data') is not None:
+            return None
+        try:
+            st = os.stat(image._filename)
+        except (OSError, TypeError):
+            return None
+        return (os.path.abspath(image._filename), extname.upper(),
+                int(extver), st.st_mtime, st.st_size,
+                tuple(sorted(pars.items())))
+
+    def _lookup(self, key, fields):
+        """ Return cached statistics if they include all ``fields``. """
+        with self._lock:
+            stats = self._cache.get(key)
+        if isinstance(stats, ChipStats) and not fields <= stats.fields:
+            return None
+        return stats
+
+    def _store(self, key, stats):
+        with self._lock:
+            old = self._cache.get(key)
+            if isinstance(stats, ChipStats) and isinstance(old, ChipStats):
+                stats.merge(old)
+            self._cache[key] = stats
+
+    def get(self, image, extver, fields='npix,min,max,mean,stddev', **pars):
+        """ Return the statistics of the science data of a chip.
+
+        Parameters
+        ----------
+        image : imageObject
+            Input image.
+
+        extver : int
+            ``EXTVER`` of the science extension of the chip.
+
+        fields : str
+            Comma-separated list of the required statistics (see
+            `~stsci.imagestats.ImageStats`).
+
+        pars : dict
+            ``lower``, ``upper``, ``nclip``, ``lsig``, ``usig`` and
+            ``binwidth`` parameters of `~stsci.imagestats.ImageStats`.
+
+        Returns
+        -------
+        stats : ChipStats
+
+        """
+        fields = _statsFields(fields)
+        pars = _statsPars(pars)
+        key = self._key(image, extver, pars)
+        stats = None if key is None else self._lookup(key, fields)
+
+        if stats is None:
+            data = image.getData('{:s},{:d}'.format(image.scienceExt,
+                                                    int(extver)))
+            try:
+                stats = _imageStats(data, fields, pars)
+            except ValueError as e:
+                stats = e
+            del data
+            if key is not None:
+                self._store(key, stats)
+
+        if isinstance(stats, Exception):
+            raise stats
+        return stats
+
+    def compute(self, chips, fields='npix,min,max,mean,stddev',
+                num_cores=None, **pars):
+        """ Compute statistics of several chips, in parallel when possible.
+
+        Parameters
+        ----------
+        chips : list of tuple
+            List of ``(imageObject, extver)`` tuples.
+
+        fields : str
+            Comma-separated list of the required statistics (see
+            :py:meth:`get`).
+
+        num_cores : int, None
+            Maximum number of processes used to compute the statistics.
+
+        pars : dict
+            Clipping parameters (see :py:meth:`get`).
+
+        """
+        fields = _statsFields(fields)
+        pars = _statsPars(pars)
+        tasks = []
+        keys = set()
+        for image, extver in chips:
+            key = self._key(image, extver, pars)
+            if (key is None or key in keys or
+                    self._lookup(key, fields) is not None):
+                continue
+            keys.add(key)
+            tasks.append((key, (image._filename, image.scienceExt,
+                                int(extver), fields, pars)))
+        if not tasks:
+            return
+
+        pool_size = util.get_pool_size(num_cores, len(tasks))
+        if pool_size > 1:
+            log.info('Computing statistics of %d chips with %d parallel '
+                     'workers' % (len(tasks), pool_size))
+            pool = multiprocessing.Pool(pool_size)
+            try:
+                results = pool.map(_computeChipStats, [t[1] for t in tasks])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_computeChipStats(t[1]) for t in tasks]
+
+        for (key, args), stats in zip(tasks, results):
+            self._store(key, stats)
+
+    def clear(self):
+        """ Release all cached statistics. """
+        with self._lock:
+            self._cache.clear()
+
+
+# statistics shared by all processing steps:
+chip_stats = ChipStatistics()
@@ -14,6 +14,7 @@ from __future__ import (absolute_import, division, unicode_literals,
 import os
 import sys
 import math
+import hashlib
 import numpy as np
 from astropy.io import fits
 
@@ -25,6 +26,8 @@ from . import imageObject
 from . import util
 from .minmed import min_med
 from . import processInput
+from . import rawfile
+from .stackstore import StackStore
 from .adrizzle import _single_step_num_
 
 from .version import *
@@ -101,16 +104,17 @@ def createMedian(imgObjList, configObj, procSteps=None):
     log.info('USER INPUT PARAMETERS for Create Median Step:')
     util.printParams(paramDict, log=log)
 
-    _median(imgObjList, paramDict)
+    _median(imgObjList, paramDict, drizpars=driz_sep_paramDict)
 
     if procSteps is not None:
         procSteps.endStep('Create Median')
 
 
 # this is the internal function, the user called function is below
-def _median(imageObjectList, paramDict):
+def _median(imageObjectList, paramDict, drizpars=None):
     """Create a median image from the list of image Objects
-       that has been given.
+       that has been given. ``drizpars`` are the parameters of the single
+       drizzle step used to identify exposures in the stack store.
     """
     newmasks = paramDict['median_newmasks']
     comb_type = paramDict['combine_type'].lower()
@@ -121,6 +125,9 @@ def _median(imageObjectList, paramDict):
     proc_units = paramDict['proc_unit']
     compress = paramDict['compress']
     bufsizeMB = paramDict['combine_bufsize']
+    stackstore = paramDict['combine_stackstore']
+    stackpars = dict({} if drizpars is None else drizpars,
+                     proc_unit=proc_units)
 
     sigma = paramDict["combine_nsigma"]
     sigmaSplit = sigma.split()
@@ -146,6 +153,7 @@ def _median(imageObjectList, paramDict):
     # Start by removing any previous products...
     if os.access(medianfile, os.F_OK):
         os.remove(medianfile)
+    rawfile.remove(medianfile)
 
     # Define lists for instrument specific parameters, these should be in
     # the image objects need to be passed to the minmed routine
@@ -158,11 +166,17 @@ def _median(imageObjectList, paramDict):
 
     single_hdr = None
     virtual = None
+    store = None
+    storeNames = []  # names of the stack store members in input order
+    storeUpdates = []  # exposures to be (re)inserted into the stack store
 
     # for each image object
     for image in imageObjectList:
         if virtual is None:
             virtual = image.inmemory
+            if virtual and stackstore and not util.is_blank(stackstore):
+                print("WARNING: Stack store cannot be used when processing "
+                      "in memory. Ignoring 'combine_stackstore'.")
 
         det_gain = image.getGain(1)
         img_exptime = image._image['sci', 1]._exptime
@@ -201,7 +215,17 @@ def _median(imageObjectList, paramDict):
             wcs_ext = '[0]'
             wcs_extnum = 0
 
-        if not virtual:
+        # single drizzled images saved in raw format are memory-mapped
+        # and read section by section without any copies:
+        raw = not virtual and rawfile.exists(singleDriz_name)
+
+        if raw:
+            iter_singleDriz = rawfile.getdata(singleDriz_name)
+            if rawfile.exists(singleWeight_name):
+                iter_singleWeight = rawfile.getdata(singleWeight_name)
+            else:
+                iter_singleWeight = None
+        elif not virtual:
             if isinstance(singleDriz, str):
                 iter_singleDriz = singleDriz + wcs_ext
                 iter_singleWeight = singleWeight + wcs_ext
@@ -218,31 +242,53 @@ def _median(imageObjectList, paramDict):
             if virtual:
                 single_hdr = singleDriz[wcs_extnum].header
             else:
-                single_hdr = fits.getheader(singleDriz_name, ext=wcs_extnum,
-                                            memmap=False)
+                if raw:
+                    single_hdr = rawfile.getheader(singleDriz_name)
+                else:
+                    single_hdr = fits.getheader(singleDriz_name,
+                                                ext=wcs_extnum, memmap=False)
+                if stackstore and not util.is_blank(stackstore):
+                    store = _openStackStore(stackstore, single_hdr)
+
+        if store is not None:
+            # Only exposures that are new or whose single drizzled products
+            # changed since the last run are (re)inserted:
+            if not raw and not os.access(singleWeight_name, os.F_OK):
+                iter_singleWeight = None
+            signature = _stackSignature(image, single_hdr, stackpars)
+            if store.signature(image._filename) != signature:
+                storeUpdates.append((image._filename, iter_singleDriz,
+                                     iter_singleWeight, signature))
+            storeNames.append(image._filename)
+
+        elif raw:
+            singleDrizList.append(iter_singleDriz)
 
-        single_image = iterfile.IterFitsFile(iter_singleDriz)
-        if virtual:
-            single_image.handle = singleDriz
-            single_image.inmemory = True
+        else:
+            single_image = iterfile.IterFitsFile(iter_singleDriz)
+            if virtual:
+                single_image.handle = singleDriz
+                single_image.inmemory = True
 
-        singleDrizList.append(single_image)  # add to an array for bookkeeping
+            singleDrizList.append(single_image)  # add to an array for bookkeeping
 
         # If it exists, extract the corresponding weight images
-        if (not virtual and os.access(singleWeight, os.F_OK)) or (
-                virtual and singleWeight):
-            weight_file = iterfile.IterFitsFile(iter_singleWeight)
-            if virtual:
-                weight_file.handle = singleWeight
-                weight_file.inmemory = True
-
-            singleWeightList.append(weight_file)
-            try:
-                tmp_mean_value = ImageStats(weight_file.data, lower=1e-8,
-                                            fields="mean", nclip=0).mean
-            except ValueError:
-                tmp_mean_value = 0.0
-            wht_mean.append(tmp_mean_value * maskpt)
+        if (store is not None or
+                (raw and iter_singleWeight is not None) or
+                (not raw and not virtual and os.access(singleWeight, os.F_OK)) or
+                (virtual and singleWeight)):
+            if store is None:
+                if raw:
+                    weight_file = iter_singleWeight
+                    wht_mean.append(_weightMean(weight_file) * maskpt)
+                else:
+                    weight_file = iterfile.IterFitsFile(iter_singleWeight)
+                    if virtual:
+                        weight_file.handle = singleWeight
+                        weight_file.inmemory = True
+                    wht_mean.append(_weightMean(weight_file.data) * maskpt)
+
+                singleWeightList.append(weight_file)
 
             # Extract instrument specific parameters and place in lists
 
@@ -295,16 +341,33 @@ def _median(imageObjectList, paramDict):
         # END Loop over input image list
         #
 
+    if store is not None:
+        _updateStackStore(store, storeUpdates, storeNames)
+        wht_mean = [store.info(name)['wht_mean'] * maskpt
+                    for name in storeNames]
+
     # create an array for the median output image, use the size of the first
     # image in the list. Store other useful image characteristics:
-    single_driz_data = singleDrizList[0].data
-    data_item_size = single_driz_data.itemsize
-    single_data_dtype = single_driz_data.dtype
-    imrows, imcols = single_driz_data.shape
+    if store is None:
+        if isinstance(singleDrizList[0], np.ndarray):
+            single_driz_data = singleDrizList[0]
+        else:
+            single_driz_data = singleDrizList[0].data
+        data_item_size = single_driz_data.itemsize
+        single_data_dtype = single_driz_data.dtype
+        imrows, imcols = single_driz_data.shape
 
-    medianImageArray = np.zeros_like(single_driz_data)
+        medianImageArray = np.zeros(single_driz_data.shape,
+                                    dtype=single_data_dtype)
 
-    del single_driz_data
+        del single_driz_data
+
+    else:
+        data_item_size = store.dtype.itemsize
+        single_data_dtype = store.dtype
+        imrows, imcols = store.shape
+
+        medianImageArray = np.zeros(store.shape, dtype=store.dtype)
 
     if comb_type == "minmed" and not newmasks:
         # Issue a warning if minmed is being run with newmasks turned off.
@@ -357,22 +420,28 @@ def _median(imageObjectList, paramDict):
             e1 = min(e1, e2 - overlap - 1)
             u2 = e2 - e1
 
-        imdrizSectionsList = np.empty(
-            (len(singleDrizList), e2 - e1, imcols),
-            dtype=single_data_dtype
-        )
-        for i, w in enumerate(singleDrizList):
-            imdrizSectionsList[i, :, :] = w[e1:e2]
+        if store is not None:
+            imdrizSectionsList, weightSectionsList = store.read_section(
+                e1, e2, storeNames
+            )
 
-        if singleWeightList:
-            weightSectionsList = np.empty(
-                (len(singleWeightList), e2 - e1, imcols),
+        else:
+            imdrizSectionsList = np.empty(
+                (len(singleDrizList), e2 - e1, imcols),
                 dtype=single_data_dtype
             )
-            for i, w in enumerate(singleWeightList):
-                weightSectionsList[i, :, :] = w[e1:e2]
-        else:
-            weightSectionsList = None
+            for i, w in enumerate(singleDrizList):
+                imdrizSectionsList[i, :, :] = w[e1:e2]
+
+            if singleWeightList:
+                weightSectionsList = np.empty(
+                    (len(singleWeightList), e2 - e1, imcols),
+                    dtype=single_data_dtype
+                )
+                for i, w in enumerate(singleWeightList):
+                    weightSectionsList[i, :, :] = w[e1:e2]
+            else:
+                weightSectionsList = None
 
         weight_mask_list = None
 
@@ -436,8 +505,14 @@ def _median(imageObjectList, paramDict):
             img.saveVirtualOutputs(mediandict)
     else:
         try:
-            print("Saving output median image to: '{}'".format(medianfile))
-            pf.writeto(medianfile)
+            if rawfile.enabled():
+                print("Saving output median image to: '{}'"
+                      .format(rawfile.rawName(medianfile)))
+                rawfile.write(medianfile, medianImageArray, pf[0].header)
+            if rawfile.keep_fits():
+                print("Saving output median image to: '{}'"
+                      .format(medianfile))
+                pf.writeto(medianfile)
         except IOError:
             msg = "Problem writing file '{}'".format(medianfile)
             print(msg)
@@ -445,16 +520,111 @@ def _median(imageObjectList, paramDict):
 
     # Always close any files opened to produce median image; namely,
     # single drizzle images and singly-drizzled weight images
+    # (memory-mapped raw images are closed when they are released)
     #
     for img in singleDrizList:
-        if not virtual:
+        if not virtual and isinstance(img, iterfile.IterFitsFile):
             img.close()
 
     # Close all singly drizzled weight images used to create median image.
     for img in singleWeightList:
-        if not virtual:
+        if not virtual and isinstance(img, iterfile.IterFitsFile):
             img.close()
 
+    if store is not None:
+        store.close()
+
+
+# output WCS keywords that identify the single drizzled products:
+_STACK_WCS_KWS = ['NAXIS1', 'NAXIS2', 'CTYPE1', 'CTYPE2', 'CRPIX1', 'CRPIX2',
+                  'CRVAL1', 'CRVAL2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']
+
+_BITPIX2DTYPE = {8: np.uint8, 16: np.int16, 32: np.int32, 64: np.int64,
+                 -32: np.float32, -64: np.float64}
+
+
+def _weightMean(data):
+    """ Compute mean of the positive values in a weight image. """
+    try:
+        return ImageStats(data, lower=1e-8, fields="mean", nclip=0).mean
+    except ValueError:
+        return 0.0
+
+
+def _openStackStore(path, single_hdr):
+    """ Open (or create) the stack store at ``path`` for single drizzled
+        images described by ``single_hdr``.
+    """
+    shape = (single_hdr['NAXIS2'], single_hdr['NAXIS1'])
+    dtype = _BITPIX2DTYPE[single_hdr['BITPIX']]
+    store = StackStore(path, shape, dtype)
+    print("Using stack store '{}' with {:d} stored exposure(s)"
+          .format(store.path, store.depth))
+    return store
+
+
+def _openStackMember(iter_singleDriz, iter_singleWeight):
+    """ Return single drizzled science and weight images of one exposure
+        that can be read section by section.
+    """
+    if isinstance(iter_singleDriz, np.ndarray):
+        # memory-mapped raw images
+        return iter_singleDriz, iter_singleWeight
+
+    single_image = iterfile.IterFitsFile(iter_singleDriz)
+    if iter_singleWeight is None:
+        weight_file = None
+    else:
+        weight_file = iterfile.IterFitsFile(iter_singleWeight)
+    return single_image, weight_file
+
+
+def _closeStackMember(single_image, weight_file):
+    for img in [single_image, weight_file]:
+        if isinstance(img, iterfile.IterFitsFile):
+            img.close()
+
+
+def _stackSignature(image, single_hdr, stackpars):
+    """ Return a signature of the single drizzled products of an exposure
+        computed from the modification time and size of the input file,
+        the sky of its chips, the drizzle parameters and the output WCS.
+        The single drizzled images are not read.
+    """
+    st = os.stat(image._filename)
+    skies = [chip.subtractedSky
+             for chip in image.returnAllChips(extname=image.scienceExt)]
+    wcs = [single_hdr.get(kw) for kw in _STACK_WCS_KWS]
+    pars = sorted((k, str(v)) for k, v in stackpars.items())
+    key = repr((st.st_mtime, st.st_size, skies, wcs, pars))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _updateStackStore(store, updates, names):
+    """ Insert new or changed exposures into the stack store and drop from
+        it all exposures that are not in the list of ``names``. Files of the
+        other exposures in the store are not rewritten.
+    """
+    members = []
+    try:
+        for name, iter_singleDriz, iter_singleWeight, signature in updates:
+            single_image, weight_file = _openStackMember(iter_singleDriz,
+                                                         iter_singleWeight)
+            if weight_file is None:
+                wht_mean = 1.0
+            elif isinstance(weight_file, np.ndarray):
+                wht_mean = _weightMean(weight_file)
+            else:
+                wht_mean = _weightMean(weight_file.data)
+            members.append((name, single_image, weight_file, signature,
+                            {'wht_mean': float(wht_mean)}))
+
+        store.update(members, remove=[n for n in store.members
+                                      if n not in names])
+    finally:
+        for name, single_image, weight_file, signature, info in members:
+            _closeStackMember(single_image, weight_file)
+
 
 def _writeImage(dataArray=None, inputHeader=None):
     """ Writes out the result of the combination step.
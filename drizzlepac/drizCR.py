@@ -10,11 +10,15 @@ image and the derivative of the model image.
 from __future__ import absolute_import, division, print_function # confidence medium
 
 import numpy as np
-import stsci.convolve as NC
 from astropy.io import fits
 import os
 from . import quickDeriv
 from . import util
+from . import buildmask
+from . import asyncwriter
+from . import rawfile
+from . import ablot
+from . import wcs_functions
 from stsci.tools import fileutil, logutil, mputil, teal
 
 
@@ -26,6 +30,8 @@ from .version import *
 __taskname__= "drizzlepac.drizCR"  # looks in drizzlepac for sky.cfg
 _step_num_ = 6  # this relates directly to the syntax in the cfg file
 
+CR_TILE_NROWS = 256  # number of image rows processed at a time by _crMask()
+
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -55,8 +61,29 @@ def run(configObj):
     rundrizCR(imgObjList, configObj)
 
 
+def useFusedBlot(configObj):
+    """ Return `True` when the median image is to be blotted to each chip
+    by the driz_cr step itself (see ``blot_fused_cr`` parameter) instead
+    of being written out to blotted images by a separate blot step.
+    """
+    blot_name = util.getSectionName(configObj, ablot._blot_step_num_)
+    step_name = util.getSectionName(configObj, _step_num_)
+    if blot_name is None or step_name is None:
+        return False
+    blot_pars = configObj[blot_name]
+    return (blot_pars['blot'] and blot_pars.get('blot_fused_cr', False) and
+            configObj[step_name]['driz_cr'])
+
+
 #the final function that calls the workhorse
-def rundrizCR(imgObjList,configObj,procSteps=None):
+def rundrizCR(imgObjList, configObj, procSteps=None, output_wcs=None,
+              wcsmap=wcs_functions.WCSMap):
+    """ Identify cosmic rays in each input image.
+
+    When ``output_wcs`` is provided, the median image is blotted to each
+    chip in memory just before the chip is processed, instead of reading
+    blotted images created by the blot step.
+    """
 
     if procSteps is not None:
         procSteps.addStep('Driz_CR')
@@ -72,11 +99,31 @@ def rundrizCR(imgObjList,configObj,procSteps=None):
     log.info("USER INPUT PARAMETERS for Driz_CR Step:")
     util.printParams(paramDict, log=log)
 
+    if output_wcs is not None:
+        blotParamDict = ablot.buildBlotParamDict(configObj)
+        blot_wcs = output_wcs.single_wcs
+        log.info('Median image will be blotted to each chip in memory.')
+        log.info('USER INPUT PARAMETERS for Blot Step:')
+        util.printParams(blotParamDict, log=log)
+        # open the median image once so that it is shared by all workers:
+        ablot._get_median(imgObjList[0])
+    else:
+        blotParamDict = None
+        blot_wcs = None
+
     # if we have the cpus and s/w, ok, but still allow user to set pool size
     pool_size = util.get_pool_size(configObj.get('num_cores'), len(imgObjList))
     if imgObjList[0].inmemory:
         pool_size = 1 # reason why is output in drizzle step
 
+    # When images are processed serially, use threads for the derivative
+    # of the blotted images instead:
+    if pool_size > 1:
+        paramDict['num_threads'] = 1
+    else:
+        paramDict['num_threads'] = util.get_pool_size(
+            configObj.get('num_cores'), None)
+
     subprocs = []
     if pool_size > 1:
         log.info('Executing %d parallel workers' % pool_size)
@@ -85,23 +132,32 @@ def rundrizCR(imgObjList,configObj,procSteps=None):
             mgr = manager.dict({})
             #mgr = manager.dict(image.virtualOutputs)
 
-            p = multiprocessing.Process(target=_drizCr,
+            p = multiprocessing.Process(target=asyncwriter.run_and_flush,
                 name='drizCR._drizCr()', # for err msgs
-                args=(image, mgr, paramDict.dict()))
+                args=(_drizCr, image, mgr, paramDict.dict(), blot_wcs, blotParamDict,
+                      wcsmap))
             subprocs.append(p)
             image.virtualOutputs.update(mgr)
         mputil.launch_and_wait(subprocs, pool_size) # blocks till all done
     else:
         log.info('Executing serially')
         for image in imgObjList:
-            _drizCr(image,image.virtualOutputs,paramDict)
+            _drizCr(image, image.virtualOutputs, paramDict, blot_wcs,
+                    blotParamDict, wcsmap)
+
+    if output_wcs is not None:
+        ablot._clear_median_cache()
+
+    # make sure all cosmic ray masks are on disk before they are used
+    asyncwriter.flush()
 
     if procSteps is not None:
         procSteps.endStep('Driz_CR')
 
 
 #the workhorse function
-def _drizCr(sciImage, virtual_outputs, paramDict):
+def _drizCr(sciImage, virtual_outputs, paramDict, blot_wcs=None,
+            blotParamDict=None, wcsmap=wcs_functions.WCSMap):
     """mask blemishes in dithered data by comparison of an image
     with a model image and the derivative of the model image.
 
@@ -109,6 +165,8 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
     blotImage is inferred from the sciImage object here which knows the name of its blotted image :)
     chip should be the science chip that corresponds to the blotted image that was sent
     paramDict contains the user parameters derived from the full configObj instance
+    blot_wcs, when given, is the WCS of the median image, which then gets blotted
+    to each chip in memory using the blot parameters in blotParamDict
     dgMask is inferred from the sciImage object, the name of the mask file to combine with the generated Cosmic ray mask
 
     here are the options you can override in configObj
@@ -152,22 +210,28 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
         scienceChip = sciImage[exten]
 
         if scienceChip.group_member:
-            blotImagePar = 'blotImage'
-            blotImageName = scienceChip.outputNames[blotImagePar]
-            if sciImage.inmemory:
-                __blotImage = sciImage.virtualOutputs[blotImageName]
+            if blot_wcs is not None:
+                __blotImage = None
             else:
-                try:
-                    os.access(blotImageName,os.F_OK)
-                except IOError:
-                    print("Could not find the Blotted image on disk:",blotImageName)
-                    raise # raise orig error
-
-                try:
-                    __blotImage = fits.open(blotImageName, mode="readonly", memmap=False)
-                except IOError:
-                    print("Problem opening blot images")
-                    raise
+                blotImagePar = 'blotImage'
+                blotImageName = scienceChip.outputNames[blotImagePar]
+                if sciImage.inmemory:
+                    __blotImage = sciImage.virtualOutputs[blotImageName]
+                elif rawfile.exists(blotImageName):
+                    # blotted image saved in raw format
+                    __blotImage = [rawfile.getdata(blotImageName)]
+                else:
+                    try:
+                        os.access(blotImageName,os.F_OK)
+                    except IOError:
+                        print("Could not find the Blotted image on disk:",blotImageName)
+                        raise # raise orig error
+
+                    try:
+                        __blotImage = fits.open(blotImageName, mode="readonly", memmap=False)
+                    except IOError:
+                        print("Problem opening blot images")
+                        raise
 
             #blotImageName=scienceChip.outputNames["blotImage"] # input file
             crMaskImage=scienceChip.outputNames["crmaskImage"] # output file
@@ -175,27 +239,25 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
 
             #check that sciImage and blotImage are the same size?
 
-            #grab the actual image from disk
-            __inputImage=sciImage.getData(exten)
-
-            # Apply any unit conversions to input image here for comparison
-            # with blotted image in units of electrons
-            __inputImage *= scienceChip._conversionFactor
+            #grab the actual image from disk and apply any unit conversions
+            # to input image here for comparison with blotted image in units
+            # of electrons (data from getData() are read-only)
+            __inputImage = sciImage.getData(exten) * scienceChip._conversionFactor
 
             #make the derivative blot image
-            __blotData=__blotImage[0].data*scienceChip._conversionFactor #simple fits
-            __blotDeriv = quickDeriv.qderiv(__blotData)
-            if not sciImage.inmemory:
+            if __blotImage is None:
+                __blotData = ablot.blot_chip(sciImage, scienceChip, blot_wcs,
+                                             blotParamDict, wcsmap=wcsmap)
+                __blotData *= scienceChip._conversionFactor
+            elif isinstance(__blotImage, list):
+                __blotData = __blotImage[0] * scienceChip._conversionFactor
+            else:
+                __blotData=__blotImage[0].data*scienceChip._conversionFactor #simple fits
+            __blotDeriv = quickDeriv.qderiv(
+                __blotData, nthreads=paramDict.get('num_threads', 1))
+            if isinstance(__blotImage, fits.HDUList) and not sciImage.inmemory:
                 __blotImage.close()
 
-            #this grabs the original dq mask from the science image
-            # This mask needs to take into account any crbits values
-            # specified by the user to be ignored. A call to the
-            # buildMask() method may work better here...
-            #__dq = sciImage.maskExt + ',' + str(chip)
-            #__dqMask=sciImage.getData(__dq)
-            __dqMask = sciImage.buildMask(chip,paramDict['crbit']) # both args are ints
-
             #parse out the SNR information
             __SNRList=(paramDict["driz_cr_snr"]).split()
             __snr1=float(__SNRList[0])
@@ -210,117 +272,33 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
             __rn=scienceChip._rdnoise
             __backg = scienceChip.subtractedSky*scienceChip._conversionFactor
 
-            # Define output cosmic ray mask to populate
-            __crMask = np.zeros(__inputImage.shape,dtype=np.uint8)
-
-            # Set scaling factor (used by MultiDrizzle) to 1 since scaling has
-            # already been accounted for in blotted image
-            __expmult = 1.
-
-        ##################   COMPUTATION PART I    ###################
-            # Create a temporary array mask
-            __t1 = np.absolute(__inputImage - __blotData)
-            __ta = np.sqrt(__gain * np.absolute(__blotData * __expmult + __backg * __expmult) + __rn * __rn)
-            __tb = ( __mult1 * __blotDeriv + __snr1 * __ta / __gain )
-            del __ta
-            __t2 = __tb / __expmult
-            del __tb
-            __tmp1 = np.logical_not(np.greater(__t1, __t2))
-            del __t1
-            del __t2
-
-            # Create a convolution kernel that is 3 x 3 of 1's
-            __kernel = np.ones((3,3),dtype=np.uint8)
-            # Create an output tmp file the same size as the input temp mask array
-            __tmp2 = np.zeros(__tmp1.shape,dtype=np.int16)
-            # Convolve the mask with the kernel
-            NC.convolve2d(__tmp1,__kernel,output=__tmp2,fft=0,mode='nearest',cval=0)
-            del __kernel
-            del __tmp1
-
-        ##################   COMPUTATION PART II    ###################
-            # Create the CR Mask
-            __xt1 = np.absolute(__inputImage - __blotData)
-            __xta = np.sqrt(__gain * np.absolute(__blotData * __expmult + __backg * __expmult) + __rn * __rn)
-            __xtb = ( __mult2 *__blotDeriv + __snr2 * __xta / __gain )
-            del __xta
-            __xt2 = __xtb / __expmult
-            del __xtb
-            # It is necessary to use a bitwise 'and' to create the mask with numarray objects.
-            __crMask = np.logical_not(np.greater(__xt1, __xt2) & np.less(__tmp2,9) )
-
-            del __xt1
-            del __xt2
-            del __tmp2
-
-
-
-        ##################   COMPUTATION PART III    ###################
-        #flag additional cte 'radial' and 'tail' pixels surrounding CR pixels as CRs
-
-            # In both the 'radial' and 'length' kernels below, 0->good and 1->bad, so that upon
-            # convolving the kernels with __crMask, the convolution output will have low->bad and high->good
-            # from which 2 new arrays are created having 0->bad and 1->good. These 2 new arrays are then 'anded'
-            # to create a new __crMask.
-
-            # recast __crMask to int for manipulations below; will recast to Bool at end
-            __crMask_orig_bool= __crMask.copy()
-            __crMask= __crMask_orig_bool.astype( np.int8 )
-
-            # make radial convolution kernel and convolve it with original __crMask
-            cr_grow_kernel = np.ones((grow, grow))     # kernel for radial masking of CR pixel
-            cr_grow_kernel_conv = __crMask.copy()   # for output of convolution
-            NC.convolve2d( __crMask, cr_grow_kernel, output = cr_grow_kernel_conv)
-
-            # make tail convolution kernel and convolve it with original __crMask
-            cr_ctegrow_kernel = np.zeros((2*ctegrow+1,2*ctegrow+1))  # kernel for tail masking of CR pixel
-            cr_ctegrow_kernel_conv = __crMask.copy()  # for output convolution
-
-            # which pixels are masked by tail kernel depends on sign of ctedir (i.e.,readout direction):
-            if ( ctedir == 1 ):  # HRC: amp C or D ; WFC: chip = sci,1 ; WFPC2
-                cr_ctegrow_kernel[ 0:ctegrow, ctegrow ]=1    #  'positive' direction
-            if ( ctedir == -1 ): # HRC: amp A or B ; WFC: chip = sci,2
-                cr_ctegrow_kernel[ ctegrow+1:2*ctegrow+1, ctegrow ]=1    #'negative' direction
-            if ( ctedir == 0 ):  # NICMOS: no cte tail correction
-                pass
-
-            # do the convolution
-            NC.convolve2d( __crMask, cr_ctegrow_kernel, output = cr_ctegrow_kernel_conv)
-
-            # select high pixels from both convolution outputs; then 'and' them to create new __crMask
-            where_cr_grow_kernel_conv    = np.where( cr_grow_kernel_conv < grow*grow,0,1 )        # radial
-            where_cr_ctegrow_kernel_conv = np.where( cr_ctegrow_kernel_conv < ctegrow, 0, 1 )     # length
-
-            __crMask = np.logical_and( where_cr_ctegrow_kernel_conv, where_cr_grow_kernel_conv) # combine masks
-            __crMask = __crMask.astype(np.uint8) # cast back to Bool
-
-            del __crMask_orig_bool
-            del cr_grow_kernel
-            del cr_grow_kernel_conv
-            del cr_ctegrow_kernel
-            del cr_ctegrow_kernel_conv
-            del where_cr_grow_kernel_conv
-            del where_cr_ctegrow_kernel_conv
-
-            # Apply CR mask to the DQ array in place
-            np.bitwise_and(__dqMask,__crMask,__dqMask)
-
-            ####### Create the corr file
-            __corrFile = np.zeros(__inputImage.shape,dtype=__inputImage.dtype)
-            __corrFile = np.where(np.equal(__dqMask,0),__blotData,__inputImage)
-            __corrDQMask = np.where(np.equal(__dqMask,0),
-                                    paramDict['crbit'],0).astype(np.uint16)
+            # Identify cosmic rays (0 -> CR, 1 -> good pixel) one section
+            # of rows at a time:
+            __crMask = _crMask(__inputImage, __blotData, __blotDeriv,
+                               gain=__gain, rn=__rn, backg=__backg,
+                               snr=(__snr1, __snr2), scale=(__mult1, __mult2),
+                               grow=grow, ctegrow=ctegrow, ctedir=ctedir)
 
             if paramDict['driz_cr_corr']:
+                #this grabs the original dq mask from the science image
+                # This mask needs to take into account any crbits values
+                # specified by the user to be ignored.
+                __dqMask = sciImage.getCombinedMask(chip,paramDict['crbit']) # both args are ints
+
+                # Apply CR mask to the DQ array in place
+                np.bitwise_and(__dqMask,__crMask,__dqMask)
+
+                ####### Create the corr file
+                __badPix = np.equal(__dqMask,0)
                 crcorr_list.append({'sciext':fileutil.parseExtn(exten),
-                                'corrFile':__corrFile.copy(),
+                                'corrFile':np.where(__badPix,__blotData,__inputImage),
                                 'dqext':fileutil.parseExtn(scienceChip.dq_extn),
-                                'dqMask':__corrDQMask.copy()})
-
+                                'dqMask':np.where(__badPix,paramDict['crbit'],0).astype(np.uint16)})
+                del __dqMask, __badPix
 
             ######## Save the cosmic ray mask file to disk
-            _cr_file = np.zeros(__inputImage.shape,np.uint8)
-            _cr_file = np.where(__crMask,1,0).astype(np.uint8)
+            # (_crMask() returns 0 for CRs and 1 for good pixels)
+            _cr_file = __crMask
 
             if not paramDict['inmemory']:
                 outfile = crMaskImage
@@ -332,15 +310,19 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
                 if(os.access(crMaskImage, os.F_OK)):
                     os.remove(crMaskImage)
                     print("Removed old cosmic ray mask file:",crMaskImage)
-                print('Creating output : ',outfile)
-            else:
-                print('Creating in-memory(virtual) FITS file...')
-                outfile = None
-
-            _pf = util.createFile(_cr_file, outfile=outfile, header = None)
+                if rawfile.enabled():
+                    print('Creating output : ',rawfile.rawName(outfile))
+                    rawfile.write(outfile, _cr_file)
+                else:
+                    rawfile.remove(outfile)
+                if rawfile.keep_fits():
+                    print('Creating output : ',outfile)
+                    util.createFile(_cr_file, outfile=outfile, header=None,
+                                    background=True)
 
-            if paramDict['inmemory']:
-                crMaskDict[crMaskImage] = _pf
+            else:
+                # keep the in-memory(virtual) mask with 8 pixels per byte
+                crMaskDict[crMaskImage] = buildmask.PackedMask(_cr_file)
 
     if paramDict['driz_cr_corr']:
         #util.createFile(__corrFile,outfile=crCorImage,header=None)
@@ -351,6 +333,110 @@ def _drizCr(sciImage, virtual_outputs, paramDict):
         sciImage.saveVirtualOutputs(crMaskDict)
         virtual_outputs = sciImage.virtualOutputs
 
+def _crMask(inputImage, blotData, blotDeriv, gain, rn, backg, snr, scale,
+            grow=1, ctegrow=0, ctedir=0, tile_nrows=CR_TILE_NROWS):
+    """ Compute the cosmic ray mask for a chip from the input (science) image,
+    the blotted median image and the derivative of the blotted image.
+
+    Both signal-to-noise tests are evaluated in a single pass over the
+    input arrays. The 3x3 neighbor test, the radial growth and the CTE tail
+    growth of the CR mask are computed as integer box filters on boolean
+    masks. Images are processed in sections of ``tile_nrows`` rows (plus
+    a halo of rows wide enough for all box filters) in order to limit
+    the size of temporary arrays.
+
+    Returns
+    -------
+    crMask : numpy.ndarray
+        A `numpy.uint8` array of the same shape as ``inputImage`` in which
+        pixels affected by cosmic rays are set to 0 and good pixels are 1.
+
+    """
+    snr1, snr2 = snr
+    mult1, mult2 = scale
+    ny = inputImage.shape[0]
+    tile_nrows = max(1, int(tile_nrows))
+    halo = 2 + max(grow, 0) + max(ctegrow, 0)
+
+    # offsets of the radial growth window (as used by stsci.convolve):
+    if grow > 0:
+        grow_win = (-(grow // 2), grow - 1 - grow // 2)
+
+    # offsets of the CTE tail window along the readout direction:
+    if ctedir == 1:
+        cte_win = (1, ctegrow)
+    elif ctedir == -1:
+        cte_win = (-ctegrow, -1)
+    else:
+        cte_win = None
+
+    crMask = np.empty(inputImage.shape, dtype=np.uint8)
+
+    for r1 in range(0, ny, tile_nrows):
+        r2 = min(r1 + tile_nrows, ny)
+        e1 = max(0, r1 - halo)
+        e2 = min(ny, r2 + halo)
+
+        inp = inputImage[e1:e2]
+        blot = blotData[e1:e2]
+        deriv = blotDeriv[e1:e2]
+
+        # Both SNR tests share the difference and noise images:
+        t1 = np.absolute(inp - blot)
+        ta = np.sqrt(gain * np.absolute(blot + backg) + rn * rn)
+        cr1 = np.greater(t1, mult1 * deriv + snr1 * ta / gain)
+        cr2 = np.greater(t1, mult2 * deriv + snr2 * ta / gain)
+        del t1, ta
+
+        # A pixel is a CR if it fails the second test and it or any
+        # of its 8 neighbors fail the first test:
+        crpix = cr2 & _boxAny(cr1, (-1, 1), (-1, 1))
+        del cr1, cr2
+
+        # flag additional 'radial' and CTE 'tail' pixels around CRs:
+        if grow > 0:
+            bad = _boxAny(crpix, grow_win, grow_win)
+        else:
+            bad = np.zeros_like(crpix)
+
+        if ctegrow > 0:
+            if cte_win is None:
+                # no tail kernel: every pixel is rejected (as with a
+                # zero-valued convolution kernel)
+                bad[...] = True
+            else:
+                bad |= _boxAny(crpix, cte_win, (0, 0))
+
+        np.logical_not(bad[r1 - e1:r2 - e1], out=crMask[r1:r2])
+
+    return crMask
+
+
+def _boxAny(mask, rows, cols):
+    """ Return a boolean array which is `True` wherever any pixel of ``mask``
+    in the window ``[i + rows[0], i + rows[1]] x [j + cols[0], j + cols[1]]``
+    is `True`. Pixels beyond the edges of ``mask`` take the value of the
+    nearest edge pixel.
+    """
+    ny, nx = mask.shape
+    pad = ((max(0, -rows[0]), max(0, rows[1])),
+           (max(0, -cols[0]), max(0, cols[1])))
+    pmask = np.pad(mask.view(np.uint8), pad, mode='edge')
+
+    # box sums computed from cumulative sums along each axis:
+    csum = np.zeros((pmask.shape[0] + 1, pmask.shape[1]), dtype=np.int32)
+    np.cumsum(pmask, axis=0, out=csum[1:])
+    lo = pad[0][0] + rows[0]
+    hi = pad[0][0] + rows[1] + 1
+    rsum = csum[hi:hi + ny] - csum[lo:lo + ny]
+
+    csum = np.zeros((ny, nx + pad[1][0] + pad[1][1] + 1), dtype=np.int32)
+    np.cumsum(rsum, axis=1, out=csum[:, 1:])
+    lo = pad[1][0] + cols[0]
+    hi = pad[1][0] + cols[1] + 1
+    return (csum[:, hi:hi + nx] - csum[:, lo:lo + nx]) > 0
+
+
 #### Create _cor file based on format of original input image
 def createCorrFile(outfile, arrlist, template):
     """
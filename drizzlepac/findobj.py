@@ -17,12 +17,16 @@ from stsci import ndimage as ndim
 
 import stsci.imagestats as imagestats
 from . import cdriz
+from . import util
+
+if util.can_parallel:
+    import multiprocessing
 
 __all__ = ['gaussian1', 'gausspars', 'gaussian', 'moments', 'errfunc',
-           'findstars', 'apply_nsigma_separation', 'xy_round',
-           'precompute_sharp_round', 'sharp_round', 'roundness', 'immoments',
-           'nmoment', 'centroid', 'cmoment', 'central_moments', 'covmat',
-           'help', 'getHelpAsString']
+           'findstars', 'findstars_many', 'apply_nsigma_separation',
+           'xy_round', 'precompute_sharp_round', 'sharp_round', 'roundness',
+           'immoments', 'nmoment', 'centroid', 'cmoment', 'central_moments',
+           'covmat', 'help', 'getHelpAsString']
 
 
 #def gaussian(amplitude, xcen, ycen, xsigma, ysigma):
@@ -30,6 +34,20 @@ __all__ = ['gaussian1', 'gausspars', 'gaussian', 'moments', 'errfunc',
 
 fwhm2sig = 2*np.sqrt(2*np.log(2))
 
+# maximum number of pixels in the stacks of boxes used to compute centroids
+CENTROID_BATCH_NPIX = 2**22
+
+# type of the results of arithmetic operations on single precision
+# scalars and Python floats (used to reproduce per-source computations):
+_SCALAR_FLOAT = (2.0 * np.float32(1.0)).dtype
+
+# size (in units of the kernel size) of the margin added around the tiles
+# used to find sources
+TILE_HALO = 4
+
+# inputs of tiled source finding shared with (forked) worker processes
+_findstars_inputs = []
+
 #def gaussian1(height, x0, y0, fwhm, nsigma=1.5, ratio=1., theta=0.0):
 def gaussian1(height, x0, y0, a, b, c):
     """
@@ -142,11 +160,146 @@ def findstars(jdata, fwhm, threshold, skymode,
               peakmin=None, peakmax=None, fluxmin=None, fluxmax=None,
               nsigma=1.5, ratio=1.0, theta=0.0,
               use_sharp_round=False,mask=None,
-              sharplo=0.2,sharphi=1.0,roundlo=-1.0,roundhi=1.0):
+              sharplo=0.2,sharphi=1.0,roundlo=-1.0,roundhi=1.0,
+              tile_size=None, num_cores=None):
+    """ Find sources in an image.
 
-    # store input image size:
-    (img_ny, img_nx) = jdata.shape
+    When ``tile_size`` is set, the image is split into overlapping tiles
+    that are processed in parallel (see `findstars_many`).
+
+    """
+    pars = dict(fwhm=fwhm, threshold=threshold, skymode=skymode,
+                peakmin=peakmin, peakmax=peakmax, fluxmin=fluxmin,
+                fluxmax=fluxmax, nsigma=nsigma, ratio=ratio, theta=theta,
+                use_sharp_round=use_sharp_round, mask=mask,
+                sharplo=sharplo, sharphi=sharphi,
+                roundlo=roundlo, roundhi=roundhi)
+    return findstars_many([(jdata, pars)], tile_size=tile_size,
+                          num_cores=num_cores)[0]
+
+
+def findstars_many(images, tile_size=None, num_cores=None):
+    """ Find sources in several images with a pool of processes.
+
+    Each image is split into tiles of ``tile_size x tile_size`` pixels.
+    Tiles are convolved and segmented together with a margin (halo) of
+    ``TILE_HALO`` kernel sizes around them, and each tile keeps only the
+    sources whose segment starts (in raster order) in the tile. A tile is
+    processed again with a doubled halo whenever one of its segments, or
+    the boxes used to measure it, extend beyond the halo. Therefore,
+    source lists are identical to those obtained by processing entire
+    images at once.
+
+    Parameters
+    ----------
+    images : list of tuple
+        List of ``(jdata, pars)`` tuples, where ``pars`` is a dictionary of
+        the keyword arguments of `findstars` (other than ``jdata``,
+        ``tile_size`` and ``num_cores``).
+
+    tile_size : int, None
+        Size of the tiles. When `None`, images are not split into tiles.
+
+    num_cores : int, None
+        Maximum number of processes used to find sources.
+
+    Returns
+    -------
+    sources : list of tuple
+        ``(fitind, fluxes)`` for each input image, as returned by
+        `findstars`.
 
+    """
+    if tile_size is not None:
+        tile_size = max(int(tile_size), 1)
+
+    inputs = []
+    tasks = []
+    for jdata, pars in images:
+        pars = pars.copy()
+        mask = pars.pop('mask', None)
+        kpars = _kernel_pars(pars['fwhm'], pars['nsigma'], pars['ratio'],
+                             pars['theta'])
+        inputs.append((jdata, mask, kpars, pars))
+
+        (img_ny, img_nx) = jdata.shape
+        if tile_size is None or (tile_size >= img_ny and tile_size >= img_nx):
+            tasks.append((len(inputs) - 1, (0, img_ny, 0, img_nx), 0))
+            continue
+        halo = TILE_HALO * max(kpars['nx'], kpars['ny'])
+        for y0 in range(0, img_ny, tile_size):
+            for x0 in range(0, img_nx, tile_size):
+                core = (y0, min(y0 + tile_size, img_ny),
+                        x0, min(x0 + tile_size, img_nx))
+                tasks.append((len(inputs) - 1, core, halo))
+
+    pool_size = 1
+    if len(tasks) > 1 and util.can_parallel and \
+       'fork' in multiprocessing.get_all_start_methods():
+        pool_size = util.get_pool_size(num_cores, len(tasks))
+
+    global _findstars_inputs
+    _findstars_inputs = inputs
+    pool = None
+    try:
+        if pool_size > 1:
+            pool = multiprocessing.get_context('fork').Pool(pool_size)
+        results = [[] for i in inputs]
+        while tasks:
+            if pool is None:
+                tiles = [_findstarsWorker(t) for t in tasks]
+            else:
+                tiles = pool.map(_findstarsWorker, tasks)
+            retry = []
+            for task, tile in zip(tasks, tiles):
+                if tile is None:
+                    # a segment is not resolved: enlarge halo
+                    i, core, halo = task
+                    retry.append((i, core, 2 * halo))
+                else:
+                    results[task[0]].append(tile)
+            tasks = retry
+    finally:
+        _findstars_inputs = []
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    sources = []
+    for (jdata, mask, kpars, pars), tiles in zip(inputs, results):
+        nobj = sum(t[0] for t in tiles)
+        if nobj < 2:
+            print('No objects found for this image. Please check value of "threshold".')
+            sources.append(([], []))
+            continue
+
+        # restore the order in which sources are found in the entire image:
+        fitind = []
+        fluxes = []
+        for t in tiles:
+            fitind.extend(t[2])
+            fluxes.extend(t[3])
+        if len(tiles) > 1:
+            keys = np.concatenate([t[1] for t in tiles])
+            order = np.argsort(keys, kind='mergesort')
+            fitind = [fitind[k] for k in order]
+            fluxes = [fluxes[k] for k in order]
+
+        sources.append(apply_nsigma_separation(
+            fitind, fluxes, pars['fwhm'] * pars['nsigma'] / 2
+        ))
+
+    return sources
+
+
+def _findstarsWorker(task):
+    # worker process: images are inherited from the parent process (fork)
+    i, core, halo = task
+    jdata, mask, kpars, pars = _findstars_inputs[i]
+    return _findstars_tile(jdata, mask, kpars, core, halo, **pars)
+
+
+def _kernel_pars(fwhm, nsigma, ratio, theta):
     # Define convolution inputs
     nx, ny, a, b, c, f = gausspars(fwhm, nsigma=nsigma, ratio= ratio, theta=theta)
 
@@ -156,10 +309,6 @@ def findstars(jdata, fwhm, threshold, skymode,
     yin, xin = np.mgrid[0:ny, 0:nx]
     kernel = gaussian1(1.0, xc, yc, a, b, c)(xin,yin)
 
-    # define size of extraction box for each source based on kernel size
-    grx = xc
-    gry = yc
-
     # DAOFIND STYLE KERNEL "SHAPE"
     rmat    = np.sqrt((xin-xc)**2 + (yin-yc)**2)
     rmatell = a*(xin-xc)**2 + b*(xin-xc)*(yin-yc) + c*(yin-yc)**2
@@ -175,21 +324,70 @@ def findstars(jdata, fwhm, threshold, skymode,
                                                # fluxes for thresholds
     nkern *= xyrmask
 
-    # initialize values used for getting source centers
-    relerr = 1./((rmask**2).sum() - (rmask.sum()**2/xyrmask.sum()))
-
     xsigsq = (fwhm/fwhm2sig)**2
     ysigsq = (ratio**2) * xsigsq
 
+    s2m, s4m = precompute_sharp_round(nx, ny, xc, yc)
+
+    return dict(nx=nx, ny=ny, xc=xc, yc=yc, kernel=kernel, xyrmask=xyrmask,
+                nkern=nkern, xsigsq=xsigsq, ysigsq=ysigsq, s2m=s2m, s4m=s4m)
+
+
+def _findstars_tile(jdata, mask, kpars, core, halo, fwhm, threshold,
+                    skymode, peakmin=None, peakmax=None, fluxmin=None,
+                    fluxmax=None, nsigma=1.5, ratio=1.0, theta=0.0,
+                    use_sharp_round=False, sharplo=0.2, sharphi=1.0,
+                    roundlo=-1.0, roundhi=1.0):
+    """ Find sources whose segments start within the ``core`` region
+    ``(y0, y1, x0, x1)`` of the image.
+
+    Returns `None` if the segments, or the boxes used to measure the
+    sources, are not fully contained in the core region enlarged by
+    ``halo`` pixels. Otherwise, returns a tuple of the number of segments,
+    the raster index of the first pixel of the segment of each source, and
+    the lists of sources and fluxes.
+
+    """
+    # store input image size:
+    (img_ny, img_nx) = jdata.shape
+
+    nx = kpars['nx']
+    ny = kpars['ny']
+    xc = kpars['xc']
+    yc = kpars['yc']
+
+    # define size of extraction box for each source based on kernel size
+    grx = xc
+    gry = yc
+
+    # region of the image analyzed by this tile, and the region read in
+    # to compute its convolution:
+    cy0, cy1, cx0, cx1 = core
+    vy0 = max(cy0 - halo, 0)
+    vy1 = min(cy1 + halo, img_ny)
+    vx0 = max(cx0 - halo, 0)
+    vx1 = min(cx1 + halo, img_nx)
+    wy0 = max(vy0 - yc, 0)
+    wy1 = min(vy1 + yc, img_ny)
+    wx0 = max(vx0 - xc, 0)
+    wx1 = min(vx1 + xc, img_nx)
+    # segments must be filtered by ownership whenever the image is split
+    # into tiles, even if the halo of this tile covers the entire image:
+    tiled = tuple(core) != (0, img_ny, 0, img_nx)
+
     # convolve image with gaussian kernel
-    convdata = convolve.convolve2d(jdata, nkern).astype(np.float32)
+    convdata = convolve.convolve2d(jdata[wy0:wy1, wx0:wx1],
+                                   kpars['nkern']).astype(np.float32)
+    convdata = convdata[vy0 - wy0:vy1 - wy0, vx0 - wx0:vx1 - wx0]
+    jdata = jdata[vy0:vy1, vx0:vx1]
 
     # clip image to create regions around each source for segmentation
     if mask is None:
         #tdata=np.where(convdata > skymode*2.0, convdata, 0)
         tdata=np.where(convdata > threshold, convdata, 0)
     else:
-        tdata=np.where((convdata > threshold) & mask, convdata, 0)
+        tdata=np.where((convdata > threshold) & mask[vy0:vy1, vx0:vx1],
+                       convdata, 0)
 
     # segment image and find sources
     s = ndim.generate_binary_structure(2,2)
@@ -197,116 +395,366 @@ def findstars(jdata, fwhm, threshold, skymode,
     fobjects = ndim.find_objects(ldata)
     #print 'Number of potential sources: ',nobj
 
-    fluxes = []
+    bbox = np.array([(ss[0].start, ss[0].stop, ss[1].start, ss[1].stop)
+                     for ss in fobjects if ss is not None],
+                    dtype=np.intp).reshape((-1, 4))
+    bbox += [vy0, vy0, vx0, vx0]
+
+    if tiled:
+        # raster index (in the entire image) of the first pixel of each
+        # segment. Segments are labeled in the order of their first pixel:
+        flat = ldata.ravel()
+        pix = np.flatnonzero(flat)
+        lab = flat[pix]
+        first = np.ones(lab.size, dtype=np.bool_)
+        first[1:] = lab[1:] > np.maximum.accumulate(lab[:-1])
+        pix = pix[first]
+        py0, px0 = np.divmod(pix, vx1 - vx0)
+        py0 += vy0
+        px0 += vx0
+
+        # keep only segments starting in the core of the tile:
+        owned = (py0 >= cy0) & (py0 < cy1) & (px0 >= cx0) & (px0 < cx1)
+        bbox = bbox[owned]
+        keys = py0[owned] * img_nx + px0[owned]
+        nobj = bbox.shape[0]
+
+        # segments touching the border of the analyzed region may extend
+        # beyond it:
+        sy0, sy1, sx0, sx1 = bbox.T
+        if np.any(((sy0 <= vy0) & (vy0 > 0)) | ((sy1 >= vy1) & (vy1 < img_ny)) |
+                  ((sx0 <= vx0) & (vx0 > 0)) | ((sx1 >= vx1) & (vx1 < img_nx))):
+            return None
+
+    else:
+        keys = np.arange(bbox.shape[0])
+
+    sy0, sy1, sx0, sx1 = bbox.T
+
+    # ignore sources within ny//2 (nx//2) of edge:
+    yr0 = sy0 - gry
+    yr1 = sy1 + gry + 1
+    xr0 = sx0 - grx
+    xr1 = sx1 + grx + 1
+    good = ((sx1 - sx0 < img_nx - 1) &
+            (sy1 - sy0 < img_ny - 1) &
+            (yr0 > 0) & (yr1 < img_ny) & (xr0 > 0) & (xr1 < img_nx))
+    idx = np.flatnonzero(good)
+    if idx.size == 0:
+        return nobj, keys[idx], [], []
+    if tiled and np.any((yr0[idx] < vy0) | (yr1[idx] > vy1) |
+                        (xr0[idx] < vx0) | (xr1[idx] > vx1)):
+        return None
+
+    # Define region centered on max value in object (slice)
+    # This region will be bounds-checked to insure that it only accesses
+    # a valid section of the image (not off the edge)
+    xcen, ycen = _box_centroids(tdata, yr0[idx] - vy0, yr1[idx] - vy0,
+                                xr0[idx] - vx0, xr1[idx] - vx0)
+    valid = np.isfinite(xcen) & np.isfinite(ycen)
+    idx = idx[valid]
+    yr0 = np.trunc(ycen[valid] + 0.5).astype(np.intp) + yr0[idx] - gry
+    xr0 = np.trunc(xcen[valid] + 0.5).astype(np.intp) + xr0[idx] - grx
+    good = (yr0 >= 0) & (yr0 + ny <= img_ny) & (xr0 >= 0) & (xr0 + nx <= img_nx)
+    idx = idx[good]
+    yr0 = yr0[good]
+    xr0 = xr0[good]
+    if idx.size == 0:
+        return nobj, keys[idx], [], []
+    if tiled and np.any((yr0 < vy0) | (yr0 + ny > vy1) |
+                        (xr0 < vx0) | (xr0 + nx > vx1)):
+        return None
+
+    # Simple Centroid on the region from the input image
+    jregions = _cutouts(jdata, yr0 - vy0, xr0 - vx0, ny, nx)
+    flat = jregions.reshape((jregions.shape[0], ny * nx))
+    src_flux = flat.sum(axis=1)
+    src_peak = flat.max(axis=1)
+
+    good = np.ones(src_flux.shape, dtype=np.bool_)
+    if peakmax is not None:
+        good &= ~(src_peak >= peakmax)
+    if peakmin is not None:
+        good &= ~(src_peak <= peakmin)
+    if fluxmin:
+        good &= ~(src_flux <= fluxmin)
+    if fluxmax:
+        good &= ~(src_flux >= fluxmax)
+
+    jregions = jregions[good]
+    src_flux = src_flux[good]
+    idx = idx[good]
+    yr0 = yr0[good]
+    xr0 = xr0[good]
+    flat = jregions.reshape((jregions.shape[0], ny * nx))
+    datamin = flat.min(axis=1)
+    datamax = flat.max(axis=1)
+
+    nsrc = jregions.shape[0]
+    if nsrc == 0:
+        return nobj, keys[idx], [], []
+    satur = np.zeros(nsrc, dtype=np.bool_)
+    sharp = nsrc * [None]
+    round1 = nsrc * [None]
+    good = np.ones(nsrc, dtype=np.bool_)
+
+    if use_sharp_round:
+        # Compute sharpness and first estimate of roundness:
+        dregions = _cutouts(convdata, yr0 - vy0, xr0 - vx0, ny, nx)
+        satur, round1, sharp, defined = _sharp_round_batch(
+            jregions, dregions, kpars['xyrmask'], xc, yc, kpars['s2m'],
+            kpars['s4m'], datamin, datamax
+        )
+        # Filter sources:
+        good &= defined
+        good &= ~((sharp < sharplo) | (sharp > sharphi))
+        good &= ~((round1 < roundlo) | (round1 > roundhi))
+        sharp = sharp.tolist()
+        round1 = round1.tolist()
+
+    px, py, round2, defined = _xy_round_batch(jregions, grx, gry, skymode,
+                                              kpars['kernel'],
+                                              kpars['xsigsq'],
+                                              kpars['ysigsq'],
+                                              datamin, datamax)
+
+    # Filter sources:
+    good &= defined
+    if use_sharp_round:
+        good &= satur | ~((round2 < roundlo) | (round2 > roundhi))
+
     fitind = []
-    if nobj < 2:
-        print('No objects found for this image. Please check value of "threshold".')
-        return fitind,fluxes
+    fluxes = []
+    for i in np.flatnonzero(good):
+        fitind.append((float(px[i]) + int(xr0[i]), float(py[i]) + int(yr0[i]),
+                       sharp[i], round1[i], float(round2[i])))
+        # compute a source flux value
+        fluxes.append(src_flux[i])
 
-    # determine center of each source, while removing spurious sources or
-    # applying limits defined by the user
-    ninit  = 0
-    ninit2 = 0
-    #minxx  = grx * 2 + 1
-    #minxy  = gry * 2 + 1
+    return nobj, keys[idx[good]], fitind, fluxes
 
-    s2m, s4m = precompute_sharp_round(nx, ny, xc, yc)
 
-    satur  = False # Default assumption if use_sharp_round=False
-    sharp  = None
-    round1 = None
-    round2 = None
+def _cutouts(image, y0, x0, ny, nx):
+    """ Return a stack of the ``(ny, nx)`` boxes of ``image`` whose lower
+    left corners are at ``(y0, x0)``.
+    """
+    windows = np.lib.stride_tricks.as_strided(
+        image,
+        shape=(image.shape[0] - ny + 1, image.shape[1] - nx + 1, ny, nx),
+        strides=2 * image.strides
+    )
+    return windows[y0, x0]
 
-    for ss,n in zip(fobjects,range(len(fobjects))):
-        ssx = ss[1].stop - ss[1].start
-        ssy = ss[0].stop - ss[0].start
-        if ssx >= tdata.shape[1]-1 or ssy >= tdata.shape[0]-1:
-            continue
 
-        yr0 = ss[0].start - gry
-        yr1 = ss[0].stop  + gry + 1
-        if yr0 <= 0 or yr1 >= img_ny: continue # ignore sources within ny//2 of edge
-        #if yr0 <= 0: yr0 = 0
-        #if yr1 >= jdata.shape[0]: yr1 = jdata.shape[0]
-
-        xr0 = ss[1].start - grx
-        xr1 = ss[1].stop  + grx + 1
-        if xr0 <= 0 or xr1 >= img_nx: continue # ignore sources within nx//2 of edge
-        #if xr0 <= 0: xr0 = 0
-        #if xr1 >= jdata.shape[1]: xr1 = jdata.shape[1]
-
-        ssnew = (slice(yr0,yr1),slice(xr0,xr1))
-        region = tdata[ssnew]
-
-        #if region.shape[0] < minxy or region.shape[1] < minxy:
-        #    continue
-
-        cntr = centroid(region)
-
-        # Define region centered on max value in object (slice)
-        # This region will be bounds-checked to insure that it only accesses
-        # a valid section of the image (not off the edge)
-        maxpos = (int(cntr[1]+0.5)+ssnew[0].start,int(cntr[0]+0.5)+ssnew[1].start)
-        yr0 = maxpos[0] - gry
-        yr1 = maxpos[0] + gry + 1
-        if yr0 < 0 or yr1 > img_ny:
-            continue
-        xr0 = maxpos[1] - grx
-        xr1 = maxpos[1] + grx + 1
-        if xr0 < 0 or xr1 > img_nx:
-            continue
+def _box_centroids(image, y0, y1, x0, x1, maxpix=CENTROID_BATCH_NPIX):
+    """ Compute `centroid` of many boxes ``image[y0:y1, x0:x1]``.
 
-        #ninit += 1
-        # Simple Centroid on the region from the input image
-        jregion = jdata[yr0:yr1,xr0:xr1]
-        src_flux = jregion.sum()
-        src_peak = jregion.max()
+    Boxes of the same size are processed together. Moments are accumulated
+    in the same order and precision as in ``cdriz.arrmoments``.
 
-        if (peakmax is not None and src_peak >= peakmax):
-            continue
-        if (peakmin is not None and src_peak <= peakmin):
-            continue
+    """
+    xcen = np.empty(y0.shape, dtype=np.float64)
+    ycen = np.empty(y0.shape, dtype=np.float64)
+    if y0.size == 0:
+        return xcen, ycen
+
+    shapes, inverse = np.unique(np.stack([y1 - y0, x1 - x0], axis=1),
+                                axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    for k, (ny, nx) in enumerate(shapes):
+        ind = np.flatnonzero(inverse == k)
+        iy = np.repeat(np.arange(ny, dtype=np.float64), nx)
+        ix = np.tile(np.arange(nx, dtype=np.float64), ny)
+        chunk = max(1, maxpix // (ny * nx))
+        for c in range(0, ind.size, chunk):
+            sel = ind[c:c + chunk]
+            boxes = _cutouts(image, y0[sel], x0[sel], ny, nx)
+            boxes = boxes.reshape((sel.size, -1)).astype(np.float32)
+            boxes = boxes.astype(np.float64)
+            # sequential (cumulative) sums reproduce the summation order
+            # of the C code:
+            m00 = np.cumsum(boxes, axis=1)[:, -1]
+            m10 = np.cumsum(iy * boxes, axis=1)[:, -1]
+            m01 = np.cumsum(ix * boxes, axis=1)[:, -1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ycen[sel] = m10 / m00
+                xcen[sel] = m01 / m00
 
-        if fluxmin and src_flux <= fluxmin:
-            continue
-        if fluxmax and src_flux >= fluxmax:
-            continue
+    return xcen, ycen
 
-        #ninit2 += 1
-        datamin = jregion.min()
-        datamax = jregion.max()
-
-        if use_sharp_round:
-            # Compute sharpness and first estimate of roundness:
-            dregion = convdata[yr0:yr1,xr0:xr1]
-            satur, round1, sharp = \
-                sharp_round(jregion, dregion, xyrmask, xc, yc,
-                            s2m, s4m, nx, ny, datamin, datamax)
-            # Filter sources:
-            if sharp is None or (sharp < sharplo or sharp > sharphi):
-                continue
-            if round1 is None or (round1 < roundlo or round1 > roundhi):
-                continue
-
-        px,py,round2 = xy_round(jregion, grx, gry, skymode,
-                                kernel, xsigsq, ysigsq, datamin, datamax)
 
-        # Filter sources:
-        if px is None:
-            continue
-        if use_sharp_round:
-            if not satur and \
-               (round2 is None or round2 < roundlo or round2 > roundhi):
-                continue
+def _sharp_round_batch(data, density, kskip, xc, yc, s2m, s4m,
+                       datamin, datamax):
+    """ Vectorized version of `sharp_round` for a stack of source boxes.
 
-        fitind.append((px+xr0,py+yr0,sharp, round1, round2))
-        # compute a source flux value
-        fluxes.append(src_flux)
+    Returns
+    -------
+    satur, round, sharp, defined : numpy.ndarray
+        Saturation flags, roundness and sharpness of the sources and a
+        flag indicating that both roundness and sharpness are defined (not
+        `None` in `sharp_round`).
 
-    fitindc,fluxesc = apply_nsigma_separation(fitind,fluxes,fwhm*nsigma/2)
+    """
+    nsrc = data.shape[0]
 
-    #print 'ninit: ',ninit,'   ninit2: ',ninit2,' final n: ',len(fitind)
-    return fitindc, fluxesc
+    # Compute the first estimate of roundness:
+    sum2 = (s2m * density).reshape((nsrc, -1)).sum(axis=1)
+    sum4 = (s4m * abs(density)).reshape((nsrc, -1)).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        round = (2.0 * sum2.astype(_SCALAR_FLOAT)) / sum4.astype(_SCALAR_FLOAT)
+    round[sum2 == 0.0] = 0.0
+    defined = (sum2 == 0.0) | ~(sum4 <= 0.0)
+
+    # Eliminate the sharpness test if the central pixel is bad:
+    mid_data_pix = data[:, yc, xc]
+    mid_dens_pix = density[:, yc, xc]
+    hi = mid_data_pix > datamax
+    lo = ~hi & (mid_data_pix < datamin)
+    defined &= ~(hi | lo)
+
+    # Sharpness statistics:
+    satur = (kskip * data).reshape((nsrc, -1)).max(axis=1) > datamax
+    satur[hi] = True
+    satur[lo] = False
+
+    # Exclude pixels (create a mask) outside the [datamin, datamax] range:
+    uskip = np.where((data >= datamin[:, None, None]) &
+                     (data <= datamax[:, None, None]), 1, 0)
+    # Update the mask with the "skipped" values from the convolution kernel:
+    uskip *= kskip
+    # Also, exclude central pixel:
+    uskip[:, yc, xc] = 0
+
+    npixels = uskip.reshape((nsrc, -1)).sum(axis=1)
+    defined &= ~((npixels < 1) | (mid_dens_pix <= 0.0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharp = (mid_data_pix - (uskip * data).reshape((nsrc, -1))
+                 .sum(axis=1) / npixels) / mid_dens_pix
+
+    return satur, round, sharp, defined
+
+
+def _xy_round_batch(data, x0, y0, skymode, ker2d, xsigsq, ysigsq,
+                    datamin, datamax):
+    """ Vectorized version of `xy_round` for a stack of source boxes of the
+    same size as the kernel.
+
+    This reproduces, operation by operation, the computations of
+    ``cdriz.arrxyround`` so that the results are identical.
+
+    Returns
+    -------
+    x, y, round, defined : numpy.ndarray
+        Source centers and roundness and a flag indicating that the values
+        are defined (not `None` in `xy_round`).
+
+    """
+    nsrc = data.shape[0]
+    nyk, nxk = ker2d.shape
+    data = data.astype(np.float32).astype(np.float64)
+    # the C code reads the kernel into a single precision variable:
+    ker2d = ker2d.astype(np.float32).astype(np.float64)
+
+    xhalf = (nxk / 2.0) - 0.5
+    yhalf = (nyk / 2.0) - 0.5
+    xmiddle = nxk // 2
+    ymiddle = nyk // 2
+
+    # pixels outside the [datamin, datamax] range reject the source:
+    defined = ~((data < np.asarray(datamin, dtype=np.float64)[:, None, None]) |
+                (data > np.asarray(datamax, dtype=np.float64)[:, None, None])
+               ).reshape((nsrc, -1)).any(axis=1)
+
+    def marginal_fit(axis):
+        # axis = 1 (x): sum along columns for each k; axis = 0 (y): rows
+        if axis == 1:
+            nout, nin, middle_out, middle_in = nxk, nyk, xmiddle, ymiddle
+        else:
+            nout, nin, middle_out, middle_in = nyk, nxk, ymiddle, xmiddle
+
+        sumgd = np.zeros(nsrc)
+        sumgsq = 0.0
+        sumg = 0.0
+        sumd = np.zeros(nsrc)
+        sumdx = np.zeros(nsrc)
+        sdgdx = 0.0
+        sdgdxsq = 0.0
+        sddgdx = np.zeros(nsrc)
+        sgdgdx = 0.0
+        p = 0.0
+        n = 0
+
+        for k in range(nout):
+            sg = 0.0
+            sd = np.zeros(nsrc)
+            for j in range(nin):
+                wt = float(middle_in + 1 - abs(j - middle_in))
+                if axis == 1:
+                    pix = data[:, j, k]
+                    kval = ker2d[j, k]
+                else:
+                    pix = data[:, k, j]
+                    kval = ker2d[k, j]
+                sd += (pix - skymode) * wt
+                sg += kval * wt
+            dxk = float(middle_out - k)
+            wt = float(middle_out + 1 - abs(middle_out - k))
+            sumgd += wt * sg * sd
+            sumgsq += wt * sg**2
+            sumg += wt * sg
+            sumd += wt * sd
+            sumdx += wt * sd * dxk
+            p += wt
+            n += 1
+            dgdx = sg * dxk
+            sdgdxsq += wt * dgdx**2
+            sdgdx += wt * dgdx
+            sddgdx += wt * sd * dgdx
+            sgdgdx += wt * sg * dgdx
+
+        if n <= 2 or p <= 0.0:
+            return None, None, np.zeros(nsrc, dtype=np.bool_)
+
+        # Solve for the height of the best-fitting gaussian to the
+        # marginal. Reject the star if the height is non-positive.
+        h1 = sumgsq - sumg**2 / p
+        if h1 <= 0.0:
+            return None, None, np.zeros(nsrc, dtype=np.bool_)
+
+        h = (sumgd - sumg * sumd / p) / h1
+        ok = h > 0.0
+
+        # Solve for the new centroid.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skylvl = (sumd - h * sumg) / p
+            d = (sgdgdx - (sddgdx - sdgdx * (h * sumg + skylvl * p))) / \
+                (h * sdgdxsq / (xsigsq if axis == 1 else ysigsq))
+            half = xhalf if axis == 1 else yhalf
+            far = np.abs(d) > half
+            d[far] = np.where(sumd[far] == 0.0, 0.0, sumdx[far] / sumd[far])
+            d[np.abs(d) > half] = 0.0
+
+        return h, d, ok
+
+    hx, dx, okx = marginal_fit(1)
+    defined &= okx
+    if not defined.any():
+        nan = np.full(nsrc, np.nan)
+        return nan, nan, nan, defined
+
+    hy, dy, oky = marginal_fit(0)
+    defined &= oky
+    if not defined.any():
+        nan = np.full(nsrc, np.nan)
+        return nan, nan, nan, defined
+
+    xc = float(int(np.floor(x0))) + dx
+    yc = float(int(np.floor(y0))) + dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        round = 2.0 * (hx - hy) / (hx + hy)
+
+    return xc, yc, round, defined
 
 
 def apply_nsigma_separation(fitind,fluxes,separation,niter=10):
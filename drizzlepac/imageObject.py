@@ -8,7 +8,8 @@ A class which makes image objects for each input filename.
 """
 from __future__ import absolute_import, division, print_function  # confidence medium
 
-import copy, os, re, sys
+import copy, os, re, sys, threading
+from collections import OrderedDict
 
 import numpy as np
 from stwcs import distortion
@@ -18,16 +19,147 @@ from astropy.io import fits
 from . import util
 from . import wcs_functions
 from . import buildmask
+from . import rawfile
 from .version import *
 
-__all__ = ['baseImageObject', 'imageObject', 'WCSObject']
+__all__ = ['baseImageObject', 'imageObject', 'WCSObject', 'ChipDataCache',
+           'chip_cache']
 
 
 IRAF_DTYPES={'float64':-64,'float32':-32,'uint8':8,'int16':16,'int32':32}
 
+CHIP_CACHE_MB = 512 # default memory budget of the chip data cache
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 
+class ChipDataCache(object):
+    """ Least-recently-used cache of chip data arrays shared by all
+    imageObjects in a process.
+
+    Arrays are keyed by ``(file, extname, extver, mtime, size)`` so that
+    an array is re-read as soon as the file it came from gets modified.
+    Data in FITS files which do not require scaling (no ``BSCALE``/``BZERO``)
+    are memory-mapped instead of being read into memory. Arrays returned by
+    the cache are read-only; callers which need to modify the data in place
+    must work on a copy.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum number of bytes held by the cache. Least recently used arrays
+        are released when this budget is exceeded. A value of 0 disables
+        caching (arrays are still read, but not retained).
+
+    """
+    def __init__(self, max_bytes=CHIP_CACHE_MB * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __str__(self):
+        return ("Chip data cache: {:d} hits, {:d} misses, {:d} arrays "
+                "({:.1f} MB of {:.1f} MB)".format(
+                    self.hits, self.misses, len(self._arrays),
+                    self.nbytes / 2.0**20, self.max_bytes / 2.0**20))
+
+    def set_budget(self, max_mb):
+        """ Set memory budget (in MB), releasing arrays as needed. """
+        if max_mb is None:
+            max_mb = CHIP_CACHE_MB
+        with self._lock:
+            self.max_bytes = max(0, int(max_mb * 2**20))
+            self._evict()
+
+    def get(self, filename, extname, extver):
+        """ Return the (read-only) data array of extension
+        ``(extname, extver)`` of ``filename`` or `None` if the file
+        does not exist.
+        """
+        if filename is None:
+            return None
+        path = os.path.abspath(filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        key = (path, extname.upper(), int(extver), st.st_mtime, st.st_size)
+        with self._lock:
+            data = self._arrays.pop(key, None)
+            if data is not None:
+                # re-insert as the most recently used array:
+                self._arrays[key] = data
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        data = self._read(path, extname, extver)
+        if data is None:
+            return None
+        data = data.view()
+        data.flags.writeable = False
+
+        with self._lock:
+            # drop arrays read from earlier versions of the same file:
+            for k in [k for k in self._arrays if k[:3] == key[:3]]:
+                self.nbytes -= self._arrays.pop(k).nbytes
+            if key not in self._arrays and data.nbytes <= self.max_bytes:
+                self._arrays[key] = data
+                self.nbytes += data.nbytes
+                self._evict()
+
+        return data
+
+    def invalidate(self, filename=None):
+        """ Release all arrays read from ``filename``, or all arrays
+        when ``filename`` is `None`.
+        """
+        path = None if filename is None else \
+            os.path.abspath(fileutil.parseFilename(filename)[0])
+        with self._lock:
+            for k in list(self._arrays.keys()):
+                if path is None or k[0] == path:
+                    self.nbytes -= self._arrays.pop(k).nbytes
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self._arrays and self.nbytes > self.max_bytes:
+            self.nbytes -= self._arrays.popitem(last=False)[1].nbytes
+
+    def _read(self, path, extname, extver):
+        exten = '{:s},{:d}'.format(extname, int(extver))
+
+        if path.lower().endswith(('.fits', '.fit')):
+            with fits.open(path, memmap=True) as hdulist:
+                hdu = fileutil.getExtn(hdulist, extn=exten)
+                hdr = hdu.header
+                if (not isinstance(hdu, fits.CompImageHDU) and
+                    hdr.get('BSCALE', 1) == 1 and hdr.get('BZERO', 0) == 0):
+                    # the array stays mapped after the file gets closed:
+                    return hdu.data
+
+        _image = fileutil.openImage(path, clobber=False, memmap=False)
+        try:
+            _data = fileutil.getExtn(_image, extn=exten).data
+        finally:
+            _image.close()
+        return _data
+
+
+# cache of chip data arrays shared by all imageObjects:
+chip_cache = ChipDataCache()
+
+
 class baseImageObject(object):
     """ Base ImageObject which defines the primary set of methods.
     """
@@ -52,6 +184,8 @@ class baseImageObject(object):
         self.createContext = True
 
         self.inmemory = False # flag for all in-memory operations
+        # bit-packed combined masks (see getCombinedMask)
+        self._maskCache = {}
         #this is the number of science chips to be processed in the file
         self._numchips=1
         self._nextend=0
@@ -140,16 +274,22 @@ class baseImageObject(object):
         log.info('Removing intermediate files for %s' % self._filename)
         # We need to remove the combined products first; namely, median image
         util.removeFileSafely(self.outputNames['outMedian'])
+        rawfile.remove(self.outputNames['outMedian'])
         # Now remove chip-specific intermediate files, if any were created.
         for chip in self.returnAllChips(extname='SCI'):
             for fname in clean_files:
                 if fname in chip.outputNames:
                     util.removeFileSafely(chip.outputNames[fname])
+                    rawfile.remove(chip.outputNames[fname])
 
     def getData(self,exten=None):
         """ Return just the data array from the specified extension
             fileutil is used instead of fits to account for non-
             FITS input images. openImage returns a fits object.
+
+            Unless a data array has been attached to the extension in
+            memory, data are read through the pipeline-wide `chip_cache`
+            and the returned array is read-only.
         """
         if exten.lower().find('sci') > -1:
             # For SCI extensions, the current file will have the data
@@ -164,19 +304,14 @@ class baseImageObject(object):
             fname = sci_chip.dqfile
 
         extnum = self._interpretExten(exten)
-        if self._image[extnum].data is None:
-            if os.path.exists(fname):
-                _image=fileutil.openImage(fname, clobber=False, memmap=False)
-                _data=fileutil.getExtn(_image, extn=exten).data
-                _image.close()
-                del _image
-                self._image[extnum].data = _data
-            else:
-                _data = None
-        else:
-            _data = self._image[extnum].data
+        hdu = self._image[extnum]
+        # Do not trigger (and keep) a full read of the data through the
+        # HDU: only use data explicitly attached to it in memory.
+        if 'data' in hdu.__dict__ and hdu.data is not None:
+            return hdu.data
 
-        return _data
+        extname, extver = exten.split(',')
+        return chip_cache.get(fname, extname, int(extver))
 
     def getHeader(self,exten=None):
         """ Return just the specified header extension fileutil
@@ -218,6 +353,7 @@ class baseImageObject(object):
         fimg[_extnum].data = data
         fimg[_extnum].header = self._image[_extnum].header
         fimg.close()
+        chip_cache.invalidate(self._filename)
 
     def putData(self,data=None,exten=None):
         """ Now that we are removing the data from the object to save memory,
@@ -730,6 +866,56 @@ class baseImageObject(object):
         del dqarr
         return dqmask
 
+    def getCombinedMask(self, chip, bits=0, staticmask=None, crmask=None):
+        """
+        Return the mask built from the DQ array of a chip (see `buildMask`)
+        combined with the static and cosmic-ray masks, if any.
+
+        Combined masks are kept bit-packed on this object and reused by
+        all processing steps. They are keyed by chip, ``bits`` and the
+        versions of the DQ array, static mask and CR mask, so that a new
+        mask gets built as soon as any of them changes (for instance, when
+        the CR flags get added to the DQ array of the input image).
+
+        Parameters
+        ----------
+        chip : int
+            Chip (``EXTVER``) number.
+
+        bits : int
+            DQ bit flags to be considered "good".
+
+        staticmask, crmask : str, astropy.io.fits.HDUList, None
+            File name or in-memory (virtual) FITS object of the static
+            and cosmic-ray masks to be combined with the DQ mask.
+
+        Returns
+        -------
+        mask : numpy.ndarray
+            A new `numpy.uint8` array: 1 for good pixels, 0 for bad ones.
+
+        """
+        sci_chip = self._image[self.scienceExt,chip]
+        dqversion = buildmask.maskVersion(sci_chip.dqfile)
+        key = (chip, bits, buildmask.maskVersion(staticmask),
+               buildmask.maskVersion(crmask))
+
+        cached = self._maskCache.get(key)
+        if cached is not None and cached[0] == dqversion:
+            return cached[1].unpack(dtype=np.uint8)
+
+        dqmask = self.buildMask(chip, bits=bits)
+        buildmask.mergeDQarray(staticmask, dqmask)
+        buildmask.mergeDQarray(crmask, dqmask)
+
+        # drop masks built from earlier versions of the DQ array:
+        for k in [k for k, v in self._maskCache.items() if v[0] != dqversion
+                  and k[0] == chip]:
+            del self._maskCache[k]
+        self._maskCache[key] = (dqversion, buildmask.PackedMask(dqmask))
+
+        return dqmask
+
     def buildEXPmask(self, chip, dqarr):
         """ Builds a weight mask from an input DQ array and the exposure time
         per pixel for this chip.
@@ -738,9 +924,10 @@ class baseImageObject(object):
                  chip)
         #exparr = self.getexptimeimg(chip)
         exparr = self._image[self.scienceExt,chip]._exptime
-        expmask = exparr*dqarr
+        expmask = dqarr.astype(np.float32)
+        expmask *= exparr
 
-        return expmask.astype(np.float32)
+        return expmask
 
     def buildIVMmask(self ,chip, dqarr, scale):
         """ Builds a weight mask from an input DQ array and either an IVM array
@@ -1027,11 +1214,13 @@ class imageObject(baseImageObject):
         self._isSimpleFits = False
 
         # Clean out any stray MDRIZSKY keywords from PRIMARY headers
-        fimg = fileutil.openImage(filename, mode='update', memmap=False)
-        if 'MDRIZSKY' in fimg['PRIMARY'].header:
-            del fimg['PRIMARY'].header['MDRIZSKY']
-        fimg.close()
-        del fimg
+        # (only reopen the file for update when there is one to remove)
+        if 'MDRIZSKY' in self._image['PRIMARY'].header:
+            fimg = fileutil.openImage(filename, mode='update', memmap=False)
+            if 'MDRIZSKY' in fimg['PRIMARY'].header:
+                del fimg['PRIMARY'].header['MDRIZSKY']
+            fimg.close()
+            del fimg
 
         if group not in [None,'']:
             # Only use selected chip
@@ -1151,9 +1340,9 @@ class imageObject(baseImageObject):
                         sci_chip.image_dtype = dtype
                         break
 
-                if self.inmemory:
-                    # read image data array into memory
-                    shape = sci_chip.data.shape
+                # Image data are not read here: only headers are needed to
+                # set up the chip. Data get read on first use by getData(),
+                # through the chip data cache.
 
 
     def setInstrumentParameters(self,instrpars):
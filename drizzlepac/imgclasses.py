@@ -34,6 +34,7 @@ except ImportError:
     from stsci.tools.bitmask import interpret_bits_value as interpret_bit_flags
 
 from . import catalogs
+from . import catcache
 from . import linearfit
 from . import updatehdr
 from . import util
@@ -167,6 +168,7 @@ class Image(object):
                 extnum = 0
             chip_filenames[sci_extn] = "{:s}[{:d}]".format(self.filename, extnum)
 
+        chips = []
         for sci_extn in range(1,self.nvers+1):
             chip_filename = chip_filenames[sci_extn]
             wcs = stwcs.wcsutil.HSTWCS(chip_filename)
@@ -185,7 +187,6 @@ class Image(object):
             else:
                 excludefile = None
 
-            kwargs['start_id'] = self.num_sources
             catalog = catalogs.generateCatalog(wcs, mode=catalog_mode,
                         catalog=source, src_find_filters=excludefile, **kwargs)
 
@@ -216,7 +217,28 @@ class Image(object):
                             "DQ mask WILL NOT be used for source finding.",
                             indent = 5), file=sys.stderr)
 
+            chips.append((sci_extn, wcs, source, catalog, mask))
+
+        # find sources in all chips with a single pool of processes:
+        image_catalogs = [(c[3], c[4]) for c in chips
+                          if isinstance(c[3], catalogs.ImageCatalog)]
+        if image_catalogs:
+            cache_dir = kwargs.get('catalog_cache')
+            if util.is_blank(cache_dir):
+                cache = None
+            else:
+                cache = catcache.CatalogCache(
+                    cache_dir,
+                    kwargs.get('catalog_cache_mb', catcache.CACHE_MB)
+                )
+            catalogs.findImageSources(*zip(*image_catalogs),
+                                      tile_size=kwargs.get('tile_size'),
+                                      num_cores=kwargs.get('num_cores'),
+                                      cache=cache)
+
+        for sci_extn, wcs, source, catalog, mask in chips:
             # read in and convert all catalog positions to RA/Dec
+            catalog.start_id = self.num_sources
             catalog.buildCatalogs(exclusions=None, mask=mask)
 
             self.num_sources += catalog.num_objects
@@ -517,6 +539,23 @@ class Image(object):
             if matchpars['searchunits'] == 'arcseconds':
                 radius /= refWCS.pscale
 
+            # Only reference sources close to the sources of this image can
+            # be matched (or contribute to the 2D histogram of offsets):
+            maxoff = radius
+            for key in ['xoffset', 'yoffset']:
+                if not util.is_blank(matchpars[key]):
+                    maxoff = max(maxoff, abs(matchpars[key]))
+            margin = (maxoff + max(matchpars['tolerance'], 1.5) +
+                      matchpars['separation'] + 1.0)
+            ref_sel = refimage.select_sources(self.outxy, margin)
+            if ref_sel.size < ref_outxy.shape[0]:
+                log.info("Using {:d} of {:d} reference sources near the "
+                         "sources of '{}'."
+                         .format(ref_sel.size, ref_outxy.shape[0], self.name))
+                ref_outxy = ref_outxy[ref_sel]
+            else:
+                ref_sel = None
+
             # Determine xyoff (X,Y offset) and tolerance to be used with xyxymatch
             use2d = matchpars['use2dhist']
             xyxysep = matchpars['separation']
@@ -528,7 +567,8 @@ class Image(object):
                                     ref_outxy,searchrad=radius,
                                     histplot=matchpars['see2dplot'],
                                     interactive=self.interactive,
-                                    figure_id = self.figure_id, plotname=hist_name)
+                                    figure_id = self.figure_id, plotname=hist_name,
+                                    num_cores=self.pars.get('num_cores'))
                 if matchpars['see2dplot'] and ('residplot' in matchpars and
                                                'No' in matchpars['residplot']):
                     if self.interactive:
@@ -568,8 +608,17 @@ class Image(object):
                 # set tolerance based on user-specified input
                 xyxytolerance = matchpars['tolerance']
 
-            matches = xyxymatch(self.outxy,ref_outxy,origin=xyoff,
-                                tolerance=xyxytolerance,separation=xyxysep)
+            if matchpars.get('matchmethod', 'xyxymatch') == 'kdtree':
+                matches = tweakutils.tree_xyxymatch(
+                    self.outxy, ref_outxy, origin=xyoff,
+                    tolerance=xyxytolerance, separation=xyxysep
+                )
+            else:
+                matches = xyxymatch(self.outxy,ref_outxy,origin=xyoff,
+                                    tolerance=xyxytolerance,separation=xyxysep)
+            if ref_sel is not None and len(matches) > 0:
+                # convert to indices in the full reference catalog:
+                matches['ref_idx'] = ref_sel[matches['ref_idx']]
 
             if len(matches) > minobj:
                 self.matches['image'] = np.column_stack([matches['input_x'][:,
@@ -593,30 +642,35 @@ class Image(object):
                 print('Found %d matches for %s...'%(len(matches),self.name))
 
                 if self.pars['writecat']:
-                    matchfile = open(self.catalog_names['match'],mode='w+')
-                    matchfile.write('#Reference: %s\n'%refname)
-                    matchfile.write('#Input: %s\n'%self.name)
                     title = '#Ref_X        Ref_Y        '
                     title += 'Input_X    Input_Y        '
                     title += 'Ref_X0    Ref_Y0        '
                     title += 'Input_X0    Input_Y0        '
                     title += 'Ref_ID    Input_ID        '
                     title += 'Ref_Source\n'
-                    fmtstr = '%0.6f    %0.6f        '*4
-                    fmtstr += '%d    %d    %s\n'
-                    matchfile.write(title)
-                    for i in range(len(matches['input_x'])):
-                        linestr = fmtstr%\
-                            (matches['ref_x'][i],matches['ref_y'][i],\
-                             matches['input_x'][i],matches['input_y'][i],
-                            self.matches['ref_orig_xy'][:,0][i],
-                            self.matches['ref_orig_xy'][:,1][i],
-                            self.matches['img_orig_xy'][:,0][i],
-                            self.matches['img_orig_xy'][:,1][i],
-                            matches['ref_idx'][i],matches['input_idx'][i],
-                            self.matches['src_origin'][i])
-                        matchfile.write(linestr)
-                    matchfile.close()
+                    cols = [matches['ref_x'], matches['ref_y'],
+                            matches['input_x'], matches['input_y'],
+                            self.matches['ref_orig_xy'][:,0],
+                            self.matches['ref_orig_xy'][:,1],
+                            self.matches['img_orig_xy'][:,0],
+                            self.matches['img_orig_xy'][:,1]]
+                    seps = ['    ', '        ']*4
+                    # format all rows at once, column by column:
+                    lines = np.char.mod('%0.6f', np.asarray(cols[0]))
+                    for col, sep in zip(cols[1:], seps[:-1]):
+                        lines = np.char.add(np.char.add(lines, sep),
+                                            np.char.mod('%0.6f', np.asarray(col)))
+                    for col, fmt, sep in [(matches['ref_idx'], '%d', seps[-1]),
+                                          (matches['input_idx'], '%d', '    '),
+                                          (self.matches['src_origin'], '%s', '    ')]:
+                        lines = np.char.add(np.char.add(lines, sep),
+                                            np.char.mod(fmt, np.asarray(col)))
+                    with open(self.catalog_names['match'], mode='w+') as matchfile:
+                        matchfile.write('#Reference: %s\n'%refname)
+                        matchfile.write('#Input: %s\n'%self.name)
+                        matchfile.write(title)
+                        if len(lines) > 0:
+                            matchfile.write('\n'.join(lines) + '\n')
             else:
                 warnstr = textutil.textbox('WARNING: \n'+
                     'Not enough matches (< %d) found for input image: %s'%(minobj,self.name))
@@ -1078,6 +1132,34 @@ class Image(object):
                         os.remove(extn)
 
 
+class _GrowingArray(object):
+    """ Array that can be extended along its first axis in amortized
+        constant time: its capacity is doubled whenever it is exceeded.
+    """
+    def __init__(self, data):
+        data = np.asarray(data)
+        self._data = data.copy()
+        self.size = data.shape[0]
+
+    @property
+    def array(self):
+        """ View of the elements of the array. """
+        return self._data[:self.size]
+
+    def append(self, values):
+        values = np.asarray(values)
+        n = values.shape[0]
+        dtype = np.result_type(self._data, values)
+        if self.size + n > self._data.shape[0] or dtype != self._data.dtype:
+            capacity = max(self.size + n, 2 * self._data.shape[0])
+            data = np.empty((capacity,) + self._data.shape[1:], dtype=dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:self.size + n] = values
+        self.size += n
+        return self.array
+
+
 class RefImage(object):
     """ This class provides all the information needed by to define a reference
         tangent plane and list of source positions on the sky.
@@ -1282,6 +1364,9 @@ class RefImage(object):
                         "a string, a list, or a numpy.ndarray")
 
         self.outxy = None
+        self._yindex = None
+        self._store = None
+        self._hull_xy = None
         self.origin = 1
         if self.all_radec is not None:
             # convert sky positions to X,Y positions on reference tangent plane
@@ -1292,6 +1377,7 @@ class RefImage(object):
            self.outxy is not None:
             xy_vertices = np.asarray(convex_hull(list(map(tuple,self.outxy))),
                                      dtype=np.float64)
+            self._hull_xy = xy_vertices
             if xy_vertices.shape[0] > 2:
                 rdv = self.wcs.wcs_pix2world(xy_vertices, 1)
                 self.skyline = SphericalPolygon.from_radec(rdv[:,0], rdv[:,1])
@@ -1374,9 +1460,51 @@ class RefImage(object):
             outxy = self.wcs.wcs_world2pix(self.all_radec[0],self.all_radec[1],self.origin)
             # convert outxy list to a Nx2 array
             self.outxy = np.column_stack([outxy[0][:,np.newaxis],outxy[1][:,np.newaxis]])
+        self._yindex = None
+        self._hull_xy = None
+
+
+    def select_sources(self, xy, margin):
+        """ Return indices (in increasing order) of reference sources whose
+        X,Y positions in the reference tangent plane lie within ``margin``
+        of the bounding box of positions ``xy``.
+
+        Reference sources are indexed by their Y positions (sorted once
+        until the reference catalog changes), so that only sources in the
+        range of Y positions of ``xy`` need to be checked.
+
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape((-1, 2))
+        xy = xy[np.all(np.isfinite(xy), axis=1)]
+        if xy.shape[0] == 0:
+            return np.zeros(0, dtype=np.intp)
+        xmin, ymin = xy.min(axis=0) - margin
+        xmax, ymax = xy.max(axis=0) + margin
+
+        if self._yindex is None:
+            order = np.argsort(self.outxy[:, 1], kind='mergesort')
+            self._yindex = (order, self.outxy[order, 1])
+        order, ysorted = self._yindex
+
+        # NaN positions are sorted last and are never selected:
+        i1 = np.searchsorted(ysorted, ymin, side='left')
+        i2 = np.searchsorted(ysorted, ymax, side='right')
+        idx = order[i1:i2]
+        x = self.outxy[idx, 0]
+        return np.sort(idx[(x >= xmin) & (x <= xmax)])
 
 
     def append_not_matched_sources(self, image):
+        """ Append sources of ``image`` that were not matched to the
+        reference catalog and update the footprint of the reference catalog.
+
+        Reference source columns are kept in arrays whose capacity is
+        doubled as needed and the convex hull of reference sources is
+        updated from its previous vertices and the new sources only,
+        so that expanding the reference catalog with many images takes
+        linear time.
+
+        """
         assert(hasattr(image, 'fit') and hasattr(image, 'matches'))
         if not image.goodmatch or image.identityfit:
             return
@@ -1401,31 +1529,53 @@ class RefImage(object):
         # convert to RA & DEC:
         new_radec = self.wcs.wcs_pix2world(new_outxy, 1)
 
-        self.outxy = np.append(self.outxy, new_outxy, 0)
+        # (re)create growing arrays if reference source columns have been
+        # replaced since the last update:
+        columns = [self.outxy] + list(self.all_radec) + list(self.xy_catalog)
+        if self._store is None or len(columns) != len(self._store[0]) or \
+           any(c is not v for c, v in zip(columns, self._store[0])):
+            self._store = (columns, [_GrowingArray(c) for c in columns])
+        store = self._store[1]
+        nradec = len(self.all_radec)
+
         id1 = self.all_radec[3][-1] + 1
-        id2 = id1 + len(self.all_radec[3])
-        self.all_radec = [np.append(self.all_radec[0], new_radec[:,0], 0),
-                          np.append(self.all_radec[1], new_radec[:,1], 0),
-                          np.append(self.all_radec[2], image.all_radec[2][not_matched_mask], 0),
-                          np.append(self.all_radec[3], np.arange(id1,id2), 0)]
-
-        # Append original image coordinates:
-        self.xy_catalog[0] = np.append(self.xy_catalog[0],
-            np.asarray(image.xy_catalog[0])[not_matched_mask], 0)
-        self.xy_catalog[1] = np.append(self.xy_catalog[1],
-            np.asarray(image.xy_catalog[1])[not_matched_mask], 0)
+        id2 = id1 + adding_nsources
+        new_columns = [new_outxy, new_radec[:,0], new_radec[:,1],
+                       image.all_radec[2][not_matched_mask],
+                       np.arange(id1,id2)]
+
+        # Append original image coordinates, source properties
+        # (zeros when not available in the image catalog) and origin:
         ncol = len(self.xy_catalog)
-        self.use_sharp_round
-        for i,col in enumerate(image.xy_catalog[2:-1]):
-            i2 = i + 2
-            if i2 < ncol-1:
-                self.xy_catalog[i2] = np.append(self.xy_catalog[i2], col, 0)
-        self.xy_catalog[-1] = np.append(self.xy_catalog[-1],
-                                        np.asarray(image.xy_catalog[-1])[not_matched_mask], 0)
+        for i, buf in enumerate(store[1 + nradec:]):
+            if i < 2 or i == ncol - 1:
+                col = image.xy_catalog[i if i < 2 else -1]
+            elif i < len(image.xy_catalog) - 1:
+                col = image.xy_catalog[i]
+            else:
+                new_columns.append(np.zeros(adding_nsources,
+                                            dtype=buf.array.dtype))
+                continue
+            new_columns.append(np.asarray(col)[not_matched_mask])
+
+        columns = [buf.append(c) for buf, c in zip(store, new_columns)]
+        self._store = (columns, store)
+
+        self.outxy = columns[0]
+        self.all_radec = columns[1:1 + nradec]
+        self.xy_catalog[:] = columns[1 + nradec:]
+        self._yindex = None
 
         #self.skyline = self.skyline.union(skyline)
-        xy_vertices = np.asarray(convex_hull(list(map(tuple,self.outxy))),
+        # the convex hull of all sources is the convex hull of the vertices
+        # of the previous hull and of the new sources:
+        if self._hull_xy is None:
+            hull_points = self.outxy
+        else:
+            hull_points = np.concatenate([self._hull_xy, new_outxy])
+        xy_vertices = np.asarray(convex_hull(list(map(tuple,hull_points))),
                                  dtype=np.float64)
+        self._hull_xy = xy_vertices
         rdv = self.wcs.wcs_pix2world(xy_vertices, 1)
         self.skyline = SphericalPolygon.from_radec(rdv[:,0], rdv[:,1])
         if IMGCLASSES_DEBUG:
@@ -8,10 +8,15 @@ This module manages the creation of the output image FITS file.
 """
 from __future__ import absolute_import, division, print_function # confidence medium
 
+import os
+import threading
+
 from astropy.io import fits
 from stsci.tools import fileutil, readgeis, logutil
 
 from . import wcs_functions
+from . import asyncwriter
+from . import rawfile
 from . import version
 
 from fitsblender import blendheaders
@@ -50,6 +55,10 @@ DRIZ_KEYWORDS = {
                 'WKEY':{'value':"",'comment':'Input image WCS Version used'}
                 }
 
+# Header templates built by getTemplates(): {key: (newhdrs, newtab)}
+_template_cache = {}
+_template_lock = threading.Lock()
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 
@@ -180,6 +189,11 @@ class OutputImage:
         headers.
 
         The arrays will have the size specified by 'shape'.
+
+        Unless 'virtual' is True, the files are written to disk by the
+        background writer (see `asyncwriter`), which takes ownership of the
+        arrays: callers must not modify them after this call and must call
+        `asyncwriter.flush()` before the files are used.
         """
         if not isinstance(template, list):
             template = [template]
@@ -406,9 +420,8 @@ class OutputImage:
 
             if not virtual:
                 print('Writing out to disk:',self.output)
-                # write out file to disk
-                fo.writeto(self.output)
-                fo.close()
+                # hand over file to the background writer
+                asyncwriter.writeto(fo, self.output)
                 del fo, hdu
                 fo = None
             # End 'if not virtual'
@@ -458,9 +471,7 @@ class OutputImage:
                 fo.append(newtab)
 
             if not virtual:
-                print('Writing out image to disk:',self.outdata)
-                # write out file to disk
-                fo.writeto(self.outdata)
+                self._writeProduct(fo, self.outdata, sciarr, hdu.header)
                 del fo,hdu
                 fo = None
             # End 'if not virtual'
@@ -498,8 +509,8 @@ class OutputImage:
                 wcs_functions.removeAllAltWCS(fwht,wcs_ext)
 
                 if not virtual:
-                    print('Writing out image to disk:',self.outweight)
-                    fwht.writeto(self.outweight)
+                    self._writeProduct(fwht, self.outweight, whtarr,
+                                       hdu.header)
                     del fwht,hdu
                     fwht = None
                 # End 'if not virtual'
@@ -539,8 +550,8 @@ class OutputImage:
                 # remove all alternate WCS solutions from headers of this product
                 wcs_functions.removeAllAltWCS(fctx,wcs_ext)
                 if not virtual:
-                    print('Writing out image to disk:',self.outcontext)
-                    fctx.writeto(self.outcontext)
+                    self._writeProduct(fctx, self.outcontext, _ctxarr,
+                                       hdu.header)
                     del fctx,hdu
                     fctx = None
                 # End 'if not virtual'
@@ -549,6 +560,24 @@ class OutputImage:
 
         return outputFITS
 
+    def _writeProduct(self, fobj, fname, data, header):
+        """ Hand over a simple FITS product to the background writer.
+
+        Single-drizzled and blotted images are saved as raw files instead
+        when intermediate products are kept in raw format (see `rawfile`);
+        their FITS files then get written only if intermediate products
+        are not removed at the end of processing.
+        """
+        if (self.single or self.blot) and rawfile.enabled():
+            rawfile.write(fname, data, header)
+            if not rawfile.keep_fits():
+                fobj.close()
+                return
+        else:
+            rawfile.remove(fname)
+        print('Writing out image to disk:',fname)
+        asyncwriter.writeto(fobj, fname)
+
     def find_kwupdate_location(self,hdr,keyword):
         """
         Find the last keyword in the output header that comes before the new
@@ -679,11 +708,46 @@ def cleanTemplates(scihdr,errhdr,dqhdr):
                 if keyword not in dqhdr:
                     dqhdr[keyword]= scihdr[keyword]
 
+def _templateKey(fnames, blend):
+    """ Key of the header templates built from ``fnames``: the input file
+        list, the blending rules and the version of each input file,
+        so that templates get rebuilt whenever input headers are updated.
+    """
+    if not blend:
+        # only the headers of the first input are used
+        fnames = fnames[:1]
+    versions = []
+    for fname in fnames:
+        try:
+            st = os.stat(fileutil.parseFilename(fname)[0])
+            versions.append((st.st_mtime, st.st_size))
+        except (OSError, TypeError):
+            versions.append(None)
+    return (tuple(fnames), bool(blend), tuple(versions))
+
+
+def _copyTemplates(newhdrs, newtab):
+    newhdrs = [None if hdr is None else hdr.copy() for hdr in newhdrs]
+    if newtab is not None:
+        newtab = newtab.copy()
+    return newhdrs, newtab
+
+
 def getTemplates(fnames, blend=True):
     """ Process all headers to produce a set of combined headers
         that follows the rules defined by each instrument.
 
+        Templates are built only once for each list of input files and
+        blending rules, and are shared by all `OutputImage` instances
+        (see `clearTemplateCache`). Callers get copies that they can modify.
+
     """
+    key = _templateKey(fnames, blend)
+    with _template_lock:
+        cached = _template_cache.get(key)
+    if cached is not None:
+        return _copyTemplates(*cached)
+
     if not blend:
         newhdrs =  blendheaders.getSingleTemplate(fnames[0])
         newtab = None
@@ -693,7 +757,16 @@ def getTemplates(fnames, blend=True):
 
     cleanTemplates(newhdrs[1],newhdrs[2],newhdrs[3])
 
-    return newhdrs, newtab
+    with _template_lock:
+        _template_cache[key] = (newhdrs, newtab)
+
+    return _copyTemplates(newhdrs, newtab)
+
+
+def clearTemplateCache():
+    """ Release all header templates built by `getTemplates`. """
+    with _template_lock:
+        _template_cache.clear()
 
 def addWCSKeywords(wcs,hdr,blot=False,single=False,after=None):
     """ Update input header 'hdr' with WCS keywords.
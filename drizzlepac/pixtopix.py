@@ -135,14 +135,8 @@ def tran(inimage,outimage,direction='forward',x=None,y=None,
         # Determine columns which contain pixel positions
         cols = util.parse_colnames(colnames,coordfile)
         # read in columns from input coordinates file
-        xyvals = np.loadtxt(coordfile,usecols=cols,delimiter=separator)
-        if xyvals.ndim == 1: # only 1 entry in coordfile
-            xlist = [xyvals[0].copy()]
-            ylist = [xyvals[1].copy()]
-        else:
-            xlist = xyvals[:,0].copy()
-            ylist = xyvals[:,1].copy()
-        del xyvals
+        xlist, ylist = util.readcols(coordfile, cols=cols[:2],
+                                     delimiter=separator)
     else:
         if isinstance(x,np.ndarray):
             xlist = x.tolist()
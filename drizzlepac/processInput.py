@@ -54,6 +54,9 @@ from . import wcs_functions
 from . import util
 from . import resetbits
 from . import mdzhandler
+from . import imageObject
+from . import asyncwriter
+from . import rawfile
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -62,6 +65,7 @@ parallel_steps = [(3,'driz_separate'),(6,'driz_cr')]
 
 if util.can_parallel:
     import multiprocessing
+    from multiprocessing.pool import ThreadPool
 
 
 def setCommonInput(configObj, createOutwcs=True):
@@ -195,10 +199,21 @@ def setCommonInput(configObj, createOutwcs=True):
     else:
         virtual = False
 
+    # memory budget for chip data shared by all imageObjects
+    imageObject.chip_cache.set_budget(configObj.get('chip_cache_mb'))
+    # memory budget for output data waiting to be written to disk
+    asyncwriter.set_budget(configObj.get('write_buffer_mb'))
+    # format of intermediate products
+    rawfile.configure(
+        configObj.get('intermediate_format'),
+        keep_fits=not configObj.get('STATE OF INPUT FILES', {}).get('clean')
+    )
+
     imageObjectList = createImageObjectList(files, instrpars,
                                             group=configObj['group'],
                                             undistort=undistort,
-                                            inmemory=virtual)
+                                            inmemory=virtual,
+                                            num_cores=configObj.get('num_cores'))
 
     # Add original file names as "hidden" attributes of imageObject
     assert(len(original_files) == len(imageObjectList)) #TODO: remove after extensive testing
@@ -328,16 +343,41 @@ def checkMultipleFiles(input):
     return len(f) > 1
 
 def createImageObjectList(files,instrpars,group=None,
-                            undistort=True, inmemory=False):
+                            undistort=True, inmemory=False, num_cores=None):
     """ Returns a list of imageObject instances, 1 for each input image in the list of input filenames.
+
+    Input files are opened (only their headers are read) and their WCS
+    are set up concurrently using up to ``num_cores`` threads.
+    Instrument parameters are applied to each image in input order.
     """
+    pool_size = util.get_pool_size(num_cores, len(files))
+    if pool_size > 1:
+        log.info('Setting up {:d} input images using {:d} threads.'
+                 .format(len(files), pool_size))
+        pool = ThreadPool(pool_size)
+        try:
+            images = pool.map(lambda img: _getInputImage(img,group=group),
+                              files)
+            # 'instrpars' may get updated by each image (in input order):
+            for image in images:
+                image.setInstrumentParameters(instrpars)
+            pool.map(lambda image: image.compute_wcslin(undistort=undistort),
+                     images)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        images = []
+        for img in files:
+            image = _getInputImage(img,group=group)
+            image.setInstrumentParameters(instrpars)
+            image.compute_wcslin(undistort=undistort)
+            images.append(image)
+
     imageObjList = []
     mtflag = False
     mt_refimg = None
-    for img in files:
-        image = _getInputImage(img,group=group)
-        image.setInstrumentParameters(instrpars)
-        image.compute_wcslin(undistort=undistort)
+    for image in images:
         if 'MTFLAG' in image._image['PRIMARY'].header:
             # check to see whether we are dealing with moving target observations...
             _keyval = image._image['PRIMARY'].header['MTFLAG']
@@ -831,6 +871,7 @@ def resetDQBits(imageObjectList, cr_bits_value=4096):
                 sci_chip = img._image[img.scienceExt,chip]
                 resetbits.reset_dq_bits(sci_chip.dqfile, cr_bits_value,
                                         extver=chip, extname=sci_chip.dq_extn)
+                imageObject.chip_cache.invalidate(sci_chip.dqfile)
 
 
 def update_member_names(oldasndict, pydr_input):
@@ -11,66 +11,126 @@ IS RETURNED BY :py:func:`quickderiv`.
 #
 # VERSION:
 #   Version 0.1.0: created -- CJH
+#   Version 0.2.0: compute in single precision (when the input allows it)
+#       using preallocated arrays and in-place operations; optionally
+#       process sections of rows in separate threads.
 #
 from __future__ import absolute_import, division # confidence high
 
 from .version import *
 # IMPORT EXTERNAL MODULES
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
-def qderiv(array): # TAKE THE ABSOLUTE DERIVATIVE OF A NUMARRY OBJECT
-    """Take the absolute derivate of an image in memory."""
+DERIV_TILE_NROWS = 512  # number of rows processed by each thread at a time
+
+
+def qderiv(array, nthreads=1, tile_nrows=DERIV_TILE_NROWS): # TAKE THE ABSOLUTE DERIVATIVE OF A NUMARRY OBJECT
+    """Take the absolute derivate of an image in memory.
+
+    For each pixel, the output is the maximum absolute difference between
+    the pixel and its four nearest neighbors along rows and columns.
+    Neighbors that fall outside the shifted region (the image borders)
+    are taken to be zero, as in the original implementation.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        2-D input image.
 
-    #Create 2 empty arrays in memory of the same dimensions as 'array'
-    tmpArray = np.zeros(array.shape,dtype=np.float64)
-    outArray = np.zeros(array.shape, dtype=np.float64)
+    nthreads : int
+        Number of threads used to process sections of ``tile_nrows``
+        image rows in parallel.
+
+    tile_nrows : int
+        Number of image rows in each section processed by a thread.
+
+    Returns
+    -------
+    outArray : numpy.ndarray
+        A `numpy.float32` array with the absolute derivative of ``array``.
+
+    """
+    # Differences of single precision values are computed exactly as
+    # in double precision followed by rounding to single precision:
+    dtype = np.promote_types(array.dtype, np.float32)
+    outArray = np.zeros(array.shape, dtype=dtype)
 
     # Get the length of an array side
     (naxis1,naxis2) = array.shape
-    #print "The input image size is (",naxis1,",",naxis2,")."
-
-#Main derivate loop:
-    #Shift images +/- 1 in Y.
-    for y in range(-1,2,2):
-        if y == -1:
-            #shift input image 1 pixel right
-            tmpArray[0:(naxis1-1),1:(naxis2-1)] = array[0:(naxis1-1),0:(naxis2-2)]
-            #print "Y shift = 1"
-        else:
-            #shift input image 1 pixel left
-            tmpArray[0:(naxis1-1),0:(naxis2-2)] = array[0:(naxis1-1),1:(naxis2-1)]
-            #print "Y shift = -1"
-        #print "call _absoluteSubtract()"
-        (tmpArray,outArray) = _absoluteSubtract(array,tmpArray,outArray)
-
-    #Shift images +/- 1 in X.
-    for x in range(-1,2,2):
-        if x == -1:
-            #shift input image 1 pixel right
-            tmpArray[1:(naxis1-1),0:(naxis2-1)] = array[0:(naxis1-2),0:(naxis2-1)]
-            #print "X shift = 1"
-        else:
-            #shift input image 1 pixel left
-            tmpArray[0:(naxis1-2),0:(naxis2-1)] = array[1:(naxis1-1),0:(naxis2-1)]
-            #print "X shift = -1"
-        #print "call _absoluteSubtract()"
-        (tmpArray,outArray) = _absoluteSubtract(array,tmpArray,outArray)
-
-
-
-    return outArray.astype(np.float32)
-
-
-def _absoluteSubtract(array,tmpArray,outArray):
-    #subtract shifted image from imput image
-    tmpArray = array - tmpArray
-    #take the absolute value of tmpArray
-    tmpArray = np.fabs(tmpArray)
-    #save maximum value of outArray or tmpArray and save in outArray
-    outArray = np.maximum(tmpArray,outArray)
-    #zero out tmpArray before reuse
-    tmpArray = tmpArray * 0.
-
-    return (tmpArray,outArray)
+
+    # (destination, source) slices of the input image shifted +/- 1 in Y
+    # and +/- 1 in X:
+    shifts = [
+        ((slice(0, naxis1-1), slice(1, naxis2-1)),
+         (slice(0, naxis1-1), slice(0, naxis2-2))),
+        ((slice(0, naxis1-1), slice(0, naxis2-2)),
+         (slice(0, naxis1-1), slice(1, naxis2-1))),
+        ((slice(1, naxis1-1), slice(0, naxis2-1)),
+         (slice(0, naxis1-2), slice(0, naxis2-1))),
+        ((slice(0, naxis1-2), slice(0, naxis2-1)),
+         (slice(1, naxis1-1), slice(0, naxis2-1)))
+    ]
+
+    # Pixels not covered by a shifted image are compared with zero, that is,
+    # the absolute value of the input pixel contributes to the output.
+    # These are the rows and columns that fall outside of any of the shifts:
+    edge_rows = np.zeros(naxis1, dtype=np.bool_)
+    edge_cols = np.zeros(naxis2, dtype=np.bool_)
+    for (rows, cols), _ in shifts:
+        inside = np.zeros(naxis1, dtype=np.bool_)
+        inside[rows] = True
+        edge_rows |= ~inside
+        inside = np.zeros(naxis2, dtype=np.bool_)
+        inside[cols] = True
+        edge_cols |= ~inside
+
+    def _deriv_section(r1, r2):
+        buf = np.empty((r2 - r1, naxis2), dtype=dtype)
+        for (drows, dcols), (srows, scols) in shifts:
+            # restrict destination rows to the section [r1, r2):
+            d1, d2, _ = drows.indices(naxis1)
+            s1 = srows.indices(naxis1)[0]
+            lo = max(d1, r1)
+            hi = min(d2, r2)
+            if hi <= lo:
+                continue
+            dst = outArray[lo:hi, dcols]
+            tmp = buf[:hi - lo, :dst.shape[1]]
+            np.subtract(array[lo:hi, dcols],
+                        array[lo - d1 + s1:hi - d1 + s1, scols],
+                        out=tmp, dtype=dtype)
+            np.absolute(tmp, out=tmp)
+            np.maximum(tmp, dst, out=dst)
+
+        sec = outArray[r1:r2]
+        rows = np.flatnonzero(edge_rows[r1:r2])
+        if rows.size:
+            sec[rows] = np.maximum(
+                np.absolute(array[r1:r2][rows], dtype=dtype), sec[rows]
+            )
+        cols = np.flatnonzero(edge_cols)
+        if cols.size:
+            sec[:, cols] = np.maximum(
+                np.absolute(array[r1:r2][:, cols], dtype=dtype), sec[:, cols]
+            )
+
+    tile_nrows = max(1, int(tile_nrows))
+    sections = [(r1, min(r1 + tile_nrows, naxis1))
+                for r1 in range(0, naxis1, tile_nrows)]
+
+    if nthreads is not None and nthreads > 1 and len(sections) > 1:
+        pool = ThreadPool(min(nthreads, len(sections)))
+        try:
+            pool.map(lambda sec: _deriv_section(*sec), sections)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for r1, r2 in sections:
+            _deriv_section(r1, r2)
+
+    return outArray.astype(np.float32, copy=False)
 
 # END MODULE
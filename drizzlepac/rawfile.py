@@ -0,0 +1,141 @@
+"""
+Raw (``.npy``) storage for intermediate products that are only read back by
+AstroDrizzle itself: single-drizzled science and weight images, median
+image, blotted images and cosmic-ray masks.
+
+When enabled with the ``intermediate_format='npy'`` parameter, each of these
+products is saved as a NumPy ``.npy`` file next to the FITS file name
+assigned to the product (``j8bt06nyq_single_sci.fits`` is saved as
+``j8bt06nyq_single_sci.npy``), along with a small JSON sidecar file
+(``j8bt06nyq_single_sci.json``) holding the FITS header (including WCS
+keywords) of the product. Raw images are read back as read-only memory-mapped
+arrays without any data conversion. FITS versions of these products are
+written as well only when intermediate products are kept (``clean=False``).
+
+All functions take the FITS file name of a product. Readers use the raw
+version of a product whenever it exists. Writers remove stale raw files
+when intermediate products are saved as FITS files.
+
+:License: :doc:`LICENSE`
+
+"""
+from __future__ import (absolute_import, division, unicode_literals,
+                        print_function)
+
+import os
+import json
+
+import numpy as np
+from astropy.io import fits
+
+from .version import *
+
+__all__ = ['configure', 'enabled', 'keep_fits', 'rawName', 'exists', 'write',
+           'getdata', 'getheader', 'remove']
+
+SIDECAR_VERSION = 1
+FORMATS = ('fits', 'npy')
+
+_format = 'fits'
+_keep_fits = True
+
+
+def configure(intermediate_format=None, keep_fits=True):
+    """ Select format of intermediate products.
+
+    Parameters
+    ----------
+    intermediate_format : {'fits', 'npy'}, None
+        Format of single-drizzled, median, blotted and CR mask images.
+        `None` selects ``'fits'``.
+
+    keep_fits : bool
+        Whether FITS files should be written out in addition to the raw
+        files when ``intermediate_format`` is ``'npy'``.
+
+    """
+    global _format, _keep_fits
+    if intermediate_format is None:
+        intermediate_format = 'fits'
+    intermediate_format = intermediate_format.lower()
+    if intermediate_format not in FORMATS:
+        raise ValueError("Unsupported intermediate format '{}'"
+                         .format(intermediate_format))
+    _format = intermediate_format
+    _keep_fits = bool(keep_fits)
+
+
+def enabled():
+    """ Return `True` if intermediate products are saved as raw files. """
+    return _format == 'npy'
+
+
+def keep_fits():
+    """ Return `True` if FITS files of intermediate products must be written
+    out to disk.
+    """
+    return _format == 'fits' or _keep_fits
+
+
+def rawName(fitsname):
+    """ Return name of the raw file of a product. """
+    return os.path.splitext(fitsname)[0] + '.npy'
+
+
+def _sidecarName(fitsname):
+    return os.path.splitext(fitsname)[0] + '.json'
+
+
+def exists(fitsname):
+    """ Return `True` if there is a raw version of a product on disk. """
+    return (isinstance(fitsname, str) and
+            os.path.isfile(rawName(fitsname)) and
+            os.path.isfile(_sidecarName(fitsname)))
+
+
+def write(fitsname, data, header=None):
+    """ Save the data and header of a product as raw files.
+
+    Files are first written to temporary files which are then renamed, so
+    that readers never see partially written products.
+
+    """
+    rname = rawName(fitsname)
+    sname = _sidecarName(fitsname)
+
+    tmpname = rname[:-4] + '.tmp.npy'
+    np.save(tmpname, np.ascontiguousarray(data))
+    os.rename(tmpname, rname)
+
+    sidecar = {
+        'version': SIDECAR_VERSION,
+        'fitsname': os.path.basename(fitsname),
+        'header': '' if header is None else header.tostring()
+    }
+    tmpname = sname + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(sidecar, f)
+    os.rename(tmpname, sname)
+
+
+def getdata(fitsname):
+    """ Return the data of a raw product as a read-only memory-mapped
+    array.
+    """
+    return np.load(rawName(fitsname), mmap_mode='r')
+
+
+def getheader(fitsname):
+    """ Return the FITS header stored with a raw product. """
+    with open(_sidecarName(fitsname)) as f:
+        sidecar = json.load(f)
+    return fits.Header.fromstring(sidecar['header'])
+
+
+def remove(fitsname):
+    """ Remove raw files of a product, if any. """
+    if not isinstance(fitsname, str):
+        return
+    for fname in [rawName(fitsname), _sidecarName(fitsname)]:
+        if os.path.isfile(fname):
+            os.remove(fname)
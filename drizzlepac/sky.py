@@ -22,21 +22,37 @@ except ImportError:
 
 
 from stsci.skypac.skymatch import skymatch
-from stsci.skypac.utils import MultiFileLog, ResourceRefCount, ext2str, \
-     file_name_components, in_memory_mask, temp_mask_file, openImageEx
+from stsci.skypac.utils import MultiFileLog, ResourceRefCount, \
+     file_name_components, in_memory_mask, openImageEx
 from stsci.skypac.parseat import FileExtMaskInfo, parse_at_file
 
 from . import processInput
-import stsci.imagestats as imagestats
 import numpy as np
+from astropy.io import fits
+from stsci.imagestats import ImageStats
 
 from . import util
+from .buildmask import mergeDQarray, maskVersion
 from .version import *
 
+if util.can_parallel:
+    import multiprocessing
+
 
 __taskname__= "drizzlepac.sky" #looks in drizzlepac for sky.cfg
 _step_num_ = 2  #this relates directly to the syntax in the cfg file
 
+# 'localmin-approx' defaults: fraction of sampled pixels, maximum sky error
+# (in units of sky sigma), number of bootstrap resamplings and minimum number
+# of sampled pixels
+SKY_SAMPLE = 0.01
+SKY_TOL = 0.01
+SKY_NBOOT = 20
+SKY_MIN_SAMPLE = 1000
+
+# inputs of 'skymatch' shared with (forked) worker processes
+_skymatch_inputs = []
+
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -77,6 +93,8 @@ def sky(input=None,outExt=None,configObj=None, group=None, editpars=False, **inp
     skyclip		'Number of clipping iterations'
     skylsigma	'Lower side clipping factor (in sigma)'
     skyusigma	'Upper side clipping factor (in sigma)'
+    skysample   'Fraction of pixels sampled by the localmin-approx method'
+    skytol      'Maximum sky error (in sigma) of the localmin-approx method'
     skymask_cat 'Catalog file listing image masks'
     use_static  'Use static mask for skymatch computations?'
     sky_bits    'Integer mask bit values considered good pixels in DQ array'
@@ -199,40 +217,46 @@ def subtractSky(imageObjList,configObj,saveFile=False,procSteps=None):
         else:
             clean = True
 
-        _skymatch(imageObjList, paramDict, inmemory, clean, log)
+        if paramDict['skymethod'] == 'localmin-approx':
+            _skyApprox(imageObjList, paramDict, inmemory, clean,
+                       num_cores=configObj.get('num_cores'))
+        else:
+            _skymatch(imageObjList, paramDict, inmemory, clean, log,
+                      num_cores=configObj.get('num_cores'))
 
     if procSteps is not None:
         procSteps.endStep('Subtract Sky')
 
 
-def _skymatch(imageList, paramDict, in_memory, clean, logfile):
+def _skymatch(imageList, paramDict, in_memory, clean, logfile,
+              num_cores=None):
     # '_skymatch' converts input imageList and other parameters to
     # data structures accepted by the "skymatch" package.
-    # It also creates a temporary mask by combining 'static' mask,
-    # DQ image, and user-supplied mask. The combined mask is then
-    # passed to 'skymatch' to be used for excluding "bad" pixels.
+    # It also combines 'static' mask, DQ image, and user-supplied mask.
+    # The combined masks and the science data already cached by the
+    # image objects are handed to 'skymatch' in memory: no temporary mask
+    # files are created and input images are not reopened by 'skymatch'.
+    # 'skymatch' records computed sky values in in-memory copies of the
+    # chip headers; they are written to the input files with a single
+    # header update per file.
 
     skyKW="MDRIZSKY" #header keyword that contains the sky that's been subtracted
 
     nimg = len(imageList)
     if nimg == 0:
-        ml.logentry("Skymatch needs at least one images to perform{0}" \
-                    "sky matching. Nothing to be done.",os.linesep)
+        log.info("Skymatch needs at least one images to perform{0}" \
+                 "sky matching. Nothing to be done.".format(os.linesep))
         return
 
     # create a list of input file names as provided by the user:
     user_fnames   = []
-    loaded_fnames = []
     filemaskinfos = nimg * [ None ]
     for img in imageList:
         user_fnames.append(img._original_file_name)
-        loaded_fnames.append(img._filename)
 
     # parse sky mask catalog file (if any):
     catfile = paramDict['skymask_cat']
     if catfile:
-        #extname = imageList[0].scienceExt
-        #assert(extname is not None and extname != '')
         catfile = catfile.strip()
         mfindx = parse_at_file(fname = catfile,
                                default_ext = ('SCI','*'),
@@ -241,7 +265,7 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
                                fnamesOnly   = True,
                                doNotOpenDQ  = True,
                                match2Images = user_fnames,
-                               im_fmode     = 'update',
+                               im_fmode     = 'readonly',
                                dq_fmode     = 'readonly',
                                msk_fmode    = 'readonly',
                                logfile      = MultiFileLog(console=True),
@@ -256,7 +280,7 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
     #
     # This needs to be done in several steps, mostly due to the fact that
     # the mask catalogs use "original" (e.g., GEIS, WAIVER FITS) file names
-    # while ultimately we want to open the version converted to MEF. Second
+    # while ultimately we want to use the version converted to MEF. Second
     # reason is that we want to combine user supplied masks with DQ+static
     # masks provided by astrodrizzle.
     new_fi = []
@@ -269,20 +293,21 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
             extver = imageList[i].getExtensions()
         assert(extname is not None and extname != '')
         assert(extver)
+        extlist  = [ (extname,ev) for ev in extver ]
 
-        # create a new FileExtMaskInfo object
+        # create a new FileExtMaskInfo object holding in-memory
+        # versions of the chips:
         fi = FileExtMaskInfo(default_ext=(extname,'*'),
                              default_mask_ext=0,
                              clobber=False,
                              doNotOpenDQ=True,
                              fnamesOnly=False,
-                             im_fmode='update',
+                             im_fmode='readonly',
                              dq_fmode='readonly',
                              msk_fmode='readonly')
-
-        # set image file and extensions:
-        fi.image = loaded_fnames[i]
-        extlist  = [ (extname,ev) for ev in extver ]
+        imref = _chipImageRef(imageList[i], extlist)
+        fi.image = imref
+        imref.release()
         fi.append_ext(extlist)
 
         # set user masks if any (this will open the files for a later use):
@@ -302,10 +327,6 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
         mextlist = []
 
         for k in range(fi.count):
-            if fi.mask_images[k].closed:
-                umask = None
-            else:
-                umask = fi.mask_images[k].hdu[fi.maskext[k]].data
             (mask, mext) = _buildStaticDQUserMask(imageList[i], extlist[k],
                                sky_bits, paramDict['use_static'],
                                fi.mask_images[k], fi.maskext[k], in_memory)
@@ -317,11 +338,13 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
         # newly computed combined static+DQ+user masks:
         fi.clear_masks()
         for k in range(fi.count):
-            if in_memory and mask is not None:
+            if masklist[k] is not None and not masklist[k].can_reload_data:
                 # os.stat() on the "original_fname" of the mask will fail
                 # since this is a "virtual" mask. Therefore we need to compute
-                # mask_stat ourselves. We will simply use id(data) for this:
-                mstat = os.stat_result((0,id(mask.hdu)) + 8*(0,))
+                # mask_stat ourselves from a unique mask version number:
+                mstat = os.stat_result(
+                    (0, maskVersion(masklist[k])) + 8*(0,)
+                )
                 fi.append_mask(masklist[k], mextlist[k], mask_stat=mstat)
             else:
                 fi.append_mask(masklist[k], mextlist[k])
@@ -331,93 +354,192 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
 
         new_fi.append(fi)
 
-    # Run skymatch algorithm:
-    skymatch(new_fi,
-             skymethod   = paramDict['skymethod'],
-             skystat     = paramDict['skystat'],
-             lower       = paramDict['skylower'],
-             upper       = paramDict['skyupper'],
-             nclip       = paramDict['skyclip'],
-             lsigma      = paramDict['skylsigma'],
-             usigma      = paramDict['skyusigma'],
-             binwidth    = paramDict['skywidth'],
-             skyuser_kwd = skyKW,
-             units_kwd   = 'BUNIT',
-             readonly    = not paramDict['skysub'],
-             dq_bits     = None,
-             optimize    = 'inmemory' if in_memory else 'balanced',
-             clobber     = True,
-             clean       = clean,
-             verbose     = True,
-             flog        = MultiFileLog(console = True, enableBold = False),
-             _taskname4history = 'AstroDrizzle')
-
-    # Populate 'subtractedSky' and 'computedSky' of input image objects:
-    for i in range(nimg):
-        assert(not new_fi[i].fnamesOnly and not new_fi[i].image.closed)
-        image       = imageList[i]
-        skysubimage = new_fi[i].image.hdu
-        numchips    = image._numchips
-        extname     = image.scienceExt
-        assert(os.path.samefile(image._filename, skysubimage.filename()))
-
-        for extver in range(1,numchips+1,1):
+    skypars = dict(skymethod   = paramDict['skymethod'],
+                   skystat     = paramDict['skystat'],
+                   lower       = paramDict['skylower'],
+                   upper       = paramDict['skyupper'],
+                   nclip       = paramDict['skyclip'],
+                   lsigma      = paramDict['skylsigma'],
+                   usigma      = paramDict['skyusigma'],
+                   binwidth    = paramDict['skywidth'],
+                   skyuser_kwd = skyKW,
+                   units_kwd   = 'BUNIT',
+                   readonly    = not paramDict['skysub'],
+                   dq_bits     = None,
+                   optimize    = 'inmemory',
+                   clobber     = True,
+                   clean       = clean,
+                   verbose     = True,
+                   _taskname4history = 'AstroDrizzle')
+
+    # Run skymatch algorithm. With 'localmin' the sky of each image is
+    # independent of the other images and images are processed in parallel:
+    pool_size = 1
+    if paramDict['skymethod'] == 'localmin' and nimg > 1 and \
+       util.can_parallel and \
+       'fork' in multiprocessing.get_all_start_methods():
+        pool_size = util.get_pool_size(num_cores, nimg)
+
+    if pool_size > 1:
+        log.info('Computing sky of {:d} images with {:d} parallel workers'
+                 .format(nimg, pool_size))
+        global _skymatch_inputs
+        _skymatch_inputs = new_fi
+        try:
+            pool = multiprocessing.get_context('fork').Pool(pool_size)
+            try:
+                skyvals = pool.map(_skymatchWorker,
+                                   [(i, skypars) for i in range(nimg)])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _skymatch_inputs = []
+    else:
+        skyvals = _runSkymatch(new_fi, skypars)
+
+    # Populate 'subtractedSky' and 'computedSky' of input image objects and
+    # record computed sky values in the input files:
+    updates = []
+    for image, values in zip(imageList, skyvals):
+        extname = image.scienceExt
+        chipvals = []
+        for extver in range(1, image._numchips + 1):
             chip = image[extname,extver]
-            if not chip.group_member:
+            if not chip.group_member or extver not in values:
                 continue
-            subtracted_sky     = skysubimage[extname,extver].header[skyKW]
+            subtracted_sky     = values[extver]
             chip.subtractedSky = subtracted_sky
             chip.computedSky   = subtracted_sky
+            chipvals.append((extver, subtracted_sky, None))
+        updates.append((image, chipvals))
 
-    # clean-up:
+    # release 'skymatch' images before updating the input files:
     for fi in new_fi:
         fi.release_all_images()
 
-def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
-                           umaskext, in_memory):
-    # creates a temporary mask by combining 'static' mask,
-    # DQ image, and user-supplied mask.
+    if paramDict['skysub']:
+        for image, chipvals in updates:
+            _updateSkyKWs(image, chipvals)
+
+
+def _runSkymatch(filemaskinfos, skypars):
+    # runs 'skymatch' and returns, for each input image, a dictionary of
+    # computed sky values keyed by EXTVER of the science extensions.
+    skymatch(filemaskinfos,
+             flog = MultiFileLog(console = True, enableBold = False),
+             **skypars)
+
+    skyvals = []
+    for fi in filemaskinfos:
+        hdulist = fi.image.hdu
+        values = {}
+        for hdu in hdulist[1:]:
+            if skypars['skyuser_kwd'] in hdu.header:
+                values[hdu.ver] = hdu.header[skypars['skyuser_kwd']]
+        skyvals.append(values)
+    return skyvals
+
+
+def _skymatchWorker(args):
+    # worker process: inputs are inherited from the parent process (fork)
+    i, skypars = args
+    return _runSkymatch([_skymatch_inputs[i]], skypars)[0]
+
+
+def _chipImageRef(img, extlist):
+    # opens (read-only) the image file of an image object and replaces the
+    # science extensions of the opened HDU list with in-memory HDUs holding
+    # the (cached) arrays of the image object's chips. The file itself is
+    # not modified. Chip WCS objects are attached to the new HDUs so that
+    # 'skymatch' does not need to recompute them:
+    imref, dqref = openImageEx(img._filename, mode='readonly', memmap=True,
+                               saveAsMEF=False, imageOnly=True,
+                               openImageHDU=True, openDQHDU=False)
+    dqref.release()
+
+    hdulist = imref.hdu
+    for extname, extver in extlist:
+        idx = hdulist.index_of((extname, extver))
+        hdr = hdulist[idx].header.copy()
+        # data from the chip cache are already scaled:
+        for kwd in ['BSCALE', 'BZERO']:
+            if kwd in hdr:
+                del hdr[kwd]
+        hdu = fits.ImageHDU(
+            data=img.getData('{:s},{:d}'.format(extname, extver)),
+            header=hdr
+        )
+        hdu.wcs = img[extname, extver].wcs
+        hdulist[idx] = hdu
+
+    # science data no longer match the file and cannot be re-loaded:
+    imref.can_reload_data = False
+    return imref
+
+
+def _updateSkyKWs(image, chipvals):
+    # records sky values of several chips of an image with a single header
+    # update. 'chipvals' is a list of (extver, value, history) tuples.
+    if not chipvals:
+        return
+    skyKW = "MDRIZSKY"
+    extname = image.scienceExt
+    log.info('Updating keyword {:s} in {:s}'.format(skyKW, image._filename))
+    fobj = fileutil.openImage(image._filename, mode='update', memmap=False)
+    try:
+        for extver, value, history in chipvals:
+            image[extname,extver].header[skyKW] = value
+            hdr = fobj[extname,extver].header
+            hdr[skyKW] = (value, 'Sky value computed by AstroDrizzle')
+            if history:
+                hdr.add_history(history)
+    finally:
+        fobj.close()
 
-    def merge_masks(m1, m2):
-        if m1 is None: return m2
-        if m2 is None: return m1
-        return np.logical_and(m1, m2).astype(np.uint8)
 
+def _staticDQMask(img, ext, sky_bits, use_static):
+    # returns the combined 'static' and DQ mask of a chip (1 for good
+    # pixels) or None when no mask is to be applied.
     mask = None
 
-    # build DQ mask
-    if sky_bits is not None:
-        mask = img.buildMask(img[ext]._chip,bits=sky_bits)
-
     # get correct static mask mask filenames/objects
     staticMaskName = img[ext].outputNames['staticMask']
     smask = None
     if use_static:
         if img.inmemory:
             if staticMaskName in img.virtualOutputs:
-                smask = img.virtualOutputs[staticMaskName].data
+                smask = img.virtualOutputs[staticMaskName]
         else:
             if staticMaskName is not None and os.path.isfile(staticMaskName):
-                sm, dq = openImageEx(
-                    staticMaskName,
-                    mode='readonly',
-                    memmap=False,
-                    saveAsMEF=False,
-                    clobber=False,
-                    imageOnly=True,
-                    openImageHDU=True,
-                    openDQHDU=False,
-                    preferMEF=False,
-                    verbose=False
-                )
-                if sm.hdu is not None:
-                    smask = sm.hdu[0].data
-                    sm.release()
+                smask = staticMaskName
             else:
                 log.warning("Static mask for file \'{}\', ext={} NOT FOUND." \
                             .format(img._filename, ext))
-        # combine DQ and static masks:
-        mask = merge_masks(mask, smask)
+
+    if sky_bits is not None:
+        # build DQ mask combined with the static mask (this combined mask
+        # is cached by the imageObject and reused by the drizzle steps):
+        mask = img.getCombinedMask(img[ext]._chip, bits=sky_bits,
+                                   staticmask=smask)
+    elif smask is not None:
+        mask = np.ones(img[ext].image_shape, dtype=np.uint8)
+        mergeDQarray(smask, mask)
+
+    return mask
+
+
+def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
+                           umaskext, in_memory):
+    # creates a temporary mask by combining 'static' mask,
+    # DQ image, and user-supplied mask.
+
+    def merge_masks(m1, m2):
+        if m1 is None: return m2
+        if m2 is None: return m1
+        return np.logical_and(m1, m2).astype(np.uint8)
+
+    mask = _staticDQMask(img, ext, sky_bits, use_static)
 
     # combine user mask with the previously computed mask:
     if umask is not None and not umask.closed:
@@ -436,21 +558,174 @@ def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
         log.warning("All pixels masked out when applying DQ, " \
                     "static, and user masks!")
 
-    # save mask to a temporary file:
+    # wrap the mask in an in-memory image (the mask array is not copied):
     (root,suffix,fext) = file_name_components(img._filename)
-    if in_memory:
-        tmpmask = in_memory_mask(mask)
-        strext = ext2str(ext, compact=True, default_extver=None)
-        tmpmask.original_fname = "{1:s}{0:s}{2:s}{0:s}{3:s}" \
-            .format('_', root, suffix, 'in-memory_skymatch_mask')
-    else:
-        (tmpfname, tmpmask) = temp_mask_file(mask, root,
-            prefix='', suffix='skymatch_mask', ext=ext,
-            randomize_prefix=False)
-        img[ext].outputNames['skyMatchMask'] = tmpfname
+    tmpmask = in_memory_mask(mask)
+    tmpmask.original_fname = "{1:s}{0:s}{2:s}{0:s}{3:s}" \
+        .format('_', root, suffix, 'in-memory_skymatch_mask')
 
     return (tmpmask, 0)
 
+def _skyApprox(imageList, paramDict, in_memory, clean, num_cores=None):
+    # 'localmin' sky computed by astrodrizzle itself from a subsample of
+    # the unmasked pixels of each chip (skymethod='localmin-approx').
+    skyKW = "MDRIZSKY"
+
+    if not util.is_blank(paramDict['skymask_cat']):
+        log.warning("User masks are not supported by the 'localmin-approx' "
+                    "sky method. Using 'localmin' instead.")
+        pars = paramDict.copy()
+        pars['skymethod'] = 'localmin'
+        _skymatch(imageList, pars, in_memory, clean, log,
+                  num_cores=num_cores)
+        return
+
+    sky_bits = interpret_bit_flags(paramDict['sky_bits'])
+    skystat = paramDict['skystat'].lower()
+    statpars = _skyStatPars(paramDict)
+    fraction = paramDict.get('skysample', SKY_SAMPLE)
+    tolerance = paramDict.get('skytol', SKY_TOL)
+
+    for image in imageList:
+        extname = image.scienceExt
+        extvers = image.group
+        if extvers is None:
+            extvers = image.getExtensions()
+
+        log.info("Computing approximate minimum sky for '{:s}' ..."
+                 .format(image._filename))
+        skies = []
+        scaledSky = []
+        for extver in extvers:
+            chip = image[extname, extver]
+            if not chip.group_member:
+                continue
+            mask = _staticDQMask(image, (extname, extver), sky_bits,
+                                 paramDict['use_static'])
+            data = image.getData('{:s},{:d}'.format(extname, extver))
+            sky, err, nsample = _sampledSkyValue(data, mask, skystat,
+                                                 statpars, fraction,
+                                                 tolerance, seed=extver)
+            del data, mask
+            if err is None:
+                log.info("    Sky of {:s}[{:s},{:d}] computed from all "
+                         "pixels: {:g}".format(image._rootname, extname,
+                                               extver, sky))
+            else:
+                log.info("    Sky of {:s}[{:s},{:d}] estimated from {:d} "
+                         "pixels: {:g} +/- {:g}"
+                         .format(image._rootname, extname, extver, nsample,
+                                 sky, err))
+
+            pscale = _skyPixelScale(chip)
+            skies.append((extver, pscale, err, nsample))
+            scaledSky.append(sky / pscale**2)
+
+        if not skies:
+            continue
+        minSky = min(scaledSky)
+
+        # update all chips of the image with a single header update:
+        chipvals = []
+        for extver, pscale, err, nsample in skies:
+            chip = image[extname, extver]
+            value = minSky * pscale**2
+            chip.subtractedSky = value
+            chip.computedSky = value
+            if err is None:
+                history = ("AstroDrizzle localmin-approx: {:s} chip sky "
+                           "computed from all pixels.".format(skyKW))
+            else:
+                history = ("AstroDrizzle localmin-approx: {:s} chip sky "
+                           "error {:.4g} ({:d} pixels)."
+                           .format(skyKW, err, nsample))
+            chipvals.append((extver, value, history))
+        _updateSkyKWs(image, chipvals)
+
+
+def _skyPixelScale(chip):
+    # account for the case where no IDCSCALE has been set, due to a
+    # lack of IDCTAB or to 'coeffs=False'.
+    pscale = chip.wcs.idcscale
+    if pscale is None:
+        pscale = chip.wcs.pscale
+    return pscale
+
+
+def _sampledSkyValue(data, mask, skystat, statpars, fraction, tolerance,
+                     seed=0, nboot=SKY_NBOOT):
+    """ Estimate the sky of an image from a stratified random subsample of
+    its unmasked pixels.
+
+    One pixel is drawn from each ``b x b`` block of the image, with
+    ``b ~ 1/sqrt(fraction)``. The standard error of the estimate is computed
+    by bootstrap resampling of the sampled pixels. When it exceeds
+    ``tolerance`` times the standard deviation of the sampled pixels (or
+    when too few unmasked pixels are sampled) the sky is computed from all
+    unmasked pixels of the image.
+
+    Returns
+    -------
+    sky : float
+        Sky value.
+
+    error : float, None
+        Bootstrap standard error of the sky value or `None` when the sky
+        was computed from all pixels.
+
+    nsample : int
+        Number of pixels used to compute the sky value.
+
+    """
+    fields = 'npix,{:s},stddev'.format(skystat)
+    ny, nx = data.shape
+
+    if 0 < fraction < 1:
+        block = max(1, int(round(1.0 / np.sqrt(fraction))))
+        rng = np.random.RandomState(seed)
+        y0 = np.arange(0, ny, block)
+        x0 = np.arange(0, nx, block)
+        y = y0[:, np.newaxis] + rng.randint(0, block, (y0.size, x0.size))
+        x = x0[np.newaxis, :] + rng.randint(0, block, (y0.size, x0.size))
+        inside = (y < ny) & (x < nx)
+        y = y[inside]
+        x = x[inside]
+        if mask is not None:
+            good = mask[y, x].astype(np.bool_)
+            y = y[good]
+            x = x[good]
+
+        sample = np.asarray(data[y, x], dtype=np.float32)
+        if sample.size >= SKY_MIN_SAMPLE:
+            try:
+                stats = ImageStats(sample, fields=fields, **statpars)
+                sky = _extractSkyValue(stats, skystat)
+                boot = np.empty(nboot, dtype=np.float64)
+                for k in range(nboot):
+                    resample = sample[rng.randint(0, sample.size,
+                                                  sample.size)]
+                    boot[k] = _extractSkyValue(
+                        ImageStats(resample, fields=skystat, **statpars),
+                        skystat
+                    )
+                error = boot.std(ddof=1)
+                if error <= tolerance * stats.stddev:
+                    return float(sky), float(error), sample.size
+            except ValueError:
+                # no valid pixels left after clipping
+                pass
+
+    # compute sky from all (unmasked) pixels:
+    if mask is not None:
+        data = data[mask.astype(np.bool_)]
+        if data.size == 0:
+            log.warning("All pixels masked out when applying DQ and static "
+                        "masks! Setting sky to 0.")
+            return 0.0, None, 0
+    stats = ImageStats(data, fields=fields, **statpars)
+    return float(_extractSkyValue(stats, skystat)), None, stats.npix
+
+
 # this function applies user supplied sky values from an input file
 def _skyUserFromFile(imageObjList, skyFile, apply_sky=None):
     """
@@ -698,6 +973,13 @@ def _skySub(imageSet,paramDict,saveFile=False):
 ##  Helper functions follow  ##
 ###############################
 
+def _skyStatPars(skypars):
+    """ Return clipping parameters of the sky statistics (see `ImageStats`). """
+    return {'lower': skypars['skylower'], 'upper': skypars['skyupper'],
+            'nclip': skypars['skyclip'], 'lsig': skypars['skylsigma'],
+            'usig': skypars['skyusigma'], 'binwidth': skypars['skywidth']}
+
+
 def _computeSky(image, skypars, memmap=False):
 
     """
@@ -709,7 +991,7 @@ def _computeSky(image, skypars, memmap=False):
 
     """
     #this object contains the returned values from the image stats routine
-    _tmp = imagestats.ImageStats(image.data,
+    _tmp = ImageStats(image.data,
             fields      = skypars['skystat'],
             lower       = skypars['skylower'],
             upper       = skypars['skyupper'],
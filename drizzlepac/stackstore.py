@@ -0,0 +1,287 @@
+"""
+Persistent, memory-mapped stack store used by the create median step to
+update the median image incrementally when exposures are added to or removed
+from an association.
+
+The store is a directory holding a small JSON description of its members
+and, for each member, two ``.npy`` files with arrays of the shape of the
+single-drizzled images:
+
+    * ``member<slot>_values.npy``  - single-drizzled pixel values
+    * ``member<slot>_weights.npy`` - single-drizzled weights
+
+Each member occupies its own slot, so that inserting or removing an
+exposure writes or deletes only the files of that exposure and rewrites
+the JSON description; the files of the other members are not touched.
+Members are identified by a signature provided by the caller (for example,
+computed from the modification time and size of the input file and the
+drizzle parameters), so that exposures whose products did not change are not
+stored again.
+
+Sections of rows of the stack are read from the memory-mapped member files
+in any member order and are passed to the usual combination algorithms.
+The stack is stored member-major (each member's image is contiguous)
+rather than pixel-major with sorted values: the combination algorithms
+(``minmed``, ``numcombine``) need the values, weights and per-exposure
+parameters (readnoise, exposure time, sky) of each member and not only
+the sorted values, and a pixel-major layout would require rewriting the
+stack of every pixel whenever an exposure is inserted or removed.
+
+:License: :doc:`LICENSE`
+
+"""
+from __future__ import (absolute_import, division, unicode_literals,
+                        print_function)
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+from stsci.tools import logutil
+
+from .version import *
+
+__all__ = ['StackStore']
+
+STORE_VERSION = 3
+COPY_NROWS = 256   # number of rows copied at a time into member files
+
+log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
+
+
+class StackStore(object):
+    """ On-disk, memory-mapped stack of single-drizzled images.
+
+    Parameters
+    ----------
+    path : str
+        Directory holding the store. It is created if it does not exist.
+
+    shape : tuple of int
+        Shape ``(ny, nx)`` of the single-drizzled images.
+
+    dtype : numpy.dtype
+        Data type of the single-drizzled science and weight images.
+
+    Notes
+    -----
+    A store created for a different image shape or data type is discarded
+    and re-created empty.
+
+    """
+    def __init__(self, path, shape, dtype):
+        self.path = os.path.abspath(path)
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.members = {}
+        self._next_slot = 0
+        self._mmaps = {}
+
+        meta = self._read_meta()
+        if (meta is None or meta['version'] != STORE_VERSION or
+                tuple(meta['shape']) != self.shape or
+                meta['dtype'] != self.dtype.str):
+            if meta is not None:
+                log.info("Discarding incompatible stack store '{}'"
+                         .format(self.path))
+            self._reset()
+        else:
+            self.members = meta['members']
+            self._next_slot = meta['next_slot']
+
+    @property
+    def depth(self):
+        """ Number of members currently stored for each pixel. """
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def _meta_file(self):
+        return os.path.join(self.path, 'stackstore.json')
+
+    def _member_file(self, slot, kind):
+        return os.path.join(self.path,
+                            'member{:05d}_{:s}.npy'.format(slot, kind))
+
+    def _read_meta(self):
+        if not os.path.isfile(self._meta_file()):
+            return None
+        try:
+            with open(self._meta_file()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self):
+        meta = {
+            'version': STORE_VERSION,
+            'shape': list(self.shape),
+            'dtype': self.dtype.str,
+            'next_slot': self._next_slot,
+            'members': self.members
+        }
+        tmpname = self._meta_file() + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.rename(tmpname, self._meta_file())
+
+    def _reset(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.members = {}
+        self._next_slot = 0
+        self._write_meta()
+
+    def _write_member(self, slot, data, weight):
+        # copy images into new member files COPY_NROWS rows at a time:
+        for kind, img in [('values', data), ('weights', weight)]:
+            fname = self._member_file(slot, kind)
+            arr = np.lib.format.open_memmap(fname, mode='w+',
+                                            dtype=self.dtype,
+                                            shape=self.shape)
+            for r1 in range(0, self.shape[0], COPY_NROWS):
+                r2 = min(r1 + COPY_NROWS, self.shape[0])
+                if img is None:
+                    arr[r1:r2] = 1
+                else:
+                    arr[r1:r2] = img[r1:r2]
+            arr.flush()
+            del arr
+
+    def _delete_member(self, slot):
+        self._mmaps.pop(slot, None)
+        for kind in ['values', 'weights']:
+            fname = self._member_file(slot, kind)
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def _member_arrays(self, slot):
+        if slot not in self._mmaps:
+            self._mmaps[slot] = tuple(
+                np.load(self._member_file(slot, kind), mmap_mode='r')
+                for kind in ['values', 'weights']
+            )
+        return self._mmaps[slot]
+
+    def signature(self, name):
+        """ Return signature recorded for a member or `None`. """
+        if name in self.members:
+            return self.members[name]['signature']
+        return None
+
+    def info(self, name):
+        """ Return dictionary of auxiliary values recorded for a member. """
+        return self.members[name]['info']
+
+    def update(self, members=(), remove=()):
+        """ Add, replace and remove members. Only the files of the added,
+        replaced and removed members are written or deleted.
+
+        Parameters
+        ----------
+        members : list of tuple
+            ``(name, data, weight, signature, info)`` for each member to be
+            added or replaced. ``data`` and ``weight`` are the
+            single-drizzled science and weight images
+            (`numpy.ndarray` or `~stsci.tools.iterfile.IterFitsFile`) and
+            are read `COPY_NROWS` rows at a time. When ``weight`` is
+            `None`, unit weights are stored. ``signature`` is a
+            JSON-serializable value identifying the member's products
+            (see `signature`). ``info`` is a JSON-serializable dictionary of
+            auxiliary values (exposure time, readnoise, etc.) or `None`.
+
+        remove : list of str
+            Names of the members to be removed.
+
+        """
+        members = list(members)
+        names = [m[0] for m in members]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate member names.")
+
+        remove = [n for n in remove if n in self.members and n not in names]
+        if not members and not remove:
+            return
+
+        old_slots = []
+        for name, data, weight, signature, info in members:
+            slot = self._next_slot
+            self._next_slot += 1
+            self._write_member(slot, data, weight)
+            if name in self.members:
+                old_slots.append(self.members[name]['slot'])
+            self.members[name] = {
+                'slot': slot,
+                'signature': signature,
+                'info': {} if info is None else info
+            }
+            log.info("Added '{}' to stack store '{}'".format(name, self.path))
+
+        for name in remove:
+            old_slots.append(self.members.pop(name)['slot'])
+            log.info("Removed '{}' from stack store '{}'"
+                     .format(name, self.path))
+
+        # files of replaced and removed members are deleted only after the
+        # new description of the store has been saved:
+        self._write_meta()
+        for slot in old_slots:
+            self._delete_member(slot)
+
+    def insert(self, name, data, weight, signature=None, info=None):
+        """ Add a single-drizzled image (and its weight) to the store or
+        replace a stored member. See `update` for the description of the
+        parameters.
+        """
+        self.update([(name, data, weight, signature, info)])
+
+    def remove(self, name):
+        """ Remove a member from the store. """
+        if name not in self.members:
+            raise KeyError(name)
+        self.update(remove=[name])
+
+    def sync(self, names):
+        """ Remove all members whose names are not in ``names``. """
+        self.update(remove=[n for n in self.members if n not in names])
+
+    def read_section(self, row1, row2, names):
+        """ Read a section of the input image stacks.
+
+        Parameters
+        ----------
+        row1, row2 : int
+            First (inclusive) and last (exclusive) rows of the section.
+
+        names : list of str
+            Members to be returned, in the desired order.
+
+        Returns
+        -------
+        data, weights : numpy.ndarray
+            Arrays of shape ``(len(names), row2 - row1, ncols)`` with
+            single-drizzled images and weights in the order of ``names``.
+
+        """
+        if sorted(names) != sorted(self.members.keys()):
+            raise ValueError("Requested members do not match members of the "
+                             "stack store.")
+
+        shape = (len(names), row2 - row1, self.shape[1])
+        data = np.empty(shape, dtype=self.dtype)
+        weights = np.empty(shape, dtype=self.dtype)
+
+        for k, name in enumerate(names):
+            values, wht = self._member_arrays(self.members[name]['slot'])
+            data[k] = values[row1:row2]
+            weights[k] = wht[row1:row2]
+
+        return data, weights
+
+    def close(self):
+        """ Release memory-mapped member files. """
+        self._mmaps.clear()
@@ -20,8 +20,9 @@ import numpy as np
 from stsci.tools import fileutil, teal, logutil
 import astropy
 from astropy.io import fits
-from stsci.imagestats import ImageStats
 from . import util
+from . import buildmask
+from .chipstats import chip_stats
 from . import processInput
 
 ASTROPY_VER_GE13 = LooseVersion(astropy.__version__) >= LooseVersion('1.3')
@@ -29,6 +30,10 @@ ASTROPY_VER_GE13 = LooseVersion(astropy.__version__) >= LooseVersion('1.3')
 __taskname__ = "drizzlepac.staticMask"
 _step_num_ = 1
 
+# statistics (and their clipping parameters) used to build static masks:
+STATIC_STAT_FIELDS = 'mode,stddev'
+STATIC_STAT_PARS = {'nclip': 3}
+
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -92,6 +97,14 @@ def createStaticMask(imageObjectList=[],configObj=None,procSteps=None):
     #create a static mask object
     myMask = staticMask(configObj)
 
+    # compute statistics of all chips at once, in parallel if possible:
+    chips = []
+    for image in imageObjectList:
+        chips.extend([(image, chip) for chip in _maskChips(image)])
+    chip_stats.compute(chips, fields=STATIC_STAT_FIELDS,
+                       num_cores=configObj.get('num_cores'),
+                       **STATIC_STAT_PARS)
+
     for image in imageObjectList:
         myMask.addMember(image) # create tmp filename here...
 
@@ -103,6 +116,13 @@ def createStaticMask(imageObjectList=[],configObj=None,procSteps=None):
     if procSteps is not None:
         procSteps.endStep('Static Mask')
 
+def _maskChips(image):
+    """ Return list of chips of an image that contribute to static masks. """
+    chips = image.group
+    if chips is None:
+        chips = image.getExtensions()
+    return chips
+
 def constructFilename(signature):
     """Construct an output filename for the given signature::
 
@@ -173,12 +193,8 @@ class staticMask(object):
 
         log.info("Computing static mask:\n")
 
-        chips = imagePtr.group
-        if chips is None:
-            chips = imagePtr.getExtensions()
-
         #for chip in range(1,numchips+1,1):
-        for chip in chips:
+        for chip in _maskChips(imagePtr):
             chipid=imagePtr.scienceExt + ','+ str(chip)
             chipimage=imagePtr.getData(chipid)
             signature=imagePtr[chipid].signature
@@ -197,10 +213,11 @@ class staticMask(object):
                         break
             imagePtr[chipid].outputNames['staticMask'] = maskname
 
-            stats = ImageStats(chipimage,nclip=3,fields='mode')
+            stats = chip_stats.get(imagePtr, chip, fields=STATIC_STAT_FIELDS,
+                                   **STATIC_STAT_PARS)
             mode = stats.mode
             rms  = stats.stddev
-            nbins = len(stats.histogram)
+            nbins = stats.nbins
             del stats
 
             log.info('  mode = %9f;   rms = %7f;   static_sig = %0.2f' %
@@ -208,15 +225,15 @@ class staticMask(object):
 
             if nbins >= 2: # only combine data from new image if enough data to mask
                 sky_rms_diff = mode - (self.static_sig*rms)
-                np.bitwise_and(self.masklist[signature],
+                np.logical_and(self.masklist[signature],
                                np.logical_not(np.less(chipimage, sky_rms_diff)),
-                               self.masklist[signature])
+                               out=self.masklist[signature])
             del chipimage
 
 
     def _buildMaskArray(self,signature):
-        """ Creates empty  numpy array for static mask array signature. """
-        return np.ones(signature[1],dtype=np.int16)
+        """ Creates empty (boolean) numpy array for static mask array signature. """
+        return np.ones(signature[1],dtype=np.bool_)
 
     def getMaskArray(self, signature):
         """ Returns the appropriate StaticMask array for the image. """
@@ -274,16 +291,18 @@ class staticMask(object):
         for key in self.masklist.keys():
             #check to see if the file already exists on disk
             filename = self.masknames[key]
-            #create a new fits image with the mask array and a standard header
-            #open a new header and data unit
-            newHDU = fits.PrimaryHDU()
-            newHDU.data = self.masklist[key]
-
             if virtual:
+                # keep the mask in memory with 8 pixels per byte
+                packed = buildmask.PackedMask(self.masklist[key])
                 for img in imageObjectList:
-                    img.saveVirtualOutputs({filename:newHDU})
+                    img.saveVirtualOutputs({filename:packed})
 
             else:
+                #create a new fits image with the mask array and a standard header
+                #open a new header and data unit
+                #(masks are kept as bool in memory but written as int16)
+                newHDU = fits.PrimaryHDU()
+                newHDU.data = self.masklist[key].astype(np.int16)
                 try:
                     if ASTROPY_VER_GE13:
                         newHDU.writeto(filename, overwrite=True)
@@ -20,6 +20,9 @@ from stwcs import updatewcs
 
 from . import util
 
+if util.can_parallel:
+    import multiprocessing
+
 # __version__ and __version_date__ are defined here, prior to the importing
 # of the modules below, so that those modules can use the values
 # from these variable definitions, allowing the values to be designated
@@ -45,6 +48,9 @@ PSET_SECTION_REFIMG = '_REF IMAGE SOURCE FINDING PARS_'
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
+# pairs of footprints shared with worker processes computing their overlap:
+_overlap_inputs = []
+
 
 def _managePsets(configobj, section_name, task_name, iparsobj=None, input_dict=None):
     """ Read in parameter values from PSET-like configobj tasks defined for
@@ -338,6 +344,10 @@ def run(configobj):
     input_images_orig_copy = copy(input_images)
     do_match_refimg = False
 
+    # overlap of input images with the footprint of the reference catalog
+    # (updated as the reference catalog expands):
+    ref_overlaps = {}
+
     # otherwise, extract the catalog from the first input image source list
     if configobj['refimage'] not in [None, '',' ','INDEF']: # User specified an image to use
         # A hack to allow different source finding parameters for
@@ -403,7 +413,8 @@ def run(configobj):
             return
 
         image = _max_overlap_image(refimage, input_images, expand_refcat,
-                                   enforce_user_order)
+                                   enforce_user_order, ref_overlaps,
+                                   configobj['num_cores'])
 
     elif refcat_par['refcat'] not in [None,'',' ','INDEF']:
         # a reference catalog is provided but not the reference image/wcs
@@ -419,7 +430,8 @@ def run(configobj):
             image = input_images.pop(0)
         else:
             image, image2 = _max_overlap_pair(input_images, expand_refcat,
-                                              enforce_user_order)
+                                              enforce_user_order,
+                                              configobj['num_cores'])
             input_images.insert(0, image2)
 
         # Workaround the defect described in ticket:
@@ -478,7 +490,8 @@ def run(configobj):
         cat_src = None
 
         refimg, image = _max_overlap_pair(input_images, expand_refcat,
-                                          enforce_user_order)
+                                          enforce_user_order,
+                                          configobj['num_cores'])
 
         refwcs = []
         #refwcs.extend(refimg.get_wcs())
@@ -598,7 +611,8 @@ def run(configobj):
                     # Clear retry flags and get next image:
                     image = _max_overlap_image(
                         refimage, input_images, expand_refcat,
-                        enforce_user_order
+                        enforce_user_order, ref_overlaps,
+                        configobj['num_cores']
                     )
                     retry_flags = len(input_images)*[0]
                     refimage.clear_dirty_flag()
@@ -686,19 +700,96 @@ def run(configobj):
         return
 
 
-def _overlap_matrix(images):
+def _bounding_cap(polygon):
+    """ Return the center (unit vector) and the angular radius of a
+        spherical cap enclosing ``polygon`` or `None` for empty polygons.
+        Polygons that cannot be enclosed in a hemisphere are enclosed in
+        the entire sphere (radius of pi).
+    """
+    points = [p for p in polygon.points if len(p) > 0]
+    if len(points) == 0:
+        return None
+    points = np.vstack(points + [np.atleast_2d(p) for p in polygon.inside])
+
+    center = points.sum(axis=0)
+    norm = np.sqrt(np.dot(center, center))
+    if norm == 0.0:
+        return (points[0], np.pi)
+    center /= norm
+
+    # caps smaller than a hemisphere contain the great circle arcs between
+    # any of their points:
+    radius = np.arccos(np.clip(np.dot(points, center), -1.0, 1.0)).max()
+    if radius >= 0.5 * np.pi:
+        radius = np.pi
+    return (center, radius)
+
+
+def _overlapping_caps(caps1, caps2):
+    """ Return a boolean matrix indicating which caps from ``caps1``
+        overlap with caps from ``caps2``. Footprints enclosed in caps
+        that do not overlap cannot overlap either.
+    """
+    def as_arrays(caps):
+        centers = np.array([[0.0, 0.0, 1.0] if c is None else c[0]
+                            for c in caps]).reshape((-1, 3))
+        radii = np.array([-np.inf if c is None else c[1] for c in caps])
+        return centers, radii
+
+    c1, r1 = as_arrays(caps1)
+    c2, r2 = as_arrays(caps2)
+    dist = np.arccos(np.clip(np.dot(c1, c2.T), -1.0, 1.0))
+    return dist <= r1[:, np.newaxis] + r2[np.newaxis, :] + 1e-9
+
+
+def _overlap_area(skyline1, skyline2):
+    return np.fabs(skyline1.intersection(skyline2).area())
+
+
+def _overlapWorker(k):
+    # worker process: footprints are inherited from the parent process (fork)
+    return _overlap_area(*_overlap_inputs[k])
+
+
+def _overlap_areas(pairs, num_cores=None):
+    """ Compute areas of the intersections of pairs of footprints,
+        in parallel processes when possible.
+    """
+    global _overlap_inputs
+    pool_size = 1
+    if len(pairs) > 1 and util.can_parallel and \
+       'fork' in multiprocessing.get_all_start_methods():
+        pool_size = util.get_pool_size(num_cores, len(pairs))
+    if pool_size < 2:
+        return [_overlap_area(s1, s2) for s1, s2 in pairs]
+
+    _overlap_inputs = pairs
+    pool = multiprocessing.get_context('fork').Pool(pool_size)
+    try:
+        return pool.map(_overlapWorker, range(len(pairs)))
+    finally:
+        _overlap_inputs = []
+        pool.close()
+        pool.join()
+
+
+def _overlap_matrix(images, num_cores=None):
     nimg = len(images)
     m = np.zeros((nimg,nimg), dtype=np.float)
-    for i in range(nimg):
-        for j in range(i+1,nimg):
-            p = images[i].skyline.intersection(images[j].skyline)
-            area = np.fabs(p.area())
-            m[j,i] = area
-            m[i,j] = area
+    # compute intersections only for footprints whose bounding caps overlap:
+    caps = [_bounding_cap(img.skyline) for img in images]
+    ii, jj = np.nonzero(np.triu(_overlapping_caps(caps, caps), 1))
+    areas = _overlap_areas(
+        [(images[i].skyline, images[j].skyline) for i, j in zip(ii, jj)],
+        num_cores
+    )
+    m[ii,jj] = areas
+    m[jj,ii] = areas
     return m
 
 
-def _max_overlap_pair(images, expand_refcat, enforce_user_order):
+def _max_overlap_pair(images, expand_refcat, enforce_user_order,
+                      num_cores=None):
     assert(len(images) > 1)
     if len(images) == 2 or not expand_refcat or enforce_user_order:
         # for the special case when only two images are provided
@@ -708,7 +799,7 @@ def _max_overlap_pair(images, expand_refcat, enforce_user_order):
         im2 = images.pop(0)
         return (im1, im2)
 
-    m = _overlap_matrix(images)
+    m = _overlap_matrix(images, num_cores)
     imgs = [f.name for f in images]
     n = m.shape[0]
     index = m.argmax()
@@ -743,18 +834,44 @@ def _max_overlap_pair(images, expand_refcat, enforce_user_order):
     return (im1, im2)
 
 
-def _max_overlap_image(refimage, images, expand_refcat, enforce_user_order):
+def _max_overlap_image(refimage, images, expand_refcat, enforce_user_order,
+                       ref_overlaps=None, num_cores=None):
+    """ Sort ``images`` by their overlap with the footprint of the
+        reference catalog and return the image with the largest overlap.
+
+        ``ref_overlaps`` is a dictionary of overlaps computed in previous
+        calls for the same reference catalog. Since the footprint of the
+        reference catalog only grows as the catalog is expanded, overlaps
+        of images entirely inside the footprint are not computed again.
+    """
     nimg = len(images)
     assert(nimg > 0)
     if not expand_refcat or enforce_user_order:
         # revert to old tweakreg behavior
         return images.pop(0)
 
+    if ref_overlaps is None:
+        ref_overlaps = {}
+
+    ref_cap = _bounding_cap(refimage.skyline)
     area = np.zeros(nimg, dtype=np.float)
-    for i in range(nimg):
-        area[i] = np.fabs(
-            refimage.skyline.intersection(images[i].skyline).area()
-        )
+    update = []
+    for i, img in enumerate(images):
+        if img not in ref_overlaps:
+            img_area = np.fabs(img.skyline.area())
+            ref_overlaps[img] = (_bounding_cap(img.skyline), img_area, 0.0)
+        cap, img_area, overlap = ref_overlaps[img]
+        if img_area > 0 and overlap >= img_area * (1.0 - 1e-9):
+            area[i] = overlap
+        elif _overlapping_caps([ref_cap], [cap])[0, 0]:
+            update.append(i)
+
+    areas = _overlap_areas([(refimage.skyline, images[i].skyline)
+                            for i in update], num_cores)
+    for i, overlap in zip(update, areas):
+        area[i] = overlap
+        cap, img_area, _ = ref_overlaps[images[i]]
+        ref_overlaps[images[i]] = (cap, img_area, overlap)
 
     # Sort the remaining of the input list of images by overlap area
     # with the reference image (in decreasing order):
@@ -6,8 +6,10 @@
 """
 from __future__ import absolute_import, division, print_function
 import string,os
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+from scipy.spatial import cKDTree
 import stsci.ndimage as ndimage
 
 from stsci.tools import asnutil, irafglob, parseinput, fileutil, logutil
@@ -19,18 +21,25 @@ import stsci.imagestats as imagestats
 
 from . import findobj
 from . import cdriz
+from . import util
 
 __all__ = [
     'parse_input', 'atfile_sci', 'parse_atfile_cat', 'ndfind',
-    'get_configobj_root', 'isfloat', 'parse_skypos', 'make_val_float',
-    'radec_hmstodd', 'parse_exclusions', 'parse_colname', 'readcols',
-    'read_FITS_cols', 'read_ASCII_cols', 'write_shiftfile', 'createWcsHDU',
-    'idlgauss_convolve', 'gauss_array', 'gauss', 'make_vector_plot',
-    'apply_db_fit', 'write_xy_file', 'find_xy_peak', 'plot_zeropoint',
-    'build_xy_zeropoint', 'build_pos_grid'
+    'ndfind_many', 'get_configobj_root', 'isfloat', 'parse_skypos',
+    'make_val_float', 'radec_hmstodd', 'parse_sexagesimal',
+    'parse_exclusions', 'parse_colname',
+    'readcols', 'read_FITS_cols', 'read_ASCII_cols', 'write_shiftfile',
+    'createWcsHDU', 'idlgauss_convolve', 'gauss_array', 'gauss',
+    'make_vector_plot', 'apply_db_fit', 'write_xy_file', 'find_xy_peak',
+    'plot_zeropoint', 'build_xy_zeropoint', 'xy_offset_histogram',
+    'tree_xyxymatch', 'build_pos_grid'
 ]
 
 
+# maximum number of pairs of positions compared at once by
+# 'xy_offset_histogram'
+XYZERO_CHUNK = 2**22
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 def parse_input(input, prodonly=False, sort_wildcards=True):
@@ -122,38 +131,89 @@ def ndfind(array, hmin, fwhm, skymode,
            sharplim=[0.2,1.0], roundlim=[-1,1], minpix=5,
            peakmin=None, peakmax=None, fluxmin=None, fluxmax=None,
            nsigma=1.5, ratio=1.0, theta=0.0,
-           mask=None, use_sharp_round=False, nbright=None):
-
-    star_list, fluxes= findobj.findstars(
-        array, fwhm, hmin, skymode,
-        peakmin=peakmin, peakmax=peakmax,
-        fluxmin=fluxmin, fluxmax=fluxmax,
-        ratio=ratio, nsigma=nsigma, theta=theta,
-        use_sharp_round=use_sharp_round,
-        mask=mask,
-        sharplo=sharplim[0], sharphi=sharplim[1],
-        roundlo=roundlim[0], roundhi=roundlim[1]
-    )
+           mask=None, use_sharp_round=False, nbright=None,
+           tile_size=None, num_cores=None):
 
-    if len(star_list) == 0:
-        print('No valid sources found...')
-        return tuple([[] for i in range(7 if use_sharp_round else 4)])
+    pars = dict(array=array, hmin=hmin, fwhm=fwhm, skymode=skymode,
+                sharplim=sharplim, roundlim=roundlim, minpix=minpix,
+                peakmin=peakmin, peakmax=peakmax, fluxmin=fluxmin,
+                fluxmax=fluxmax, nsigma=nsigma, ratio=ratio, theta=theta,
+                mask=mask, use_sharp_round=use_sharp_round, nbright=nbright)
+    return ndfind_many([pars], tile_size=tile_size, num_cores=num_cores)[0]
 
-    star_list = list(np.array(star_list).T)
-    fluxes = np.array(fluxes, np.float)
 
-    if nbright is not None:
-        idx = np.argsort(fluxes)[::-1]
-        fluxes = fluxes[idx]
-        star_list = [s[idx] for s in star_list]
+def ndfind_many(pars_list, tile_size=None, num_cores=None):
+    """ Find sources in several images with `ndfind`.
 
-    if use_sharp_round:
-        return (star_list[0], star_list[1], fluxes,
-                np.arange(star_list[0].size),
-                star_list[2], star_list[3], star_list[4])
-    else:
-        return (star_list[0], star_list[1], fluxes,
-                np.arange(star_list[0].size), None, None, None)
+    Sources in all images (and in all tiles of the images when
+    ``tile_size`` is not `None`) are found with a single pool of
+    processes (see `~drizzlepac.findobj.findstars_many`).
+
+    Parameters
+    ----------
+    pars_list : list of dict
+        Keyword arguments of `ndfind` (other than ``tile_size`` and
+        ``num_cores``) for each image.
+
+    tile_size : int, None
+        Size of the tiles into which images are split.
+
+    num_cores : int, None
+        Maximum number of processes used to find sources.
+
+    Returns
+    -------
+    sources : list of tuple
+        Tuples returned by `ndfind` for each image.
+
+    """
+    images = [(pars['array'], _findstars_pars(**pars)) for pars in pars_list]
+    found = findobj.findstars_many(images, tile_size=tile_size,
+                                   num_cores=num_cores)
+
+    sources = []
+    for pars, (star_list, fluxes) in zip(pars_list, found):
+        use_sharp_round = pars.get('use_sharp_round', False)
+        nbright = pars.get('nbright')
+
+        if len(star_list) == 0:
+            print('No valid sources found...')
+            sources.append(tuple([[] for i in range(7 if use_sharp_round else 4)]))
+            continue
+
+        star_list = list(np.array(star_list).T)
+        fluxes = np.array(fluxes, np.float)
+
+        if nbright is not None:
+            idx = np.argsort(fluxes)[::-1]
+            fluxes = fluxes[idx]
+            star_list = [s[idx] for s in star_list]
+
+        if use_sharp_round:
+            sources.append((star_list[0], star_list[1], fluxes,
+                            np.arange(star_list[0].size),
+                            star_list[2], star_list[3], star_list[4]))
+        else:
+            sources.append((star_list[0], star_list[1], fluxes,
+                            np.arange(star_list[0].size), None, None, None))
+
+    return sources
+
+
+def _findstars_pars(array, hmin, fwhm, skymode,
+                    sharplim=[0.2,1.0], roundlim=[-1,1], minpix=5,
+                    peakmin=None, peakmax=None, fluxmin=None, fluxmax=None,
+                    nsigma=1.5, ratio=1.0, theta=0.0,
+                    mask=None, use_sharp_round=False, nbright=None):
+    # convert 'ndfind' arguments to 'findobj.findstars' arguments
+    return dict(fwhm=fwhm, threshold=hmin, skymode=skymode,
+                peakmin=peakmin, peakmax=peakmax,
+                fluxmin=fluxmin, fluxmax=fluxmax,
+                ratio=ratio, nsigma=nsigma, theta=theta,
+                use_sharp_round=use_sharp_round,
+                mask=mask,
+                sharplo=sharplim[0], sharphi=sharplim[1],
+                roundlo=roundlim[0], roundhi=roundlim[1])
 
 
 def isfloat(value):
@@ -268,6 +328,59 @@ def radec_hmstodd(ra,dec):
     return pos
 
 
+def parse_sexagesimal(values, hours=False):
+    """ Convert arrays of sexagesimal values into decimal degrees.
+
+        Parameters
+        ----------
+        values : list or array
+            Values given as numbers (in decimal degrees) or as strings in
+            any of the formats::
+
+                "nn nn nn.nnn"
+                "nn:nn:nn.nn"
+                "nnH nnM nn.nnS" or "nnD nnM nn.nnS"
+                "nn.nnnnnnn"
+
+            Strings with a single value are interpreted as decimal degrees.
+
+        hours : bool
+            Interpret sexagesimal values as hours (of right ascension).
+
+        Returns
+        -------
+        deg : numpy.ndarray
+            Array of values in decimal degrees.
+
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        return values.astype(np.float64)
+    values = values.astype(np.str_).ravel()
+
+    # convert any non-numeric characters to spaces and split into fields:
+    for c in ':hmsdHMSD':
+        values = np.char.replace(values, c, ' ')
+    fields = np.char.split(values).tolist()
+    nfields = np.array([len(f) for f in fields], dtype=np.intp)
+    if np.any(nfields < 1) or np.any(nfields > 3):
+        raise ValueError("Unable to interpret values as sexagesimal.")
+
+    flat = np.array([v for f in fields for v in f], dtype=np.float64)
+    row = np.repeat(np.arange(nfields.size), nfields)
+    pos = np.arange(flat.size) - np.repeat(np.cumsum(nfields) - nfields,
+                                           nfields)
+    dms = np.zeros((nfields.size, 3), dtype=np.float64)
+    dms[row, pos] = np.abs(flat)
+
+    sign = np.where(np.char.startswith(np.char.lstrip(values), '-'),
+                    -1.0, 1.0)
+    deg = sign * (dms[:, 0] + dms[:, 1] / 60.0 + dms[:, 2] / 3600.0)
+    if hours:
+        deg[nfields > 1] *= 15.0
+    return deg
+
+
 def parse_exclusions(exclusions):
     """ Read in exclusion definitions from file named by 'exclusions'
         and return a list of positions and distances
@@ -391,12 +504,13 @@ def parse_colname(colname):
     return cols
 
 
-def readcols(infile, cols=None):
-    """ Function which reads specified columns from either FITS tables or
-        ASCII files
+def readcols(infile, cols=None, delimiter=None):
+    """ Function which reads specified columns from either FITS tables,
+        numpy ``.npy`` files or ASCII files
 
         This function reads in the columns specified by the user into numpy arrays
-        regardless of the format of the input table (ASCII or FITS table).
+        regardless of the format of the input table (ASCII, FITS table or
+        ``.npy`` file). Values in ``.csv`` files are separated by commas.
 
         Parameters
         ----------
@@ -404,6 +518,8 @@ def readcols(infile, cols=None):
             Filename of the input file
         cols   : string or list of strings
             Columns to be read into arrays
+        delimiter : string, None
+            Separator of values in ASCII files (any whitespace when `None`)
 
         Returns
         -------
@@ -415,15 +531,23 @@ def readcols(infile, cols=None):
         return None
     if infile.endswith('.fits'):
         outarr = read_FITS_cols(infile,cols=cols)
+    elif infile.endswith('.npy'):
+        colnums = []
+        for c in cols:
+            cname = parse_colname(c)[0]
+            colnums.append(int(cname) - 1 if cname.isdigit() else cname)
+        outarr = util.read_binary_columns(infile, colnums)
     else:
-        outarr = read_ASCII_cols(infile,cols=cols)
+        if delimiter is None and infile.endswith('.csv'):
+            delimiter = ','
+        outarr = read_ASCII_cols(infile,cols=cols,delimiter=delimiter)
     return outarr
 
 
 def read_FITS_cols(infile,cols=None):
     """ Read columns from FITS table
     """
-    ftab = fits.open(infile, memmap=False)
+    ftab = fits.open(infile, memmap=True)
     extnum = 0
     extfound = False
     for extn in ftab:
@@ -448,7 +572,7 @@ def read_FITS_cols(infile,cols=None):
     return outarr
 
 
-def read_ASCII_cols(infile,cols=[1,2,3]):
+def read_ASCII_cols(infile,cols=[1,2,3],delimiter=None):
     """ Interpret input ASCII file to return arrays for specified columns.
 
         Notes
@@ -463,90 +587,61 @@ def read_ASCII_cols(infile,cols=[1,2,3]):
         and 7 represents the flux value for a total of 3 requested columns of data
         to be returned.
 
+        The file is read at once and each column is converted as a whole.
+
         Returns
         -------
         outarr : list of arrays
             The return value will be a list of numpy arrays, one for each 'column'.
     """
-    # build dictionary representing format of each row
-    # Format of dictionary: {'colname':col_number,...}
-    # This provides the mapping between column name and column number
-    coldict = {}
-    fin = open(infile,'r')
-    flines = fin.readlines()
-    fin.close()
-
-    for l in flines: # interpret each line from catalog file
-        if l[0].lstrip() == '#' or l.lstrip() == '':
-            continue
-        else:
-            # convert first row of data into column definitions using indices
-            numcols = len(l.split())
-            colnames = range(1,numcols+1)
-            for name in colnames:
-                coldict[str(name)] = name-1
-            break
+    # map specified columns to (0-indexed) columns in file:
     numcols = len(cols)
+    colnums = [[int(cn) - 1 for cn in parse_colname(c)] for c in cols]
+    filecols = sorted(set(cn for cnums in colnums for cn in cnums))
+
+    # skip blank lines, comment lines, or lines with
+    # fewer columns than requested by user
+    if all(len(cnums) == 1 for cnums in colnums):
+        try:
+            values = util.read_ascii_columns(
+                infile, filecols, mincols=numcols, delimiter=delimiter,
+                dtype=np.float64
+            )
+        except ValueError:
+            pass
+        else:
+            values = dict(zip(filecols, values))
+            return [values[cnums[0]] for cnums in colnums]
+
+    values = dict(zip(filecols, util.read_ascii_columns(
+        infile, filecols, mincols=numcols, delimiter=delimiter)))
+
     outarr = []
-    for col in range(numcols):
-        outarr.append([])
     convert_radec = False
+    for cnums in colnums:
+        if len(cnums) > 1:
+            # interpret multi-column specification as one value
+            outval = values[cnums[0]]
+            for cn in cnums[1:]:
+                outval = np.char.add(np.char.add(outval, ' '), values[cn])
+            outarr.append(outval)
+            convert_radec = True
+        else:
+            outval = values[cnums[0]]
+            try:
+                outval = outval.astype(np.float64)
+            except ValueError:
+                # Check for multi-column values given as "nn:nn:nn.s"
+                if np.any(np.char.find(outval, ':') >= 0):
+                    outval = np.char.replace(outval, ':', ' ')
+                    convert_radec = True
+            outarr.append(outval)
 
-    # Now, map specified columns to columns in file and populate output arrays
-    # Open catalog file
-    fin = open(infile,'r')
-    for l in fin.readlines(): # interpret each line from catalog file
-        if l[0] == '#' or l.lstrip() == '':
-            continue
-        l = l.strip()
-        # skip blank lines, comment lines, or lines with
-        # fewer columns than requested by user
-        if len(l) == 0 or len(l.split()) < numcols or (
-            len(l) > 0 and (l[0] == '#' or "INDEF" in l)
-            ): continue
-        lspl = l.split()
-        nsplit = len(lspl)
-
-        # For each 'column' requested by user, pull data from row
-        for c,i in zip(cols,list(range(numcols))):
-            cnames = parse_colname(c)
-            if len(cnames) > 1:
-                # interpret multi-column specification as one value
-                outval = ''
-                for cn in cnames:
-                    cnum = coldict[cn]
-                    cval = lspl[cnum]
-                    outval += cval+' '
-                outarr[i].append(outval)
-                convert_radec = True
-            else:
-                #pull single value from row for this column
-                cnum = coldict[cnames[0]]
-                if isfloat(lspl[cnum]):
-                    cval = float(lspl[cnum])
-                else:
-                    cval = lspl[cnum]
-                    # Check for multi-column values given as "nn:nn:nn.s"
-                    if ':' in cval:
-                        cval = cval.replace(':',' ')
-                        convert_radec = True
-                outarr[i].append(cval)
-
-    fin.close()
     # convert multi-column RA/Dec specifications
     if convert_radec:
-        outra = []
-        outdec = []
-        for ra,dec in zip(outarr[0],outarr[1]):
-            radd,decdd = radec_hmstodd(ra,dec)
-            outra.append(radd)
-            outdec.append(decdd)
-        outarr[0] = outra
-        outarr[1] = outdec
-
-    # convert all lists to numpy arrays
-    for c in range(len(outarr)):
-        outarr[c] = np.array(outarr[c])
+        outarr[0] = parse_sexagesimal(outarr[0], hours=True)
+        outarr[1] = parse_sexagesimal(outarr[1])
+
     return outarr
 
 
@@ -1078,15 +1173,14 @@ def plot_zeropoint(pars):
 
 
 def build_xy_zeropoint(imgxy,refxy,searchrad=3.0,histplot=False,figure_id=1,
-                        plotname=None, interactive=True):
+                        plotname=None, interactive=True, num_cores=None):
     """ Create a matrix which contains the delta between each XY position and
         each UV position.
     """
     print('Computing initial guess for X and Y shifts...')
 
-    # run C function to create ZP matrix
-    xyshape = int(searchrad*2)+1
-    zpmat = cdriz.arrxyzero(imgxy.astype(np.float32), refxy.astype(np.float32), searchrad)
+    # create ZP matrix
+    zpmat = xy_offset_histogram(imgxy, refxy, searchrad, num_cores=num_cores)
 
     xp,yp,flux,zpqual = find_xy_peak(zpmat,center=(searchrad,searchrad))
     if zpqual is not None:
@@ -1127,6 +1221,220 @@ def build_xy_zeropoint(imgxy,refxy,searchrad=3.0,histplot=False,figure_id=1,
     return xp,yp,flux,zpqual
 
 
+def xy_offset_histogram(imgxy, refxy, searchrad, num_cores=None):
+    """ Compute the 2D histogram of the offsets between image and reference
+        positions that are closer than ``searchrad`` along both axes.
+
+        This is an indexed equivalent of ``cdriz.arrxyzero`` and it returns
+        an identical histogram: reference positions are binned in a grid of
+        cells slightly larger than ``searchrad`` so that each image
+        position is compared only to reference positions in the 3x3 cells
+        around it. Image positions are processed in chunks, in parallel
+        threads when ``num_cores`` allows it.
+
+        Parameters
+        ----------
+        imgxy : numpy.ndarray
+            ``(N, 2)`` array of image positions.
+
+        refxy : numpy.ndarray
+            ``(M, 2)`` array of reference positions.
+
+        searchrad : float
+            Maximum offset along each axis.
+
+        num_cores : int, None
+            Maximum number of threads used to compute the histogram.
+
+        Returns
+        -------
+        zpmat : numpy.ndarray
+            Histogram of offsets with ``int(2*searchrad)+1`` bins along each
+            axis. ``zpmat[j, i]`` is the number of pairs with offsets
+            ``int(dy+searchrad) == j`` and ``int(dx+searchrad) == i``.
+
+    """
+    searchrad = float(searchrad)
+    nbins = int(searchrad * 2) + 1
+
+    # offsets involving non-finite positions are never counted:
+    imgxy = np.asarray(imgxy, dtype=np.float32).reshape((-1, 2))
+    refxy = np.asarray(refxy, dtype=np.float32).reshape((-1, 2))
+    imgxy = imgxy[np.all(np.isfinite(imgxy), axis=1)]
+    refxy = refxy[np.all(np.isfinite(refxy), axis=1)]
+
+    if imgxy.shape[0] == 0 or refxy.shape[0] == 0 or not searchrad > 0:
+        return np.zeros((nbins, nbins), dtype=np.float64)
+
+    # bin positions in cells (slightly larger than 'searchrad' to guard
+    # against round-off errors) and sort reference positions by cell:
+    cell = searchrad * (1.0 + 1e-3)
+    origin = np.minimum(imgxy.min(axis=0), refxy.min(axis=0)).astype(np.float64)
+    icell = np.floor((imgxy - origin) / cell)
+    rcell = np.floor((refxy - origin) / cell)
+    ncx, ncy = np.maximum(icell.max(axis=0), rcell.max(axis=0)) + 3
+    if ncx * ncy >= 2**62:
+        # positions are too spread out to be indexed:
+        return cdriz.arrxyzero(imgxy, refxy, searchrad)
+    icell = icell.astype(np.int64) + 1
+    rcell = rcell.astype(np.int64) + 1
+    ncx = int(ncx)
+
+    rkey = rcell[:, 1] * ncx + rcell[:, 0]
+    order = np.argsort(rkey, kind='mergesort')
+    rkey = rkey[order]
+    refxy = refxy[order]
+
+    # range of sorted reference positions in each of the 9 cells around
+    # each image position:
+    lo = []
+    cnt = []
+    for oy in (-1, 0, 1):
+        for ox in (-1, 0, 1):
+            ikey = (icell[:, 1] + oy) * ncx + icell[:, 0] + ox
+            first = np.searchsorted(rkey, ikey, side='left')
+            lo.append(first)
+            cnt.append(np.searchsorted(rkey, ikey, side='right') - first)
+    lo = np.array(lo)
+    cnt = np.array(cnt)
+
+    # split image positions into chunks of about XYZERO_CHUNK pairs:
+    npairs = np.cumsum(cnt.sum(axis=0))
+    bounds = np.searchsorted(
+        npairs, np.arange(XYZERO_CHUNK, npairs[-1], XYZERO_CHUNK),
+        side='right'
+    )
+    bounds = np.unique(np.concatenate([[0], bounds, [imgxy.shape[0]]]))
+    chunks = [(imgxy[i:j], lo[:, i:j], cnt[:, i:j])
+              for i, j in zip(bounds[:-1], bounds[1:]) if j > i]
+
+    def count_offsets(chunk):
+        xy, first, n = chunk
+        first = first.ravel()
+        n = n.ravel()
+        npair = n.sum()
+        jimg = np.repeat(np.tile(np.arange(xy.shape[0]), 9), n)
+        kref = (np.repeat(first - np.cumsum(n) + n, n) +
+                np.arange(npair))
+        # offsets are computed in single precision as in 'arrxyzero':
+        dx = (xy[jimg, 0] - refxy[kref, 0]).astype(np.float64)
+        dy = (xy[jimg, 1] - refxy[kref, 1]).astype(np.float64)
+        good = (np.abs(dx) < searchrad) & (np.abs(dy) < searchrad)
+        xind = (dx[good] + searchrad).astype(np.intp)
+        yind = (dy[good] + searchrad).astype(np.intp)
+        return np.bincount(yind * nbins + xind, minlength=nbins * nbins)
+
+    pool_size = util.get_pool_size(num_cores, len(chunks))
+    if pool_size > 1:
+        pool = ThreadPool(pool_size)
+        try:
+            counts = pool.map(count_offsets, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [count_offsets(c) for c in chunks]
+
+    zpmat = np.sum(counts, axis=0).reshape((nbins, nbins))
+    return zpmat.astype(np.float64)
+
+
+def _separated(xy, separation):
+    """ Return a mask of the positions that are not closer than
+        ``separation`` to a preceding (retained) position.
+    """
+    keep = np.ones(xy.shape[0], dtype=np.bool_)
+    if separation <= 0 or xy.shape[0] < 2:
+        return keep
+    pairs = cKDTree(xy).query_pairs(separation, output_type='ndarray')
+    if len(pairs) == 0:
+        return keep
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    pairs = pairs[np.hypot(*(xy[pairs[:, 0]] - xy[pairs[:, 1]]).T) <
+                  separation]
+    for i, j in pairs:
+        if keep[i]:
+            keep[j] = False
+    return keep
+
+
+def tree_xyxymatch(inxy, refxy, origin=(0.0, 0.0), tolerance=1.0,
+                   separation=0.0):
+    """ Match input positions to reference positions using a k-d tree.
+
+        This is an alternative to the 'tolerance' algorithm of
+        ``stsci.stimage.xyxymatch`` for large catalogs: each input position,
+        shifted by ``origin``, is matched to the closest reference position
+        within ``tolerance``. Matches are one-to-one: when several input
+        positions are closest to the same reference position, only the
+        closest input position is kept.
+
+        Parameters
+        ----------
+        inxy : numpy.ndarray
+            ``(N, 2)`` array of input positions.
+
+        refxy : numpy.ndarray
+            ``(M, 2)`` array of reference positions.
+
+        origin : tuple of float
+            Offset of the input positions relative to the reference
+            positions: ``inxy - origin`` is compared to ``refxy``.
+
+        tolerance : float
+            Maximum distance between matched positions (in pixels).
+
+        separation : float
+            Minimum separation of positions in each list. A position closer
+            than ``separation`` to a preceding position in the same list is
+            not matched.
+
+        Returns
+        -------
+        matches : numpy.ndarray
+            Structured array with fields ``input_x``, ``input_y``,
+            ``input_idx``, ``ref_x``, ``ref_y`` and ``ref_idx`` (as returned by
+            ``xyxymatch``), sorted by reference index.
+
+    """
+    dtype = [('input_x', np.float64), ('input_y', np.float64),
+             ('input_idx', np.intp), ('ref_x', np.float64),
+             ('ref_y', np.float64), ('ref_idx', np.intp)]
+
+    inxy = np.asarray(inxy, dtype=np.float64).reshape((-1, 2))
+    refxy = np.asarray(refxy, dtype=np.float64).reshape((-1, 2))
+
+    iidx = np.flatnonzero(np.all(np.isfinite(inxy), axis=1))
+    ridx = np.flatnonzero(np.all(np.isfinite(refxy), axis=1))
+    iidx = iidx[_separated(inxy[iidx], separation)]
+    ridx = ridx[_separated(refxy[ridx], separation)]
+
+    if iidx.size == 0 or ridx.size == 0 or not tolerance > 0:
+        return np.zeros(0, dtype=dtype)
+
+    tree = cKDTree(refxy[ridx])
+    dist, k = tree.query(inxy[iidx] - np.asarray(origin, dtype=np.float64),
+                         k=1, distance_upper_bound=tolerance)
+    found = np.isfinite(dist)
+    dist = dist[found]
+    iidx = iidx[found]
+    rmatch = ridx[k[found]]
+
+    # keep the closest input position for each reference position:
+    order = np.lexsort((iidx, dist, rmatch))
+    rmatch, first = np.unique(rmatch[order], return_index=True)
+    iidx = iidx[order][first]
+
+    matches = np.zeros(rmatch.size, dtype=dtype)
+    matches['input_x'] = inxy[iidx, 0]
+    matches['input_y'] = inxy[iidx, 1]
+    matches['input_idx'] = iidx
+    matches['ref_x'] = refxy[rmatch, 0]
+    matches['ref_y'] = refxy[rmatch, 1]
+    matches['ref_idx'] = rmatch
+    return matches
+
+
 def build_pos_grid(start,end,nstep, mesh=False):
     """
     Return a grid of positions starting at X,Y given by 'start', and ending
@@ -16,6 +16,7 @@ import os
 import sys
 import string
 import errno
+import warnings
 
 import numpy as np
 import astropy
@@ -28,6 +29,7 @@ from stsci.tools import configobj
 from stwcs import wcsutil
 from stwcs.wcsutil import altwcs
 
+from . import asyncwriter
 from .version import *
 
 __fits_version__ = astropy.__version__
@@ -1018,18 +1020,28 @@ def getRotatedSize(corners, angle):
     return computeRange(_corners)
 
 
-def readcols(infile, cols=[0, 1, 2, 3], hms=False):
+def readcols(infile, cols=[0, 1, 2, 3], hms=False, delimiter=None):
     """
-    Read the columns from an ASCII file as numpy arrays.
+    Read the columns from an ASCII file, a FITS table or a numpy ``.npy``
+    file as numpy arrays.
 
     Parameters
     ----------
     infile : str
-        Filename of ASCII file with array data as columns.
+        Filename of ASCII file with array data as columns, of a FITS file
+        with a table or of a ``.npy`` file.
 
     cols : list of int
         List of 0-indexed column numbers for columns to be turned into numpy arrays
-        (DEFAULT- [0,1,2,3]).
+        (DEFAULT- [0,1,2,3]). Column names can be used for FITS tables and
+        ``.npy`` files with structured arrays.
+
+    hms : bool
+        Return values read from ASCII files as strings instead of converting
+        them to floating point numbers (DEFAULT- False).
+
+    delimiter : str, optional
+        Separator of values in ASCII files (DEFAULT- any whitespace).
 
     Returns
     -------
@@ -1037,31 +1049,121 @@ def readcols(infile, cols=[0, 1, 2, 3], hms=False):
         Simple list of numpy arrays in the order as specifed in the 'cols' parameter.
 
     """
+    if infile.endswith('.npy') or fileutil.isFits(infile)[0]:
+        return read_binary_columns(infile, cols)
+
+    return read_ascii_columns(infile, cols, delimiter=delimiter,
+                              dtype=np.str_ if hms else np.float64)
+
+
+def read_ascii_columns(infile, cols, mincols=None, delimiter=None,
+                       dtype=np.str_):
+    """
+    Read columns from an ASCII file as arrays.
+
+    The file is read at once and only the requested columns are extracted.
+    Blank lines, comment lines (starting with '#'), lines containing
+    'INDEF' and lines with fewer than ``mincols`` values are skipped.
+    Numerical tables with the same number of values in each line are
+    parsed in a single pass.
+
+    Parameters
+    ----------
+    infile : str
+        Filename of ASCII file with array data as columns.
+
+    cols : list of int
+        List of 0-indexed column numbers.
+
+    mincols : int, optional
+        Minimum number of values in a line (DEFAULT- largest column
+        number in ``cols`` plus one).
+
+    delimiter : str, optional
+        Separator of values (DEFAULT- any whitespace).
+
+    dtype : numpy.dtype, optional
+        Type of the returned arrays (DEFAULT- strings). A `ValueError` is
+        raised if values cannot be converted to this type.
+
+    Returns
+    -------
+    outarr : list of numpy arrays
+        List of arrays in the order as specified in ``cols``.
+
+    """
+    # lines must contain all requested columns:
+    mincols = max([mincols or 0] + [c + 1 for c in cols])
+
+    with open(infile, 'r') as fin:
+        lines = [l for l in (l.strip() for l in fin.read().splitlines())
+                 if l and l[0] != '#' and 'INDEF' not in l]
+
+    ncols = set(len(l.split(delimiter)) for l in lines)
+
+    if np.dtype(dtype).kind in 'biuf' and len(ncols) == 1 and \
+       min(ncols) >= mincols:
+        # all lines have the same number of values: parse them at once.
+        # Non-numerical values stop parsing with a warning (older numpy)
+        # or an error; such files are read line by line below:
+        sep = ' ' if delimiter is None else delimiter
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            try:
+                values = np.fromstring(sep.join(lines), dtype=dtype, sep=sep)
+            except ValueError:
+                values = np.empty(0, dtype=dtype)
+        if values.size == min(ncols) * len(lines):
+            values = values.reshape((len(lines), -1))
+            return [values[:, c].copy() for c in cols]
+
+    rows = [l.split(delimiter) for l in lines]
+    if delimiter is None:
+        rows = [r for r in rows if len(r) >= mincols]
+    else:
+        rows = [[v.strip() for v in r] for r in rows if len(r) >= mincols]
+
+    return [np.array([r[c] for r in rows], dtype=dtype) for c in cols]
+
+
+def read_binary_columns(infile, cols):
+    """
+    Read columns from a FITS table or from a numpy ``.npy`` file.
+
+    Files are memory-mapped so that only the requested columns are read
+    from disk when they are accessed.
+
+    Parameters
+    ----------
+    infile : str
+        Filename of a FITS file with a table (the first table in the file
+        is used) or of a ``.npy`` file with a 2D or a structured array.
+
+    cols : list of int or str
+        List of 0-indexed column numbers or column names.
+
+    Returns
+    -------
+    outarr : list of numpy arrays
+        List of arrays in the order as specified in ``cols``.
+
+    """
+    if infile.endswith('.npy'):
+        data = np.load(infile, mmap_mode='r')
+        names = data.dtype.names
+        if names is None:
+            data = data.reshape((data.shape[0], -1))
+            return [data[:, c] for c in cols]
+        return [data[names[c] if isinstance(c, (int, np.integer)) else c]
+                for c in cols]
+
+    with fits.open(infile, memmap=True) as ftab:
+        for extn in ftab:
+            if isinstance(extn, (fits.BinTableHDU, fits.TableHDU)):
+                return [extn.data.field(c) for c in cols]
+
+    raise ValueError("No catalog table found in '{:s}'".format(infile))
 
-    fin = open(infile,'r')
-    outarr = []
-    for l in fin.readlines():
-        l = l.strip()
-        if len(l) == 0 or len(l.split()) < len(cols) or (len(l) > 0 and l[0] == '#' or (l.find("INDEF") > -1)): continue
-        for i in range(10):
-            lnew = l.replace("  "," ")
-            if lnew == l: break
-            else: l = lnew
-        lspl = lnew.split(" ")
-
-        if len(outarr) == 0:
-            for c in range(len(cols)): outarr.append([])
-
-        for c,n in zip(cols,list(range(len(cols)))):
-            if not hms:
-                val = float(lspl[c])
-            else:
-                val = lspl[c]
-            outarr[n].append(val)
-    fin.close()
-    for n in range(len(cols)):
-        outarr[n] = np.array(outarr[n])
-    return outarr
 
 def parse_colnames(colnames,coords=None):
     """ Convert colnames input into list of column numbers.
@@ -1105,11 +1207,15 @@ def parse_colnames(colnames,coords=None):
     return cols
 
 
-def createFile(dataArray=None, outfile=None, header=None):
+def createFile(dataArray=None, outfile=None, header=None, background=False):
     """
     Create a simple fits file for the given data array and header.
     Returns either the FITS object in-membory when outfile==None or
     None when the FITS file was written out to a file.
+
+    When background is True, the file is handed over to the background
+    writer (see `asyncwriter`) which then owns dataArray; the file is
+    guaranteed to be on disk only after `asyncwriter.flush()` returns.
     """
     # Insure that at least a data-array has been provided to create the file
     assert(dataArray is not None), "Please supply a data array for createFiles"
@@ -1145,10 +1251,16 @@ def createFile(dataArray=None, outfile=None, header=None):
 
         fitsobj.append(hdu)
         if outfile is not None:
-            fitsobj.writeto(outfile)
+            if background:
+                # the writer closes the file once it has been written out
+                asyncwriter.writeto(fitsobj, outfile)
+                fitsobj = None
+            else:
+                fitsobj.writeto(outfile)
     finally:
         # CLOSE THE IMAGE FILES
-        fitsobj.close()
+        if fitsobj is not None:
+            fitsobj.close()
 
         if outfile is not None:
             del fitsobj
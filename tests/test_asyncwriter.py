@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from drizzlepac.asyncwriter import FITSWriter
+
+
+def test_write_behind(tmpdir):
+    data = np.arange(100, dtype=np.float32).reshape(10, 10)
+    names = [str(tmpdir.join('out{:d}.fits'.format(k))) for k in range(4)]
+
+    # budget smaller than two products forces backpressure:
+    writer = FITSWriter(max_bytes=data.nbytes + 1)
+    for k, fname in enumerate(names):
+        writer.writeto(fits.HDUList([fits.PrimaryHDU(data + k)]), fname)
+        assert writer.pending <= data.nbytes
+    writer.flush()
+    assert writer.pending == 0
+
+    for k, fname in enumerate(names):
+        assert np.array_equal(fits.getdata(fname), data + k)
+
+
+def test_errors_raised_on_flush(tmpdir):
+    fname = str(tmpdir.join('out.fits'))
+    fits.PrimaryHDU(np.zeros(5)).writeto(fname)
+
+    writer = FITSWriter()
+    writer.writeto(fits.HDUList([fits.PrimaryHDU(np.ones(5))]), fname)
+    with pytest.raises(IOError):
+        writer.flush()
+
+    # errors are reported only once:
+    writer.flush()
@@ -0,0 +1,65 @@
+import numpy as np
+from astropy import wcs as pywcs
+import astropy.coordinates as coords
+
+from drizzlepac import catalogs
+
+
+def _catalog(nsrc=5000):
+    w = pywcs.WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [150.0, 2.0]
+    w.wcs.crpix = [500.0, 500.0]
+    w.wcs.cdelt = [-1e-5, 1e-5]
+    w.pscale = 0.036
+
+    x, y = np.random.uniform(0, 1000, (2, nsrc))
+    ra, dec = w.all_pix2world(x, y, 1)
+    catalog = catalogs.Catalog.__new__(catalogs.Catalog)
+    catalog.wcs = w
+    catalog.radec = [ra, dec, np.arange(nsrc)]
+    catalog.xypos = [x, y, np.arange(nsrc)]
+    return catalog
+
+
+def _outside(catalog, regions):
+    src = coords.SkyCoord(catalog.radec[0], catalog.radec[1], unit='deg')
+    keep = np.ones(len(catalog.radec[0]), dtype=bool)
+    for ra, dec, dist in regions:
+        sep = coords.SkyCoord(ra, dec, unit='deg').separation(src)
+        keep &= sep.arcsec > dist
+    return keep
+
+
+def test_apply_exclusions_sky_regions(tmpdir):
+    np.random.seed(9)
+    catalog = _catalog()
+    x, dec = catalog.xypos[0], catalog.radec[1]
+    regions = [(150.002, 2.003, 3.6), (149.998, 1.996, 10.0)]
+    expected = _outside(catalog, regions)
+
+    regfile = tmpdir.join('exclusions.reg')
+    regfile.write('fk5\n' + ''.join('circle({},{},{}")\n'.format(*r)
+                                    for r in regions))
+    keep = catalog.apply_exclusions(str(regfile))
+
+    assert 0 < np.count_nonzero(~keep)
+    assert np.array_equal(keep, expected)
+    assert np.array_equal(catalog.xypos[0], x[keep])
+    assert np.array_equal(catalog.radec[1], dec[keep])
+    assert np.array_equal(catalog.xypos[-1], np.arange(np.count_nonzero(keep)))
+
+
+def test_apply_exclusions_pixel_regions(tmpdir):
+    np.random.seed(10)
+    catalog = _catalog()
+    ra, dec = catalog.wcs.all_pix2world([[300.0, 700.0], [800.0, 200.0]], 1).T
+    expected = _outside(catalog, [(ra[0], dec[0], 50 * 0.036),
+                                  (ra[1], dec[1], 120 * 0.036)])
+
+    regfile = tmpdir.join('exclusions.reg')
+    regfile.write('image\ncircle(300,700,50)\n800 200 120\n')
+    keep = catalog.apply_exclusions(str(regfile))
+
+    assert 0 < np.count_nonzero(~keep)
+    assert np.array_equal(keep, expected)
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+from drizzlepac import catcache
+
+
+def _sources(n):
+    x = np.arange(n, dtype=float)
+    return (x, x + 1, 10 * x, np.arange(n), None, None, None)
+
+
+def test_catalog_key():
+    data = np.arange(100, dtype=np.float32).reshape((10, 10))
+    mask = data > 50
+    pars = {'threshold': 4.0, 'conv_width': 3.5}
+
+    key = catcache.catalogKey(data, mask, pars)
+    assert key == catcache.catalogKey(data.copy(), mask.copy(), dict(pars))
+    assert key != catcache.catalogKey(data, None, pars)
+    assert key != catcache.catalogKey(data, mask, {'threshold': 5.0,
+                                                   'conv_width': 3.5})
+    data[0, 0] = 1.0
+    assert key != catcache.catalogKey(data, mask, pars)
+    assert catcache.catalogKey(data, mask, pars, 'missing.reg') is None
+
+
+def test_cache_get_put_evict(tmpdir):
+    cache = catcache.CatalogCache(str(tmpdir.join('cache')))
+    assert cache.get('a') is None
+
+    cache.put('a', _sources(10))
+    sources = cache.get('a')
+    assert sources[4:] == (None, None, None)
+    for got, expected in zip(sources[:4], _sources(10)[:4]):
+        assert np.array_equal(got, expected)
+
+    # keep only the most recently used catalogs:
+    size = cache.nbytes
+    cache.max_bytes = 2 * size
+    cache.put('b', _sources(10))
+    os.utime(cache._file('a'), (0, 0))
+    os.utime(cache._file('b'), (1, 1))
+    cache.put('c', _sources(10))
+    assert len(cache) == 2
+    assert cache.get('a') is None
+    assert cache.get('b') is not None and cache.get('c') is not None
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from drizzlepac.imageObject import ChipDataCache
+
+
+def _write(fname, data, **kw):
+    hdr = fits.Header(kw)
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(data, header=hdr, name='SCI', ver=1)]
+                 ).writeto(fname, overwrite=True)
+
+
+def test_hits_misses_and_eviction(tmpdir):
+    data = np.arange(200, dtype=np.float32).reshape(10, 20)
+    names = [str(tmpdir.join('img{:d}.fits'.format(k))) for k in range(3)]
+    for k, fname in enumerate(names):
+        _write(fname, data + k)
+
+    cache = ChipDataCache(max_bytes=2 * data.nbytes)
+    for fname in names[:2]:
+        cache.get(fname, 'sci', 1)
+    arr = cache.get(names[0], 'SCI', 1)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert not arr.flags.writeable
+    assert np.array_equal(arr, data)
+
+    # names[1] is the least recently used array:
+    cache.get(names[2], 'sci', 1)
+    assert len(cache) == 2
+    cache.get(names[0], 'sci', 1)
+    cache.get(names[1], 'sci', 1)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_reread_modified_file(tmpdir):
+    fname = str(tmpdir.join('img.fits'))
+    data = np.ones((8, 8), dtype=np.int16)
+    _write(fname, data, BZERO=0, BSCALE=1)
+
+    cache = ChipDataCache()
+    assert cache.get(fname, 'sci', 1).sum() == 64
+
+    _write(fname, 2 * data, BZERO=32768, BSCALE=1)
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 10))
+    assert cache.get(fname, 'sci', 1).sum() == 128
+    assert len(cache) == 1
+    assert cache.get(str(tmpdir.join('missing.fits')), 'sci', 1) is None
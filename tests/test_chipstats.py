@@ -0,0 +1,62 @@
+import numpy as np
+from astropy.io import fits
+from stsci.imagestats import ImageStats
+
+from drizzlepac.chipstats import ChipStatistics
+
+
+class _Chip(object):
+    pass
+
+
+class _Image(dict):
+    """ Minimal stand-in for an imageObject with one SCI extension. """
+    scienceExt = 'SCI'
+
+    def __init__(self, filename):
+        dict.__init__(self)
+        self._filename = filename
+        self[('SCI', 1)] = _Chip()
+        self.ncalls = 0
+
+    def getData(self, exten):
+        self.ncalls += 1
+        return fits.getdata(self._filename, ext=('SCI', 1))
+
+
+def test_stats_shared_and_refreshed(tmpdir):
+    fname = str(tmpdir.join('img_flt.fits'))
+    np.random.seed(0)
+    data = np.random.normal(10.0, 2.0, (64, 64)).astype(np.float32)
+    data[::5, ::7] = 1000.0
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(data, name='SCI', ver=1)]).writeto(fname)
+
+    image = _Image(fname)
+    stats = ChipStatistics()
+    stats.compute([(image, 1)], fields='mode,stddev', num_cores=1, nclip=3)
+    assert len(stats) == 1
+
+    s = stats.get(image, 1, fields='mode', nclip=3)
+    ref = ImageStats(data, nclip=3, fields='mode,median')
+    assert s.mode == ref.mode
+    assert s.stddev == ref.stddev
+    assert s.nbins == len(ref.histogram)
+    assert not hasattr(s, 'median')
+    assert image.ncalls == 0
+
+    # missing fields are computed and added to the cached statistics:
+    s = stats.get(image, 1, fields='median', nclip=3)
+    assert image.ncalls == 1
+    assert s.median == ref.median and s.mode == ref.mode
+    stats.get(image, 1, fields='mode,median,mean', nclip=3)
+    assert image.ncalls == 1
+    assert len(stats) == 1
+
+    # different clipping parameters are computed separately:
+    stats.get(image, 1, fields='median', nclip=5, lsig=4.0, usig=4.0)
+    assert len(stats) == 2
+
+    fits.setval(fname, 'FOO', value=1, ext=1)
+    stats.get(image, 1, fields='mode', nclip=3)
+    assert len(stats) == 3
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import stsci.convolve as NC
+
+from drizzlepac import drizCR
+
+
+def _reference_crmask(inp, blot, deriv, gain, rn, backg, snr, scale,
+                      grow, ctegrow, ctedir):
+    """ Original (untiled) driz_cr mask computation. """
+    t1 = np.absolute(inp - blot)
+    ta = np.sqrt(gain * np.absolute(blot + backg) + rn * rn)
+    tmp1 = np.logical_not(np.greater(t1, scale[0] * deriv + snr[0] * ta / gain))
+    tmp2 = np.zeros(tmp1.shape, dtype=np.int16)
+    NC.convolve2d(tmp1, np.ones((3, 3), dtype=np.uint8), output=tmp2, fft=0,
+                  mode='nearest', cval=0)
+    crmask = np.logical_not(
+        np.greater(t1, scale[1] * deriv + snr[1] * ta / gain) &
+        np.less(tmp2, 9)
+    ).astype(np.int8)
+
+    grow_conv = crmask.copy()
+    NC.convolve2d(crmask, np.ones((grow, grow)), output=grow_conv)
+
+    cte_kernel = np.zeros((2 * ctegrow + 1, 2 * ctegrow + 1))
+    if ctedir == 1:
+        cte_kernel[0:ctegrow, ctegrow] = 1
+    elif ctedir == -1:
+        cte_kernel[ctegrow + 1:2 * ctegrow + 1, ctegrow] = 1
+    cte_conv = crmask.copy()
+    NC.convolve2d(crmask, cte_kernel, output=cte_conv)
+
+    return np.logical_and(np.where(cte_conv < ctegrow, 0, 1),
+                          np.where(grow_conv < grow * grow, 0, 1)
+                          ).astype(np.uint8)
+
+
+@pytest.mark.parametrize('grow,ctegrow,ctedir,tile_nrows', [
+    (1, 0, 0, 256), (1, 0, 0, 7), (3, 0, 0, 5), (2, 3, 1, 4), (3, 2, -1, 1)
+])
+def test_crmask_matches_reference(grow, ctegrow, ctedir, tile_nrows):
+    rng = np.random.RandomState(1)
+    blot = rng.normal(100.0, 10.0, (61, 47)).astype(np.float32)
+    inp = blot + rng.normal(0.0, 10.0, blot.shape).astype(np.float32)
+    inp[rng.uniform(size=blot.shape) < 0.02] += 500.0
+    deriv = np.abs(rng.normal(0.0, 3.0, blot.shape)).astype(np.float32)
+    pars = dict(gain=7.0, rn=5.0, backg=3.0, snr=(3.5, 3.0), scale=(1.2, 0.7),
+                grow=grow, ctegrow=ctegrow, ctedir=ctedir)
+
+    crmask = drizCR._crMask(inp, blot, deriv, tile_nrows=tile_nrows, **pars)
+    assert crmask.dtype == np.uint8
+    assert np.array_equal(crmask, _reference_crmask(inp, blot, deriv, **pars))
@@ -0,0 +1,136 @@
+import numpy as np
+
+from drizzlepac import findobj
+
+
+def _boxes(nsrc=200, seed=3):
+    np.random.seed(seed)
+    nx, ny, a, b, c, f = findobj.gausspars(2.5, nsigma=1.5)
+    yin, xin = np.mgrid[0:ny, 0:nx]
+    kernel = findobj.gaussian1(1.0, nx // 2, ny // 2, a, b, c)(xin, yin)
+    data = np.random.normal(10.0, 3.0, (nsrc, ny, nx)).astype(np.float32)
+    data += (np.random.lognormal(4, 1, nsrc)[:, None, None] *
+             kernel).astype(np.float32)
+    return data, kernel
+
+
+def test_box_centroids_match_centroid():
+    np.random.seed(1)
+    image = np.random.uniform(0, 100, (60, 80)).astype(np.float32)
+    y0 = np.random.randint(0, 40, 50)
+    x0 = np.random.randint(0, 60, 50)
+    y1 = y0 + np.random.randint(3, 15, 50)
+    x1 = x0 + np.random.randint(3, 15, 50)
+
+    xcen, ycen = findobj._box_centroids(image, y0, y1, x0, x1)
+    for i in range(50):
+        cx, cy = findobj.centroid(image[y0[i]:y1[i], x0[i]:x1[i]])
+        assert xcen[i] == cx and ycen[i] == cy
+
+
+def test_xy_round_batch_matches_xy_round():
+    data, kernel = _boxes()
+    ny, nx = kernel.shape
+    xsigsq = (2.5 / findobj.fwhm2sig)**2
+    datamin = data.reshape((data.shape[0], -1)).min(axis=1)
+    datamax = data.reshape((data.shape[0], -1)).max(axis=1)
+
+    x, y, rnd, defined = findobj._xy_round_batch(
+        data, nx // 2, ny // 2, 10.0, kernel, xsigsq, xsigsq, datamin, datamax
+    )
+    for i in range(data.shape[0]):
+        px, py, r = findobj.xy_round(data[i], nx // 2, ny // 2, 10.0, kernel,
+                                     xsigsq, xsigsq, datamin[i], datamax[i])
+        if px is None:
+            assert not defined[i]
+        else:
+            assert defined[i]
+            # the compiled routine may differ in the last bits depending
+            # on compiler optimizations:
+            assert np.allclose((x[i], y[i], rnd[i]), (px, py, r),
+                               rtol=1e-12, atol=1e-15)
+
+
+def test_sharp_round_batch_matches_sharp_round():
+    data, kernel = _boxes()
+    ny, nx = kernel.shape
+    xc, yc = nx // 2, ny // 2
+    density = (data - 10.0).astype(np.float32)
+    kskip = np.ones((ny, nx), dtype=np.int16)
+    s2m, s4m = findobj.precompute_sharp_round(nx, ny, xc, yc)
+    datamin = data.reshape((data.shape[0], -1)).min(axis=1)
+    datamax = data.reshape((data.shape[0], -1)).max(axis=1)
+
+    satur, rnd, sharp, defined = findobj._sharp_round_batch(
+        data, density, kskip, xc, yc, s2m, s4m, datamin, datamax
+    )
+    for i in range(data.shape[0]):
+        s, r, sh = findobj.sharp_round(data[i], density[i], kskip, xc, yc,
+                                       s2m, s4m, nx, ny, datamin[i],
+                                       datamax[i])
+        assert satur[i] == s
+        if r is None or sh is None:
+            assert not defined[i]
+        else:
+            assert defined[i]
+            assert rnd[i] == r and sharp[i] == sh
+
+
+def test_tiled_findstars_matches_single_pass():
+    np.random.seed(5)
+    image = np.random.normal(10.0, 3.0, (300, 260)).astype(np.float32)
+    yy, xx = np.mgrid[-4:5, -4:5]
+    for x, y in np.random.uniform(5, 250, (400, 2)):
+        ix, iy = int(x), int(y)
+        psf = np.exp(-((xx - x + ix)**2 + (yy - y + iy)**2) / 2.88)
+        image[iy - 4:iy + 5, ix - 4:ix + 5] += \
+            (np.random.lognormal(5, 1) * psf).astype(np.float32)
+    # a streak crossing all tiles:
+    image[100, :] += 200
+    mask = np.random.uniform(size=image.shape) > 0.01
+
+    kwargs = dict(use_sharp_round=True, fluxmin=5.0, mask=mask)
+    stars, fluxes = findobj.findstars(image, 2.5, 15.0, 10.0, **kwargs)
+    tstars, tfluxes = findobj.findstars(image, 2.5, 15.0, 10.0, tile_size=64,
+                                        num_cores=1, **kwargs)
+    assert len(stars) > 100
+    assert np.array_equal(np.array(stars, dtype=float),
+                          np.array(tstars, dtype=float), equal_nan=True)
+    assert fluxes == tfluxes
+
+
+def test_tiled_findstars_with_chip_wide_segment():
+    np.random.seed(7)
+    image = np.random.normal(10.0, 3.0, (300, 260)).astype(np.float32)
+    yy, xx = np.mgrid[-4:5, -4:5]
+    for x, y in np.random.uniform(5, 250, (400, 2)):
+        ix, iy = int(x), int(y)
+        psf = np.exp(-((xx - x + ix)**2 + (yy - y + iy)**2) / 2.88)
+        image[iy - 4:iy + 5, ix - 4:ix + 5] += \
+            (np.random.lognormal(5, 1) * psf).astype(np.float32)
+    # a saturated column starting in the first tile: its halo grows to
+    # the entire chip while the other tiles return their own sources:
+    image[:, 20] += 500
+
+    kwargs = dict(use_sharp_round=False, fluxmin=5.0)
+    stars, fluxes = findobj.findstars(image, 2.5, 15.0, 10.0, **kwargs)
+    tstars, tfluxes = findobj.findstars(image, 2.5, 15.0, 10.0, tile_size=64,
+                                        num_cores=1, **kwargs)
+    assert len(stars) > 100
+    assert np.array_equal(np.array(stars, dtype=float),
+                          np.array(tstars, dtype=float), equal_nan=True)
+    assert fluxes == tfluxes
+
+    # each segment is owned by exactly one tile, also when the halo of a
+    # tile covers the entire chip:
+    kpars = findobj._kernel_pars(2.5, 1.5, 1.0, 0.0)
+    pars = dict(fwhm=2.5, threshold=15.0, skymode=10.0, **kwargs)
+    nobj, keys, src, flx = findobj._findstars_tile(
+        image, None, kpars, (0, 300, 0, 260), 0, **pars
+    )
+    tiles = [findobj._findstars_tile(image, None, kpars,
+                                     (y, y + 64, x, x + 64), 1000, **pars)
+             for y in range(0, 300, 64) for x in range(0, 260, 64)]
+    tkeys = np.concatenate([t[1] for t in tiles])
+    assert sum(t[0] for t in tiles) == nobj
+    assert np.unique(tkeys).size == tkeys.size == len(src)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from drizzlepac import imgclasses
+
+
+def test_refimage_select_sources():
+    np.random.seed(6)
+    refimage = imgclasses.RefImage.__new__(imgclasses.RefImage)
+    refimage.outxy = np.random.uniform(-5000, 5000, (100000, 2))
+    refimage.outxy[:10] = np.nan
+    refimage._yindex = None
+
+    xy = np.random.uniform(100, 600, (50, 2))
+    idx = refimage.select_sources(xy, 2.5)
+
+    x, y = refimage.outxy.T
+    with np.errstate(invalid='ignore'):
+        inside = ((x >= xy[:, 0].min() - 2.5) & (x <= xy[:, 0].max() + 2.5) &
+                  (y >= xy[:, 1].min() - 2.5) & (y <= xy[:, 1].max() + 2.5))
+    assert np.array_equal(idx, np.flatnonzero(inside))
+    assert refimage.select_sources(np.zeros((0, 2)), 2.5).size == 0
+
+
+class _MatchedImage(object):
+    def __init__(self, nsrc, nmatched):
+        self.goodmatch = True
+        self.identityfit = False
+        self.outxy = np.random.uniform(0, 2000, (nsrc, 2))
+        self.all_radec = [np.zeros(nsrc), np.zeros(nsrc),
+                          np.random.uniform(1, 10, nsrc), np.arange(nsrc)]
+        self.xy_catalog = [self.outxy[:, 0], self.outxy[:, 1],
+                           self.all_radec[2], np.arange(nsrc),
+                           np.asarray(nsrc * ['img'], dtype=object)]
+        self.matches = {'input_idx': np.random.permutation(nsrc)[:nmatched]}
+        self.fit = {'offset': np.array([1.5, -0.5]),
+                    'fit_matrix': np.array([[1.0, 1e-4], [-1e-4, 1.0]])}
+
+
+def test_refimage_append_not_matched_sources():
+    from astropy import wcs as pywcs
+
+    np.random.seed(8)
+    refimage = imgclasses.RefImage.__new__(imgclasses.RefImage)
+    refimage.wcs = pywcs.WCS(naxis=2)
+    refimage.wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    refimage.wcs.wcs.crval = [10.0, 20.0]
+    refimage.wcs.wcs.crpix = [1000.0, 1000.0]
+    refimage.wcs.wcs.cdelt = [-1e-5, 1e-5]
+    refimage.dirty = False
+    refimage._yindex = None
+    refimage._store = None
+    refimage._hull_xy = None
+
+    image = _MatchedImage(200, 0)
+    refimage.outxy = image.outxy.copy()
+    refimage.all_radec = [c.copy() for c in image.all_radec]
+    refimage.xy_catalog = [np.asarray(c).copy() for c in image.xy_catalog]
+    expected = [refimage.outxy]
+
+    for k in range(10):
+        image = _MatchedImage(300, 250)
+        refimage.append_not_matched_sources(image)
+        mask = np.ones(300, dtype=bool)
+        mask[image.matches['input_idx']] = False
+        expected.append(np.dot(image.outxy[mask] - image.fit['offset'] -
+                               refimage.wcs.wcs.crpix,
+                               image.fit['fit_matrix'].T) +
+                        refimage.wcs.wcs.crpix)
+
+    expected = np.concatenate(expected)
+    nsrc = expected.shape[0]
+    assert np.array_equal(refimage.outxy, expected)
+    assert all(len(c) == nsrc for c in refimage.all_radec + refimage.xy_catalog)
+    assert np.array_equal(refimage.all_radec[3], np.arange(nsrc))
+    assert list(refimage.xy_catalog[-1]) == nsrc * ['img']
+
+    hull = imgclasses.convex_hull(list(map(tuple, expected)))
+    assert np.array_equal(refimage._hull_xy, np.asarray(hull))
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from drizzlepac import buildmask
+from drizzlepac.imageObject import baseImageObject
+
+
+class _DQImage(baseImageObject):
+    """ Minimal imageObject with a single chip and a DQ array on disk. """
+    def __init__(self, dqfile):
+        baseImageObject.__init__(self, dqfile)
+        self._image = fits.HDUList([fits.PrimaryHDU(),
+                                    fits.ImageHDU(name='SCI')])
+        self._image['SCI', 1].dqfile = dqfile
+        self.nbuild = 0
+
+    def buildMask(self, chip, bits=0, write=False):
+        self.nbuild += 1
+        return buildmask.buildMask(fits.getdata(self._filename), bits)
+
+
+def test_combined_mask_cache(tmpdir):
+    rng = np.random.RandomState(0)
+    dq = np.where(rng.uniform(size=(13, 17)) < 0.3, 4096, 0).astype(np.int16)
+    dq[rng.uniform(size=dq.shape) < 0.2] |= 16
+    static = (rng.uniform(size=dq.shape) > 0.2).astype(np.uint8)
+    dqfile = str(tmpdir.join('dq.fits'))
+    smask = str(tmpdir.join('static.fits'))
+    fits.writeto(dqfile, dq)
+    fits.writeto(smask, static)
+
+    img = _DQImage(dqfile)
+    ref = ((dq & ~4096) == 0).astype(np.uint8) & static
+    for k in range(2):
+        mask = img.getCombinedMask(1, bits=4096, staticmask=smask)
+        assert mask.dtype == np.uint8
+        assert np.array_equal(mask, ref)
+        mask[:] = 0  # callers own the returned array
+    assert img.nbuild == 1
+
+    img.getCombinedMask(1, bits=0, staticmask=smask)
+    assert img.nbuild == 2
+
+    # updating the DQ array invalidates all masks for the chip:
+    fits.writeto(dqfile, dq | 4096, overwrite=True)
+    st = os.stat(dqfile)
+    os.utime(dqfile, (st.st_atime, st.st_mtime + 10))
+    mask = img.getCombinedMask(1, bits=0, staticmask=smask)
+    assert img.nbuild == 3
+    assert not mask.any()
+    assert len(img._maskCache) == 1
+
+
+def test_replaced_virtual_mask(tmpdir):
+    dq = np.zeros((9, 8), dtype=np.int16)
+    dqfile = str(tmpdir.join('dq.fits'))
+    fits.writeto(dqfile, dq)
+    img = _DQImage(dqfile)
+
+    for k in range(5):
+        # replace the virtual static mask with a new object that may be
+        # allocated at the address of the released one:
+        static = np.zeros(dq.shape, dtype=np.uint8)
+        static[k] = 1
+        smask = buildmask.PackedMask(static)
+        mask = img.getCombinedMask(1, bits=0, staticmask=smask)
+        assert np.array_equal(mask, static)
+        del smask
+    assert img.nbuild == 5
+
+    versions = [buildmask.PackedMask(static).mask_version for k in range(3)]
+    assert versions == sorted(set(versions))
+
+
+def test_packed_mask():
+    rng = np.random.RandomState(1)
+    mask = (rng.uniform(size=(11, 7)) > 0.3).astype(np.int16)
+    packed = buildmask.PackedMask(mask)
+    assert packed.nbytes == 10
+    assert packed.sum() == mask.sum()
+    assert np.array_equal(packed.data, mask)
+    assert packed.unpack().dtype == np.bool_
+
+    dqarr = np.ones(mask.shape, dtype=np.uint8)
+    buildmask.mergeDQarray(packed, dqarr)
+    assert np.array_equal(dqarr, mask)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from drizzlepac import quickDeriv
+
+
+def _reference_qderiv(array):
+    """ Original float64 implementation of quickDeriv.qderiv(). """
+    outArray = np.zeros(array.shape, dtype=np.float64)
+    (naxis1, naxis2) = array.shape
+    shifts = [
+        ((slice(0, naxis1-1), slice(1, naxis2-1)),
+         (slice(0, naxis1-1), slice(0, naxis2-2))),
+        ((slice(0, naxis1-1), slice(0, naxis2-2)),
+         (slice(0, naxis1-1), slice(1, naxis2-1))),
+        ((slice(1, naxis1-1), slice(0, naxis2-1)),
+         (slice(0, naxis1-2), slice(0, naxis2-1))),
+        ((slice(0, naxis1-2), slice(0, naxis2-1)),
+         (slice(1, naxis1-1), slice(0, naxis2-1)))
+    ]
+    for dst, src in shifts:
+        tmpArray = np.zeros(array.shape, dtype=np.float64)
+        tmpArray[dst] = array[src]
+        outArray = np.maximum(np.fabs(array - tmpArray), outArray)
+    return outArray.astype(np.float32)
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (2, 3), (5, 4), (131, 67)])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.int16])
+@pytest.mark.parametrize('nthreads,tile_nrows', [(1, 512), (4, 7), (3, 1)])
+def test_qderiv_matches_reference(shape, dtype, nthreads, tile_nrows):
+    rng = np.random.RandomState(0)
+    array = (1000.0 * rng.normal(size=shape)).astype(dtype)
+
+    deriv = quickDeriv.qderiv(array, nthreads=nthreads, tile_nrows=tile_nrows)
+
+    assert deriv.dtype == np.float32
+    assert np.array_equal(deriv, _reference_qderiv(array))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from drizzlepac import rawfile
+
+
+def test_roundtrip(tmpdir):
+    fname = str(tmpdir.join('img_single_sci.fits'))
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    hdr = fits.Header([('CRVAL1', 5.5), ('CTYPE1', 'RA---TAN')])
+
+    assert not rawfile.exists(fname)
+    rawfile.write(fname, data, hdr)
+    assert rawfile.exists(fname)
+    assert rawfile.rawName(fname) == str(tmpdir.join('img_single_sci.npy'))
+
+    arr = rawfile.getdata(fname)
+    assert isinstance(arr, np.memmap)
+    assert not arr.flags.writeable
+    assert np.array_equal(arr[1:3], data[1:3])
+    assert rawfile.getheader(fname)['CRVAL1'] == 5.5
+    del arr
+
+    rawfile.remove(fname)
+    assert not rawfile.exists(fname)
+    assert not tmpdir.listdir()
+
+
+def test_configure():
+    try:
+        rawfile.configure('npy', keep_fits=False)
+        assert rawfile.enabled() and not rawfile.keep_fits()
+        rawfile.configure('npy', keep_fits=True)
+        assert rawfile.enabled() and rawfile.keep_fits()
+        with pytest.raises(ValueError):
+            rawfile.configure('hdf5')
+    finally:
+        rawfile.configure()
+    assert not rawfile.enabled() and rawfile.keep_fits()
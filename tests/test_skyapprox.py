@@ -0,0 +1,43 @@
+import numpy as np
+from stsci.imagestats import ImageStats
+
+from drizzlepac.sky import _sampledSkyValue
+
+STATPARS = {'lower': None, 'upper': None, 'nclip': 5, 'lsig': 4.0,
+            'usig': 4.0, 'binwidth': 0.1}
+
+
+def _skyImage():
+    np.random.seed(1)
+    data = np.random.normal(100.0, 5.0, (1024, 1024)).astype(np.float32)
+    # a few bright "sources":
+    data[100:140, 200:260] += 500.0
+    data[700:720, 800:830] += 1000.0
+    return data
+
+
+def test_sampled_sky_matches_full():
+    data = _skyImage()
+    mask = np.ones(data.shape, dtype=np.uint8)
+    mask[:, :10] = 0
+    data[:, :10] = -1e5
+
+    sky, err, nsample = _sampledSkyValue(data, mask, 'median', STATPARS,
+                                         0.01, 0.05)
+    full = ImageStats(data[:, 10:], fields='median', **STATPARS).median
+
+    assert err is not None
+    assert nsample < data.size // 50
+    assert abs(sky - full) < 5 * err + 0.01
+    assert err < 0.05 * 5.0
+
+
+def test_sampled_sky_falls_back_to_full():
+    data = _skyImage()
+    sky, err, nsample = _sampledSkyValue(data, None, 'median', STATPARS,
+                                         0.01, 1e-6)
+    full = ImageStats(data, fields='npix,median', **STATPARS)
+
+    assert err is None
+    assert nsample == full.npix
+    assert sky == full.median
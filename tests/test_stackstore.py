@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from drizzlepac.stackstore import StackStore
+
+
+def test_insert_remove_read_section(tmpdir):
+    rng = np.random.RandomState(0)
+    shape = (37, 23)
+    names = ['img{:d}'.format(k) for k in range(5)]
+    data = {n: rng.normal(size=shape).astype(np.float32) for n in names}
+    wht = {n: rng.uniform(size=shape).astype(np.float32) for n in names}
+
+    store = StackStore(str(tmpdir.join('store')), shape, np.float32)
+    for n in names[:4]:
+        store.insert(n, data[n], wht[n], signature=n)
+    store.remove('img1')
+    store.insert('img4', data['img4'], wht['img4'])
+
+    # re-open from disk and reconstruct stacks in an arbitrary order:
+    store = StackStore(str(tmpdir.join('store')), shape, np.float32)
+    order = ['img4', 'img0', 'img3', 'img2']
+    assert store.depth == 4
+    assert store.signature('img3') == 'img3'
+
+    sci, wts = store.read_section(5, 33, order)
+    assert np.array_equal(sci, np.stack([data[n][5:33] for n in order]))
+    assert np.array_equal(wts, np.stack([wht[n][5:33] for n in order]))
+
+
+def test_update_touches_only_changed_members(tmpdir):
+    rng = np.random.RandomState(1)
+    shape = (25, 11)
+    names = ['img{:d}'.format(k) for k in range(4)]
+    data = {n: rng.normal(size=shape).astype(np.float32) for n in names}
+    wht = {n: rng.uniform(size=shape).astype(np.float32) for n in names}
+
+    path = str(tmpdir.join('store'))
+    store = StackStore(path, shape, np.float32)
+    store.update([(n, data[n], wht[n], 'sig0', {'k': k})
+                  for k, n in enumerate(names[:3])])
+    assert store.depth == 3
+    img2_files = [os.path.join(path, f) for f in os.listdir(path)
+                  if f.startswith('member00002_')]
+    assert len(img2_files) == 2
+    stats = [os.stat(f) for f in img2_files]
+
+    # replace, add and remove members; other members' files are untouched:
+    data['img1'] = data['img1'] + 1
+    store.update([('img1', data['img1'], None, 'sig1', None),
+                  ('img3', data['img3'], wht['img3'], 'sig0', None)],
+                 remove=['img0'])
+    assert store.signature('img1') == 'sig1'
+    assert store.signature('img0') is None
+    assert store.info('img2') == {'k': 2}
+    for f, st in zip(img2_files, stats):
+        assert os.stat(f).st_mtime_ns == st.st_mtime_ns
+    assert len(os.listdir(path)) == 1 + 2 * store.depth
+
+    order = ['img3', 'img1', 'img2']
+    sci, wts = store.read_section(0, 25, order)
+    assert np.array_equal(sci, np.stack([data[n] for n in order]))
+    assert np.array_equal(wts[1], np.ones(shape, dtype=np.float32))
+    assert np.array_equal(wts[2], wht['img2'])
+
+    store.sync([])
+    assert store.depth == 0
+    assert sorted(os.listdir(path)) == ['stackstore.json']
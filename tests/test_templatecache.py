@@ -0,0 +1,35 @@
+import numpy as np
+from astropy.io import fits
+
+from drizzlepac import outputimage
+
+
+def test_templates_built_once(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('img_flt.fits'))
+    fits.PrimaryHDU(np.zeros((2, 2))).writeto(fname)
+
+    calls = []
+
+    def single_template(name):
+        calls.append(name)
+        return [fits.Header([('FOO', 1)]), fits.Header([('BSCALE', 2)]),
+                fits.Header(), fits.Header()]
+
+    monkeypatch.setattr(outputimage.blendheaders, 'getSingleTemplate',
+                        single_template)
+    outputimage.clearTemplateCache()
+    try:
+        hdrs, tab = outputimage.getTemplates([fname + '[0]'], blend=False)
+        hdrs[0]['FOO'] = 2
+        hdrs, tab = outputimage.getTemplates([fname + '[0]'], blend=False)
+        assert len(calls) == 1
+        assert tab is None
+        assert hdrs[0]['FOO'] == 1
+        assert 'BSCALE' not in hdrs[1]
+
+        # templates are rebuilt when input headers change:
+        fits.setval(fname, 'BAR', value=1)
+        outputimage.getTemplates([fname + '[0]'], blend=False)
+        assert len(calls) == 2
+    finally:
+        outputimage.clearTemplateCache()
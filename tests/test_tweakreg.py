@@ -0,0 +1,32 @@
+import numpy as np
+from spherical_geometry.polygon import SphericalPolygon
+
+from drizzlepac import tweakreg
+
+
+class _Footprint(object):
+    def __init__(self, ra, dec, size):
+        ras = [ra - size, ra + size, ra + size, ra - size, ra - size]
+        decs = [dec - size, dec - size, dec + size, dec + size, dec - size]
+        self.skyline = SphericalPolygon.from_radec(ras, decs, center=(ra, dec))
+
+
+def test_overlap_matrix_matches_all_intersections():
+    np.random.seed(7)
+    images = [_Footprint(*p) for p in
+              np.random.uniform([10, 20, 0.01], [10.5, 20.5, 0.08], (30, 3))]
+    empty = _Footprint(0, 0, 1)
+    empty.skyline = SphericalPolygon([])
+    images.append(empty)
+
+    m = tweakreg._overlap_matrix(images)
+
+    nimg = len(images)
+    expected = np.zeros((nimg, nimg))
+    for i in range(nimg):
+        for j in range(i + 1, nimg):
+            expected[i, j] = expected[j, i] = np.fabs(
+                images[i].skyline.intersection(images[j].skyline).area()
+            )
+    assert np.array_equal(m > 0, expected > 0)
+    assert np.allclose(m, expected, rtol=0, atol=1e-14)
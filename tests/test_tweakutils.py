@@ -0,0 +1,84 @@
+import numpy as np
+
+from drizzlepac import cdriz, tweakutils
+
+
+def test_xy_offset_histogram_matches_arrxyzero():
+    np.random.seed(2)
+    ref = np.round(np.random.uniform(-50, 50, (500, 2)) * 8) / 8
+    offsets = np.round(np.random.uniform(-3, 3, (500, 2)) * 8) / 8
+    img = np.vstack([ref + offsets, ref + 2.5, ref * 1000])
+    img[:3] = np.nan
+
+    for searchrad in [0.3, 1.0, 2.5]:
+        zpmat = cdriz.arrxyzero(img.astype(np.float32),
+                                ref.astype(np.float32), searchrad)
+        hist = tweakutils.xy_offset_histogram(img, ref, searchrad)
+        assert hist.dtype == zpmat.dtype
+        assert np.array_equal(hist, zpmat)
+
+
+def test_tree_xyxymatch_closest_unique_matches():
+    np.random.seed(4)
+    ref = np.random.uniform(0, 200, (300, 2))
+    img = np.vstack([ref[:200] + [3.0, -2.0] +
+                     np.random.normal(0, 0.2, (200, 2)),
+                     ref[:20] + [3.3, -2.0], [[np.nan, 5.0]]])
+
+    m = tweakutils.tree_xyxymatch(img, ref, origin=(3.0, -2.0),
+                                  tolerance=1.0)
+    assert np.array_equal(m['ref_idx'], np.unique(m['ref_idx']))
+    assert len(np.unique(m['input_idx'])) == len(m)
+    assert len(m) >= 190
+    d = np.hypot(m['input_x'] - 3.0 - m['ref_x'],
+                 m['input_y'] + 2.0 - m['ref_y'])
+    assert np.all(d < 1.0)
+    assert np.array_equal(m['input_x'], img[m['input_idx'], 0])
+    assert np.array_equal(m['ref_y'], ref[m['ref_idx'], 1])
+
+    # each reference source is matched to the closest of the image sources
+    # for which it is the nearest reference source:
+    dist = np.hypot(*(img[:-1, None, :] - [3.0, -2.0] - ref[None, :, :]).T).T
+    nearest = dist.argmin(axis=1)
+    for r, i in zip(m['ref_idx'], m['input_idx']):
+        assert i == np.argmin(np.where(nearest == r, dist[:, r], np.inf))
+
+
+def test_readcols_formats(tmpdir):
+    xy = np.random.RandomState(4).uniform(0, 4000, (50, 3))
+    txt = str(tmpdir.join('cat.txt'))
+    with open(txt, 'w') as f:
+        f.write('# x y flux\n\n')
+        f.write('\n'.join('{:.6f} {:.6f} {:.6f}'.format(*r) for r in xy))
+        f.write('\n1 2 INDEF\n')
+    np.savetxt(str(tmpdir.join('cat.csv')), xy, delimiter=',', fmt='%.6f')
+    np.save(str(tmpdir.join('cat.npy')), xy)
+
+    for ext in ['txt', 'csv', 'npy']:
+        x, y = tweakutils.readcols(str(tmpdir.join('cat.' + ext)),
+                                   cols=['c1', 'c3'])
+        assert np.allclose(x, xy[:, 0], rtol=0, atol=1e-6)
+        assert np.allclose(y, xy[:, 2], rtol=0, atol=1e-6)
+
+
+def test_sexagesimal_columns(tmpdir):
+    fname = str(tmpdir.join('radec.txt'))
+    with open(fname, 'w') as f:
+        f.write('12 30 00.0 -30 15 00.0\n')
+        f.write('01 00 36.0 +00 30 36.0\n')
+        f.write('-00 00 36.0 -00 00 36.0\n')
+    ra, dec = tweakutils.readcols(fname, cols=['c1-c3', 'c4-c6'])
+    assert np.allclose(ra, [187.5, 15.15, -0.15], rtol=0, atol=1e-12)
+    assert np.allclose(dec, [-30.25, 0.51, -0.01], rtol=0, atol=1e-12)
+    assert np.allclose(tweakutils.parse_sexagesimal(['12:30:00', '45.5']),
+                       [12.5, 45.5], rtol=0, atol=1e-12)
+
+
+def test_readcols_skips_short_lines(tmpdir):
+    fname = str(tmpdir.join('ragged.txt'))
+    with open(fname, 'w') as f:
+        f.write('1 2 3\n4 5\n6 7 8 9\n')
+    x, y, z = tweakutils.readcols(fname, cols=['c1', 'c2', 'c3'])
+    assert np.array_equal(x, [1, 6])
+    assert np.array_equal(y, [2, 7])
+    assert np.array_equal(z, [3, 8])